@@ -0,0 +1,39 @@
+"""add task state trigger
+
+Revision ID: 1b7e5c9d2a84
+Revises: 4a3c2b1d5e6f
+Create Date: 2014-06-05 16:48:03.519844
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '1b7e5c9d2a84'
+down_revision = '4a3c2b1d5e6f'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.execute('''
+CREATE OR REPLACE FUNCTION task_state() RETURNS trigger AS $$
+BEGIN
+    IF (COALESCE(NEW.n_task_runs, 0) >= COALESCE(NEW.n_answers, 30)) THEN
+        NEW.state := 'completed';
+    ELSIF (NEW.state = 'completed') THEN
+        NEW.state := 'ongoing';
+    END IF;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+CREATE TRIGGER task_state
+BEFORE INSERT OR UPDATE OF n_answers, n_task_runs, state ON task
+FOR EACH ROW EXECUTE PROCEDURE task_state();
+''')
+    # Run python cli.py reconcile_tasks afterwards to fix the state of the
+    # existing tasks
+
+
+def downgrade():
+    op.execute('DROP TRIGGER IF EXISTS task_state ON task')
+    op.execute('DROP FUNCTION IF EXISTS task_state()')
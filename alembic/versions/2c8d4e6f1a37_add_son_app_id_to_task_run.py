@@ -0,0 +1,51 @@
+"""add son_app_id to task_run and is_it_spam to task
+
+Revision ID: 2c8d4e6f1a37
+Revises: 5d2f8e0a7c13
+Create Date: 2014-06-12 16:40:08.531904
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '2c8d4e6f1a37'
+down_revision = '5d2f8e0a7c13'
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.engine.reflection import Inspector
+
+
+field = 'son_app_id'
+# is_it_spam was added by hand to some deployments, so the column added here
+# is marked with this comment, and only that one is dropped by downgrade
+spam_comment = 'added by revision %s' % revision
+
+
+def upgrade():
+    op.add_column('task_run', sa.Column(field, sa.Integer))
+    # Backfill the column from the info JSON of the existing task runs
+    query = '''UPDATE task_run SET son_app_id=CAST(SUBSTRING(info FROM
+               '"son_app_id": *"?(-?[0-9]+)') AS INTEGER)
+               WHERE info LIKE '%"son_app_id"%' '''
+    op.execute(query)
+    op.create_index('task_run_son_app_id_user_id_idx', 'task_run',
+                    ['app_id', 'son_app_id', 'user_id'])
+    op.create_index('task_run_son_app_id_user_ip_idx', 'task_run',
+                    ['app_id', 'son_app_id', 'user_ip'])
+    inspector = Inspector.from_engine(op.get_bind())
+    columns = [c['name'] for c in inspector.get_columns('task')]
+    if 'is_it_spam' not in columns:
+        op.add_column('task', sa.Column('is_it_spam', sa.Integer, default=0,
+                                        server_default='0'))
+        op.execute("COMMENT ON COLUMN task.is_it_spam IS '%s'" % spam_comment)
+
+
+def downgrade():
+    query = sa.text('''SELECT col_description(attrelid, attnum)
+                    FROM pg_attribute WHERE attrelid='task'::regclass
+                    AND attname='is_it_spam' AND NOT attisdropped''')
+    if op.get_bind().execute(query).scalar() == spam_comment:
+        op.drop_column('task', 'is_it_spam')
+    op.drop_index('task_run_son_app_id_user_ip_idx')
+    op.drop_index('task_run_son_app_id_user_id_idx')
+    op.drop_column('task_run', field)
@@ -0,0 +1,62 @@
+"""add n_task_runs counter to task
+
+Revision ID: 4a3c2b1d5e6f
+Revises: 3f113ca6c186
+Create Date: 2014-06-02 10:12:41.204512
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4a3c2b1d5e6f'
+down_revision = '3f113ca6c186'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+field = 'n_task_runs'
+
+
+def upgrade():
+    op.add_column('task', sa.Column(field, sa.Integer, default=0,
+                                    server_default='0'))
+    # Backfill the counter from the existing task runs
+    query = '''UPDATE task SET n_task_runs=counts.n FROM
+               (SELECT task_id, COUNT(id) AS n FROM task_run
+               GROUP BY task_id) AS counts
+               WHERE task.id=counts.task_id'''
+    op.execute(query)
+    op.execute('''
+CREATE OR REPLACE FUNCTION task_run_counter() RETURNS trigger AS $$
+BEGIN
+    IF (TG_OP = 'INSERT' OR TG_OP = 'UPDATE') THEN
+        UPDATE task SET n_task_runs = COALESCE(n_task_runs, 0) + 1
+        WHERE id = NEW.task_id;
+    END IF;
+    IF (TG_OP = 'DELETE' OR TG_OP = 'UPDATE') THEN
+        UPDATE task SET n_task_runs = GREATEST(COALESCE(n_task_runs, 0) - 1, 0)
+        WHERE id = OLD.task_id;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+CREATE TRIGGER task_run_counter
+AFTER INSERT OR DELETE OR UPDATE OF task_id ON task_run
+FOR EACH ROW EXECUTE PROCEDURE task_run_counter();
+''')
+    op.execute('''CREATE INDEX task_app_id_priority_idx ON task
+                  (app_id, priority_0 DESC, id ASC)
+                  WHERE state != 'completed' ''')
+    op.create_index('task_run_task_id_user_id_idx', 'task_run',
+                    ['task_id', 'user_id'])
+    op.create_index('task_run_task_id_user_ip_idx', 'task_run',
+                    ['task_id', 'user_ip'])
+
+
+def downgrade():
+    op.drop_index('task_run_task_id_user_ip_idx')
+    op.drop_index('task_run_task_id_user_id_idx')
+    op.drop_index('task_app_id_priority_idx')
+    op.execute('DROP TRIGGER IF EXISTS task_run_counter ON task_run')
+    op.execute('DROP FUNCTION IF EXISTS task_run_counter()')
+    op.drop_column('task', field)
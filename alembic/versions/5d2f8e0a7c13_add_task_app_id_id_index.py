@@ -0,0 +1,23 @@
+"""add task app_id id index
+
+Revision ID: 5d2f8e0a7c13
+Revises: 1b7e5c9d2a84
+Create Date: 2014-06-09 11:03:27.118230
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5d2f8e0a7c13'
+down_revision = '1b7e5c9d2a84'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.execute('''CREATE INDEX task_app_id_id_idx ON task (app_id, id)
+                  WHERE state != 'completed' ''')
+
+
+def downgrade():
+    op.drop_index('task_app_id_id_idx')
@@ -0,0 +1,36 @@
+"""add task_run_stats rollups and stats_watermark
+
+Revision ID: 6e1a9c3b7d20
+Revises: 2c8d4e6f1a37
+Create Date: 2014-06-20 10:12:41.203518
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '6e1a9c3b7d20'
+down_revision = '2c8d4e6f1a37'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table(
+        'task_run_stats',
+        sa.Column('app_id', sa.Integer, primary_key=True,
+                  autoincrement=False),
+        sa.Column('day', sa.Text, primary_key=True),
+        sa.Column('hour', sa.Text, primary_key=True),
+        sa.Column('n_auth', sa.Integer, nullable=False, server_default='0'),
+        sa.Column('n_anon', sa.Integer, nullable=False, server_default='0')
+    )
+    op.create_table(
+        'stats_watermark',
+        sa.Column('name', sa.Text, primary_key=True),
+        sa.Column('last_id', sa.Integer, nullable=False, server_default='0')
+    )
+
+
+def downgrade():
+    op.drop_table('stats_watermark')
+    op.drop_table('task_run_stats')
@@ -3,6 +3,7 @@ import os
 import sys
 import optparse
 import inspect
+import json
 
 import pybossa.model as model
 from pybossa.core import db
@@ -65,6 +66,124 @@ def fixtures():
     db.session.commit()
 
 
+def reconcile_tasks():
+    '''Fix drift in task n_answers, n_task_runs and state'''
+    from sqlalchemy.sql import text
+    # DEPRECATED: task.info.n_answers overrides task.n_answers
+    sql = text('''SELECT id, info, n_answers FROM task
+               WHERE info LIKE '%"n_answers"%' ''')
+    # the info is parsed here, as it is JSON within a text column, and the
+    # tasks to fix are updated 1000 at a time
+    fixes = []
+    for row in db.engine.execute(sql):
+        info = json.loads(row.info)
+        if isinstance(info, dict) and info.get('n_answers') and \
+                int(info['n_answers']) != row.n_answers:
+            fixes.append((row.id, int(info['n_answers'])))
+    for i in range(0, len(fixes), 1000):
+        batch = fixes[i:i + 1000]
+        values = ', '.join('(:id_%s, :n_%s)' % (j, j)
+                           for j in range(len(batch)))
+        params = {}
+        for j, (task_id, n_answers) in enumerate(batch):
+            params['id_%s' % j] = task_id
+            params['n_%s' % j] = n_answers
+        db.engine.execute(text('''UPDATE task SET n_answers=fixed.n
+                               FROM (VALUES %s) AS fixed (id, n)
+                               WHERE task.id=fixed.id''' % values),
+                          **params)
+    print "n_answers fixed for %s tasks" % len(fixes)
+    # Recount the task runs of every task in bulk
+    sql = text('''UPDATE task SET n_task_runs=counts.n FROM
+               (SELECT task.id, COUNT(task_run.id) AS n FROM task
+               LEFT OUTER JOIN task_run ON task.id=task_run.task_id
+               GROUP BY task.id) AS counts
+               WHERE task.id=counts.id
+               AND task.n_task_runs IS DISTINCT FROM counts.n''')
+    print "n_task_runs fixed for %s tasks" % db.engine.execute(sql).rowcount
+    # The task_state trigger sets the right state on any update of it
+    sql = text('''UPDATE task SET state=state WHERE
+               (n_task_runs >= n_answers AND state != 'completed')
+               OR (n_task_runs < n_answers AND state = 'completed')''')
+    print "state fixed for %s tasks" % db.engine.execute(sql).rowcount
+
+def warm_cache(n_apps=10, workers=4):
+    '''Precompute the cached front page, listings and stats of the top apps'''
+    import time
+    from multiprocessing.pool import ThreadPool
+    from sqlalchemy.sql import text
+    from pybossa.cache import apps as cached_apps
+    from pybossa.cache import categories as cached_cat
+    from pybossa.cache import users as cached_users
+    from pybossa import stats
+
+    jobs = [(cached_apps.get_featured_front_page, ()),
+            (cached_apps.get_top, ()),
+            (cached_users.get_top, ()),
+            (cached_cat.get_all, ()),
+            (cached_cat.get_used, ()),
+            (cached_apps.n_featured, ()),
+            (cached_apps.n_published, ()),
+            (cached_apps.get_featured, ('featured', 1, 5))]
+    for c in cached_cat.get_all():
+        jobs.append((cached_apps.n_count, (c['short_name'],)))
+        # the front page shows one app per category, and the listings five
+        jobs.append((cached_apps.get, (c['short_name'], 1, 1)))
+        jobs.append((cached_apps.get, (c['short_name'], 1, 5)))
+    # the apps with most answers in the last week first
+    sql = text('''SELECT app_id FROM task_run
+               WHERE finish_time > :since GROUP BY app_id
+               ORDER BY COUNT(id) DESC LIMIT :limit''')
+    since = time.strftime('%Y-%m-%dT%H:%M:%S',
+                          time.gmtime(time.time() - 7 * 24 * 60 * 60))
+    for row in db.engine.execute(sql, since=since, limit=int(n_apps)):
+        jobs.append((stats.get_stats, (row.app_id, web.app.config['GEO'])))
+
+    def warm(job):
+        f, args = job
+        start = time.time()
+        error = None
+        with web.app.test_request_context():
+            try:
+                f(*args)
+            except Exception as e:
+                error = e
+            finally:
+                db.session.remove()
+        return f.__name__, args, time.time() - start, error
+
+    start = time.time()
+    pool = ThreadPool(int(workers))
+    try:
+        for name, args, elapsed, error in pool.imap(warm, jobs):
+            args = ', '.join(str(a) for a in args)
+            if error is None:
+                print "%.2fs %s(%s)" % (elapsed, name, args)
+            else:
+                print "%.2fs %s(%s) failed: %s" % (elapsed, name, args, error)
+    finally:
+        pool.close()
+        pool.join()
+    print "%s keys warmed in %.2fs" % (len(jobs), time.time() - start)
+
+def rollup_stats(rebuild=None):
+    '''Fold the new task runs into the stats rollups (run it from cron)'''
+    import time
+    from pybossa import stats
+    if rebuild not in (None, 'rebuild'):
+        print "Usage: python cli.py rollup_stats [rebuild]"
+        return
+    start = time.time()
+    n = stats.rollup(rebuild=(rebuild == 'rebuild'))
+    print "%s task runs folded in %.2fs" % (n, time.time() - start)
+
+
+def reset_geo():
+    '''Remove the locations of the IP addresses kept in Redis'''
+    from pybossa import geo
+    geo.reset()
+
+
 ## ==================================================
 ## Misc stuff for setting up a command line interface
 
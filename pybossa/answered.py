@@ -0,0 +1,268 @@
+# -*- coding: utf8 -*-
+# This file is part of PyBossa.
+#
+# Copyright (C) 2013 SF Isle of Man Limited
+#
+# PyBossa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyBossa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Index of the tasks already answered by every user for the scheduler.
+
+The scheduler must skip the tasks that the user (or IP for anonymous users)
+has already answered. Instead of an anti-join with the task_run table, that
+grows with the contributions of the user, every (app, user) and (app, IP)
+pair gets a Redis bitmap with one bit per task of the app, set when the user
+answers it:
+
+    pybossa_sched:app:<app_id>:answered:<ns>:user:<user_id>
+    pybossa_sched:app:<app_id>:answered:<ns>:ip:<user_ip>
+
+The bit of a task is task.id - base, where base is the lowest task id of the
+app minus one. Bit 0 is always set, so a bitmap exists once it has been
+built. The ids of an app are not contiguous (the apps share the id sequence,
+and tasks can be added long after the first ones), so the bitmaps only cover
+MAX_SPAN ids from the base, at most 16KB each. The tasks above it are
+checked in the DB. The namespace ns holds the base and a generation number,
+so all the bitmaps of an app are dropped by changing it.
+Multi-stage apps also get one bitmap per stage (son_app_id) with the answers
+sent for that stage.
+
+Bitmaps are built from the DB when they are missing, updated once a new
+TaskRun is committed, and they expire after SCHED_QUEUE_TIMEOUT seconds. A
+bitmap can still miss an answer committed while it was being built, so the
+scheduler checks its final candidates with check, and the answers found
+there are set in the bitmap.
+
+The Redis calls go through the circuit breaker (see pybossa.breaker): when
+Redis is unavailable get returns None, and the scheduler uses check instead.
+
+This module exports:
+    * get: for getting which tasks of a list the user has answered
+    * check: for getting which tasks of a list the user has answered in the DB
+    * delete: for dropping the bitmaps of an app
+
+"""
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_session
+from sqlalchemy.sql import text
+
+from pybossa.core import app, db, redis_master
+from pybossa.breaker import redis_breaker, Unavailable
+import pybossa.model as model
+
+KEYPREFIX = 'pybossa_sched'
+# Task ids covered by a bitmap from the base of the app
+MAX_SPAN = 2 ** 17
+
+
+def _timeout():
+    return app.config.get('SCHED_QUEUE_TIMEOUT', 24 * 60 * 60)
+
+
+def _ns_key(app_id):
+    return '%s:app:%s:answered' % (KEYPREFIX, app_id)
+
+
+def _key(app_id, ns, user_id=None, user_ip=None, son_app_id=None):
+    key = '%s:%s' % (_ns_key(app_id), ns)
+    if son_app_id is not None:
+        key += ':son:%s' % son_app_id
+    if user_id:
+        return '%s:user:%s' % (key, user_id)
+    return '%s:ip:%s' % (key, user_ip)
+
+
+def _namespace(app_id, refresh=False):
+    """Return the namespace of the bitmaps of an app: the lowest task id of
+    the app minus one (the base) and a generation number"""
+    key = _ns_key(app_id)
+    ns = None if refresh else redis_master.get(key)
+    if ns is None:
+        sql = text('''SELECT MIN(id) FROM task WHERE app_id=:app_id''')
+        base = db.engine.execute(sql, app_id=app_id).scalar()
+        if base is None:
+            return None
+        gen = redis_master.incr('%s:gen' % key)
+        ns = '%s.%s' % (base - 1, gen)
+        p = redis_master.pipeline()
+        p.set(key, ns)
+        p.expire(key, _timeout())
+        p.execute()
+    return ns
+
+
+def _base(ns):
+    return int(ns.split('.')[0])
+
+
+def _answers(app_id, user_id=None, user_ip=None, son_app_id=None,
+             task_ids=None):
+    """Return the task_ids of the answers of a user in the DB"""
+    sql = '''SELECT task_id FROM task_run WHERE app_id=:app_id'''
+    if task_ids is not None:
+        sql += ''' AND task_id IN :task_ids'''
+        task_ids = tuple(task_ids)
+    if son_app_id is not None:
+        sql += ''' AND son_app_id=:son_app_id'''
+    if user_id:
+        sql += ''' AND user_id=:user_id'''
+    else:
+        sql += ''' AND user_ip=:user_ip'''
+    rows = db.engine.execute(text(sql), app_id=app_id, user_id=user_id,
+                             user_ip=user_ip, son_app_id=son_app_id,
+                             task_ids=task_ids)
+    return set(row.task_id for row in rows)
+
+
+def _build(key, base, app_id, user_id=None, user_ip=None, son_app_id=None):
+    """Build the bitmap of a user from the DB"""
+    task_ids = _answers(app_id, user_id, user_ip, son_app_id)
+    p = redis_master.pipeline()
+    p.setbit(key, 0, 1)
+    for task_id in task_ids:
+        if base < task_id <= base + MAX_SPAN:
+            p.setbit(key, task_id - base, 1)
+    p.expire(key, _timeout())
+    p.execute()
+
+
+def get(app_id, task_ids, user_id=None, user_ip=None, son_app_id=None):
+    """Return the set of task_ids answered by the user (in the son_app_id
+    stage, if given), or None if Redis is unavailable"""
+    if not task_ids:
+        return set()
+    if not user_id and not user_ip:
+        user_ip = '127.0.0.1'
+    try:
+        result = redis_breaker.call(_get, app_id, task_ids, user_id, user_ip,
+                                    son_app_id)
+    except Unavailable:
+        return None
+    if result is None:
+        return None
+    done, beyond = result
+    if beyond:
+        done |= _answers(app_id, user_id, user_ip, son_app_id, beyond)
+    return done
+
+
+def _get(app_id, task_ids, user_id, user_ip, son_app_id):
+    """Return the task_ids set in the bitmap, and the ones beyond its span"""
+    ns = _namespace(app_id)
+    if ns is None or min(task_ids) <= _base(ns):
+        # the lowest task id of the app has changed
+        ns = _namespace(app_id, refresh=True)
+    if ns is None:
+        # the app has no tasks yet
+        return None
+    base = _base(ns)
+    within = [t for t in task_ids if t - base <= MAX_SPAN]
+    beyond = [t for t in task_ids if t - base > MAX_SPAN]
+    if not within:
+        return set(), beyond
+    key = _key(app_id, ns, user_id, user_ip, son_app_id)
+    if not redis_master.exists(key):
+        _build(key, base, app_id, user_id, user_ip, son_app_id)
+    p = redis_master.pipeline(transaction=False)
+    for task_id in within:
+        p.getbit(key, task_id - base)
+    done = set(task_id for task_id, bit in zip(within, p.execute()) if bit)
+    return done, beyond
+
+
+def check(app_id, task_ids, user_id=None, user_ip=None, son_app_id=None):
+    """Return the set of task_ids answered by the user in the DB, and set
+    them in the bitmaps of the user"""
+    if not task_ids:
+        return set()
+    if not user_id and not user_ip:
+        user_ip = '127.0.0.1'
+    done = _answers(app_id, user_id, user_ip, son_app_id, task_ids)
+    for task_id in done:
+        _answered(app_id, task_id, user_id, user_ip, son_app_id)
+    return done
+
+
+def delete(app_id):
+    """Drop the bitmaps of an app, so they are rebuilt on next request.
+    Old bitmaps are not removed, they just expire"""
+    try:
+        redis_breaker.call(redis_master.delete, _ns_key(app_id))
+    except Unavailable:
+        pass
+
+
+def _set_bits(app_id, task_id, keys):
+    ns = redis_master.get(_ns_key(app_id))
+    if ns is None or not 0 < task_id - _base(ns) <= MAX_SPAN:
+        return
+    for key in keys(ns):
+        # only update existing bitmaps, as missing ones are built from the DB
+        if redis_master.exists(key):
+            redis_master.setbit(key, task_id - _base(ns), 1)
+
+
+def _answered(app_id, task_id, user_id=None, user_ip=None, son_app_id=None):
+    """Set the bit of an answered task, if the bitmaps of the user exist"""
+    def keys(ns):
+        if son_app_id is None:
+            return [_key(app_id, ns, user_id, user_ip)]
+        return [_key(app_id, ns, user_id, user_ip, son_app_id)]
+    try:
+        redis_breaker.call(_set_bits, app_id, task_id, keys)
+    except Unavailable:
+        # the bit is set by check when the task is a candidate again
+        pass
+
+
+def _pending(session):
+    if '_answered_pending' not in session.__dict__:
+        session._answered_pending = []
+    return session._answered_pending
+
+
+@event.listens_for(model.TaskRun, 'after_insert')
+def _task_run_added(mapper, conn, target):
+    """Set the bit of the answered task once the TaskRun is committed, so a
+    rolled back answer is never skipped"""
+    session = object_session(target)
+    if session is not None:
+        _pending(session).append(('added', target.app_id, target.task_id,
+                                  target.user_id, target.user_ip,
+                                  target.son_app_id))
+
+
+@event.listens_for(model.TaskRun, 'after_delete')
+def _task_run_deleted(mapper, conn, target):
+    """Answers are rarely deleted, so just drop the bitmaps of the app once
+    it is committed"""
+    session = object_session(target)
+    if session is not None:
+        _pending(session).append(('deleted', target.app_id))
+
+
+@event.listens_for(Session, 'after_commit')
+def _committed(session):
+    for change in session.__dict__.pop('_answered_pending', []):
+        if change[0] == 'deleted':
+            delete(change[1])
+            continue
+        app_id, task_id, user_id, user_ip, son_app_id = change[1:]
+        _answered(app_id, task_id, user_id, user_ip)
+        if son_app_id is not None:
+            _answered(app_id, task_id, user_id, user_ip, son_app_id)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _rolled_back(session):
+    session.__dict__.pop('_answered_pending', None)
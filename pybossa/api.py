@@ -30,7 +30,7 @@ import json
 from flask import Blueprint, request, abort, Response, current_app
 from flask.views import MethodView
 from flask.ext.login import current_user
-from werkzeug.exceptions import NotFound
+from werkzeug.exceptions import NotFound, BadRequest
 
 from pybossa.util import jsonpify, crossdomain
 import pybossa.model as model
@@ -314,6 +314,37 @@ def new_task(app_id):
     except Exception as e:
         return error.format_exception(e, target='app', action='GET')
 
+@jsonpify
+@blueprint.route('/app/<app_id>/newtasks')
+@crossdomain(origin='*', headers=cors_headers)
+@ratelimit(limit=300, per=15*60)
+def new_tasks(app_id):
+    """Return a list with up to n (?n=K) different tasks for the current
+    user, picked in a single scheduler pass"""
+    try:
+        app = db.session.query(model.App).get(app_id)
+        if app is None:
+            raise NotFound
+        if request.args.get('offset'):
+            offset = int(request.args.get('offset'))
+        else:
+            offset = 0
+        try:
+            n = int(request.args.get('n', 1))
+        except ValueError:
+            raise BadRequest('n should be a positive integer')
+        if n < 1:
+            raise BadRequest('n should be a positive integer')
+        n = min(n, current_app.config.get('SCHED_MAX_TASKS', 20))
+        user_id = None if current_user.is_anonymous() else current_user.id
+        user_ip = request.remote_addr if current_user.is_anonymous() else None
+        tasks = sched.new_tasks(app_id, user_id, user_ip, offset, n,
+                                son_app_id=request.args.get('son_app_id', '0'))
+        return Response(json.dumps([t.dictize() for t in tasks]),
+                        mimetype="application/json")
+    except Exception as e:
+        return error.format_exception(e, target='app', action='GET')
+
 @jsonpify
 @blueprint.route('/app/<app_id>/<son_app_id>/newtask2')
 @crossdomain(origin='*', headers=cors_headers)
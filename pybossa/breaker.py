@@ -0,0 +1,135 @@
+# -*- coding: utf8 -*-
+# This file is part of PyBossa.
+#
+# Copyright (C) 2013 SF Isle of Man Limited
+#
+# PyBossa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyBossa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Circuit breaker for the Redis calls.
+
+When Redis is down or too slow, every call waits for the socket timeout
+before failing. After REDIS_BREAKER_THRESHOLD consecutive failures the
+breaker opens, and the calls fail at once during REDIS_BREAKER_COOLDOWN
+seconds, so the cache goes straight to the DB and the rate limits are not
+enforced. Then one call is let through: if it works the breaker closes,
+otherwise it stays open for another cool-down.
+
+The state of the breaker is kept within every process.
+
+This module exports:
+    * CircuitBreaker class: for guarding the calls to a service
+    * Unavailable exception: raised instead of calling an unavailable service
+    * redis_breaker: the breaker of the Redis calls
+    * get: for getting the state of the breakers of this process
+
+"""
+import time
+import threading
+from redis import exceptions
+
+from pybossa.core import app
+
+# Errors telling that Redis is unavailable, unlike e.g. a wrong command
+ERRORS = (exceptions.ConnectionError,
+          getattr(exceptions, 'TimeoutError', exceptions.ConnectionError))
+
+
+class Unavailable(Exception):
+
+    """The service failed, or it is not called during a cool-down"""
+
+    pass
+
+
+class CircuitBreaker(object):
+
+    """Stop calling a failing service during a cool-down"""
+
+    def __init__(self, name, threshold=5, cooldown=30, errors=ERRORS):
+        self.name = name
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.errors = errors
+        self.failures = 0
+        self.opened_at = None
+        self.stats = dict(calls=0, failures=0, short_circuits=0, opens=0)
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if time.time() - self.opened_at < self.cooldown:
+            return 'open'
+        return 'half-open'
+
+    def allow(self):
+        """Return True if the service can be called"""
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.time() - self.opened_at < self.cooldown:
+                return False
+            # half open: this call tries the service, and the others wait
+            # for another cool-down
+            self.opened_at = time.time()
+            return True
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            if self.opened_at is not None:
+                self.opened_at = None
+                app.logger.warning('%s is available again' % self.name)
+
+    def failure(self, error):
+        with self._lock:
+            self.failures += 1
+            self.stats['failures'] += 1
+            if self.opened_at is None and self.failures >= self.threshold:
+                self.opened_at = time.time()
+                self.stats['opens'] += 1
+                app.logger.error('%s is unavailable for %ss: %s' %
+                                 (self.name, self.cooldown, error))
+
+    def call(self, f, *args, **kwargs):
+        """Call f, or raise Unavailable if the breaker is open or f fails
+        with one of the errors of the breaker"""
+        if not self.allow():
+            self.stats['short_circuits'] += 1
+            raise Unavailable(self.name)
+        self.stats['calls'] += 1
+        try:
+            result = f(*args, **kwargs)
+        except self.errors as e:
+            self.failure(e)
+            raise Unavailable(self.name)
+        self.success()
+        return result
+
+
+redis_breaker = CircuitBreaker('Redis',
+                               app.config.get('REDIS_BREAKER_THRESHOLD', 5),
+                               app.config.get('REDIS_BREAKER_COOLDOWN', 30))
+
+
+def get():
+    """Return the state of the breakers of this process"""
+    breakers = []
+    for breaker in (redis_breaker,):
+        b = dict(breaker.stats)
+        b.update(name=breaker.name, state=breaker.state,
+                 consecutive_failures=breaker.failures)
+        breakers.append(b)
+    return breakers
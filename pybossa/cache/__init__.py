@@ -23,83 +23,555 @@ It exports:
     * cache: for caching functions without parameters
     * memoize: for caching functions using its arguments as part of the key
     * delete_cached: to remove a cached value
+    * memoize_many: for computing and caching many values of a memoized
+      function at once
     * delete_memoized: to remove a cached value from the memoize decorator
+    * update_memoized: to update in place a value of the memoize decorator
+
+Only one worker computes a missing value at a time, while the others wait
+for it. Values can also be served stale while one worker refreshes them
+(see the stale argument of the decorators), and timeouts are shortened at
+random by up to JITTER, so keys cached together do not expire together.
+Hits, misses, compute and Redis times and value sizes are recorded per
+cached function (see pybossa.cachestats).
+
+Values are also kept until the end of the request (see pybossa.memo), so
+calling a cached function again within a request does not go to Redis.
+
+The Redis calls go through a circuit breaker (see pybossa.breaker): while
+Redis is unavailable the functions are just called, and nothing is cached.
+
+Every memoized function has a generation counter, stored along its values.
+Removing all the values of a function just increments the counter, so the
+values of older generations are ignored until they expire.
+
+Cached values can also be kept in a small LRU cache within every process,
+so hot keys are not fetched from Redis on every request. It is enabled with
+REDIS_CACHE_LOCAL_SIZE (max number of keys) and REDIS_CACHE_LOCAL_TIMEOUT
+(seconds a key is kept). Deleted keys are removed from the LRU cache of all
+the processes through Redis pub/sub.
+
+Values are pickled, or encoded with msgpack if it is installed and
+REDIS_CACHE_ENCODING is 'msgpack', and compressed with zlib when they are
+larger than REDIS_CACHE_COMPRESS_THRESHOLD bytes. Cached functions must
+return plain values (numbers, strings, tuples, lists and dicts): mapped
+instances drag their ORM state along, so they are never cached.
 
 """
 import os
+import time
+import random
 import hashlib
+import threading
+import heapq
+import itertools
+import zlib
 from functools import wraps
-from pybossa.core import redis_master, redis_slave
+from pybossa.core import app, redis_master, redis_slave
+from pybossa import cachestats
+from pybossa import memo
+from pybossa.breaker import redis_breaker, Unavailable
 try:
     import cPickle as pickle
 except ImportError:  # pragma: no cover
     import pickle
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
 
 try:
     import settings_local as settings
 except ImportError:  # pragma: no cover
     os.environ['PYBOSSA_REDIS_CACHE_DISABLED'] = '1'
+    settings = None
 
 ONE_DAY = 24 * 60 * 60
 ONE_HOUR = 60 * 60
 HALF_HOUR = 30 * 60
 FIVE_MINUTES = 5 * 60
+# Seconds a worker may take computing a value before another one can do it
+LOCK_TIMEOUT = 60
+# Seconds a worker waits for the value computed by another one
+LOCK_WAIT = 5
+# Fraction of the timeout cut at random from every value, so the values
+# cached at the same time do not expire at the same time
+JITTER = 0.1
+# Values are encoded with this codec, and compressed if they are larger than
+# this number of bytes
+ENCODING = getattr(settings, 'REDIS_CACHE_ENCODING', 'pickle')
+COMPRESS_THRESHOLD = getattr(settings, 'REDIS_CACHE_COMPRESS_THRESHOLD', 1024)
+
+
+class LocalCache(object):
+
+    """Thread safe LRU cache of pickled values with a short timeout"""
+
+    def __init__(self, size=0, timeout=5):
+        self.size = size
+        self.timeout = timeout
+        # key: [last use, expiration time, value]
+        self._data = {}
+        self._clock = itertools.count()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            if item[1] < time.time():
+                del self._data[key]
+                return None
+            item[0] = next(self._clock)
+            return item[2]
+
+    def set(self, key, value, timeout):
+        if not self.size:
+            return
+        with self._lock:
+            expires = time.time() + min(timeout, self.timeout)
+            self._data[key] = [next(self._clock), expires, value]
+            if len(self._data) > self.size:
+                # evict the least recently used tenth at once, so eviction
+                # is not paid on every set
+                n = len(self._data) - self.size + self.size // 10
+                for k in heapq.nsmallest(n, self._data,
+                                         key=lambda k: self._data[k][0]):
+                    del self._data[k]
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def delete_prefix(self, prefix):
+        with self._lock:
+            for key in [k for k in self._data if k.startswith(prefix)]:
+                del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+local_cache = LocalCache(getattr(settings, 'REDIS_CACHE_LOCAL_SIZE', 0),
+                         getattr(settings, 'REDIS_CACHE_LOCAL_TIMEOUT', 5))
+_listener = None
+
+
+def _channel():
+    return "%s:invalidate" % settings.REDIS_KEYPREFIX
+
+
+def _listen():
+    """Remove from the local cache the keys deleted by any process"""
+    while True:
+        try:
+            pubsub = redis_master.pubsub()
+            pubsub.subscribe(_channel())
+            for message in pubsub.listen():
+                if message['type'] != 'message':
+                    continue
+                key = message['data']
+                if key.endswith('*'):
+                    local_cache.delete_prefix(key[:-1])
+                else:
+                    local_cache.delete(key)
+        except Exception:
+            # messages may have been lost, so start again from scratch
+            local_cache.clear()
+            time.sleep(1)
+
+
+def _start_listener():
+    global _listener
+    if _listener is None:
+        _listener = threading.Thread(target=_listen, name='cache-invalidate')
+        _listener.daemon = True
+        _listener.start()
+
+
+def _mapped(value):
+    """Return the first mapped instance found in a value, or None"""
+    if hasattr(value, '_sa_instance_state'):
+        return value
+    if isinstance(value, dict):
+        value = value.values()
+    if isinstance(value, (list, tuple, set, frozenset)):
+        for item in value:
+            found = _mapped(item)
+            if found is not None:
+                return found
+    return None
+
+
+def _dumps(entry):
+    """Encode a value. The first byte tells the codec: p for pickle and m for
+    msgpack, in upper case if the rest is compressed with zlib"""
+    raw, codec = None, 'p'
+    if ENCODING == 'msgpack' and msgpack is not None:
+        try:
+            raw, codec = msgpack.packb(entry, use_bin_type=True), 'm'
+        except (TypeError, ValueError):
+            # e.g. datetimes, which only pickle supports
+            pass
+    if raw is None:
+        raw = pickle.dumps(entry, pickle.HIGHEST_PROTOCOL)
+    if len(raw) > COMPRESS_THRESHOLD:
+        raw, codec = zlib.compress(raw), codec.upper()
+    return codec + raw
+
+
+def _loads(raw):
+    """Decode a value encoded by _dumps"""
+    codec, raw = raw[:1], raw[1:]
+    if codec in ('P', 'M'):
+        raw, codec = zlib.decompress(raw), codec.lower()
+    if codec == 'p':
+        return pickle.loads(raw)
+    if codec == 'm' and msgpack is not None:
+        # msgpack has no tuples, so the entry comes back as a list
+        return tuple(msgpack.unpackb(raw, raw=False))
+    raise ValueError('Unknown cache encoding %r' % codec)
+
+
+def _read(key, gen_key=None):
+    """Return (generation, entry) of a key, from the local cache or Redis.
+    The entry is (fresh_until, value), or None if the key is missing or it
+    was stored for an older generation. The key and the generation of its
+    function are read with a single MGET"""
+    if local_cache.size:
+        _start_listener()
+        raw = local_cache.get(key)
+        if raw is not None:
+            gen, fresh_until, value = _loads(raw)
+            return gen, (fresh_until, value)
+    if gen_key is None:
+        raw, gen = redis_slave.get(key), None
+    else:
+        raw, gen = redis_slave.mget([key, gen_key])
+        gen = _generation(gen_key, gen)
+    return gen, _decode(key, raw, gen)
+
+
+def _read_many(keys, gen_key):
+    """Return (generation, entries) of the keys of a memoized function, read
+    with a single MGET. Entries are as in _read"""
+    entries = [None] * len(keys)
+    missing = range(len(keys))
+    if local_cache.size:
+        _start_listener()
+        missing = []
+        for i, key in enumerate(keys):
+            raw = local_cache.get(key)
+            if raw is None:
+                missing.append(i)
+            else:
+                gen, fresh_until, value = _loads(raw)
+                entries[i] = (fresh_until, value)
+    raws = redis_slave.mget([keys[i] for i in missing] + [gen_key])
+    gen = _generation(gen_key, raws.pop())
+    for i, raw in zip(missing, raws):
+        entries[i] = _decode(keys[i], raw, gen)
+    return gen, entries
+
+
+def _generation(gen_key, gen):
+    """Return the generation read from gen_key, creating it if missing"""
+    if gen is None:
+        # the generation starts at the current time, so it never goes
+        # back to a previous value if the counter is lost
+        redis_master.setnx(gen_key, int(time.time() * 1000))
+        gen = redis_master.get(gen_key)
+    return int(gen)
+
+
+def _decode(key, raw, gen):
+    """Return the entry of a raw value read from Redis, or None if it is
+    missing or it was stored for another generation"""
+    if not raw:
+        return None
+    try:
+        stored_gen, fresh_until, value = _loads(raw)
+    except (TypeError, ValueError, zlib.error, pickle.UnpicklingError):
+        # a value stored by a previous version
+        return None
+    if stored_gen != gen:
+        return None
+    if local_cache.size:
+        local_cache.set(key, raw, ONE_DAY)
+    return fresh_until, value
+
+
+def _write(key, gen, timeout, stale, value, pipe=None):
+    """Store a value, fresh during timeout seconds (minus some jitter) and
+    stale during stale more seconds. The SETEX is queued in pipe if given.
+    Returns the size of the stored value"""
+    found = _mapped(value)
+    if found is not None:
+        app.logger.error('Mapped instance %r not cached in %s' % (found, key))
+        return 0
+    timeout -= random.randint(0, int(timeout * JITTER))
+    raw = _dumps((gen, time.time() + timeout, value))
+    (pipe or redis_master).setex(key, timeout + stale, raw)
+    local_cache.set(key, raw, timeout)
+    return len(raw)
+
+
+def _ms(start):
+    return (time.time() - start) * 1000
 
 
-def cache(key_prefix, timeout=300):
+def _safe(fallback, f, *args, **kwargs):
+    """Call a Redis function through the circuit breaker, returning fallback
+    if Redis is unavailable"""
+    try:
+        return redis_breaker.call(f, *args, **kwargs)
+    except Unavailable:
+        return fallback
+
+
+def _lock(key):
+    """Try to get the lock for recomputing a key. Without Redis every worker
+    computes its value"""
+    return _safe(True, redis_master.set, '%s:lock' % key, 1, nx=True,
+                 ex=LOCK_TIMEOUT)
+
+
+def _compute(name, f, args, kwargs, **counts):
+    """Compute a value without storing it"""
+    start = time.time()
+    value = f(*args, **kwargs)
+    cachestats.record(name, misses=1, compute_ms=_ms(start), **counts)
+    return value
+
+
+def _refresh(name, key, gen, timeout, stale, f, args, kwargs):
+    """Compute and store a value, holding the lock of its key"""
+    try:
+        start = time.time()
+        value = f(*args, **kwargs)
+        compute_ms = _ms(start)
+        size = _safe(0, _write, key, gen, timeout, stale, value)
+        cachestats.record(name, misses=1, compute_ms=compute_ms, writes=1,
+                          bytes=size)
+        return value
+    finally:
+        _safe(None, redis_master.delete, '%s:lock' % key)
+
+
+def _cached(name, key, gen_key, timeout, stale, f, args, kwargs):
+    """Return the cached value of a key, or compute it. Only one worker
+    computes a missing (or stale) value at a time: the others wait for it,
+    or get the stale value meanwhile. The outcome is recorded in the metrics
+    of name (see pybossa.cachestats)"""
+    start = time.time()
+    result = _safe(None, _read, key, gen_key)
+    if result is None:
+        return _compute(name, f, args, kwargs, bypassed=1)
+    gen, entry = result
+    read_ms = _ms(start)
+    if entry is not None:
+        fresh_until, value = entry
+        if fresh_until >= time.time():
+            cachestats.record(name, hits=1, reads=1, read_ms=read_ms)
+            return value
+        if not _lock(key):
+            cachestats.record(name, stale=1, reads=1, read_ms=read_ms)
+            return value
+        cachestats.record(name, reads=1, read_ms=read_ms)
+        return _refresh(name, key, gen, timeout, stale, f, args, kwargs)
+    cachestats.record(name, reads=1, read_ms=read_ms)
+    if _lock(key):
+        return _refresh(name, key, gen, timeout, stale, f, args, kwargs)
+    deadline = time.time() + LOCK_WAIT
+    while time.time() < deadline:
+        time.sleep(0.05)
+        start = time.time()
+        result = _safe(None, _read, key, gen_key)
+        if result is None:
+            break
+        gen, entry = result
+        read_ms = _ms(start)
+        if entry is not None:
+            cachestats.record(name, hits=1, reads=1, read_ms=read_ms)
+            return entry[1]
+        cachestats.record(name, reads=1, read_ms=read_ms)
+    # the worker holding the lock is too slow, or it died
+    return _compute(name, f, args, kwargs)
+
+
+def _delete(keys, prefix=None):
+    """Delete keys from Redis, and from the local cache of every process the
+    keys (or all the keys starting with prefix)"""
+    deleted = _safe(0, redis_master.delete, *keys) if keys else 0
+    _forget([prefix + '*'] if prefix else keys)
+    return deleted
+
+
+def _forget(keys):
+    """Remove keys (or all the keys starting with the ones ending in *) from
+    the local cache of every process"""
+    for key in keys:
+        if key.endswith('*'):
+            local_cache.delete_prefix(key[:-1])
+        else:
+            local_cache.delete(key)
+        if local_cache.size:
+            _safe(None, redis_master.publish, _channel(), key)
+
+
+def _memoize_key(function, args):
+    """Return the key of the value of a memoized function for args"""
+    key_to_hash = ""
+    for i in args:
+        key_to_hash += ":%s" % i
+    key_to_hash = key_to_hash.encode('utf-8')
+    return "%s:%s_args::%s" % (settings.REDIS_KEYPREFIX, function.__name__,
+                               hashlib.md5(key_to_hash).hexdigest())
+
+
+def _memo_key(function, args):
+    """Return the key of the value of a memoized function for args within
+    the request"""
+    key = "%s_args:" % function.__name__
+    for i in args:
+        key += ":%s" % i
+    return key
+
+
+def _gen_key(function):
+    """Return the key of the generation counter of a memoized function"""
+    return "%s:%s_gen" % (settings.REDIS_KEYPREFIX, function.__name__)
+
+
+def cache(key_prefix, timeout=300, stale=0):
     """
     Decorator for caching functions.
 
-    Returns the function value from cache, or the function if cache disabled
+    Returns the function value from cache, or the function if cache disabled.
+    After timeout seconds the value is stale, and it is still returned
+    during stale seconds while one worker computes the new value.
 
     """
     def decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
+            value = memo.get("::%s" % key_prefix)
+            if value is not memo.MISSING:
+                return value
             if os.environ.get('PYBOSSA_REDIS_CACHE_DISABLED') is None:
                 key = "%s::%s" % (settings.REDIS_KEYPREFIX, key_prefix)
-                output = redis_slave.get(key)
-                if output:
-                    return pickle.loads(output)
-                else:
-                    output = f(*args, **kwargs)
-                    redis_master.setex(key, timeout, pickle.dumps(output))
-                    return output
+                memo.count('cache_calls')
+                value = _cached(key_prefix, key, None, timeout, stale, f,
+                                args, kwargs)
             else:
-                return f(*args, **kwargs)
+                value = f(*args, **kwargs)
+            memo.set("::%s" % key_prefix, value)
+            return value
         return wrapper
     return decorator
 
 
-def memoize(timeout=300, debug=False):
+def memoize(timeout=300, stale=0, debug=False):
     """
     Decorator for caching functions using its arguments as part of the key.
 
-    Returns the cached value, or the function if the cache is disabled
+    Returns the cached value, or the function if the cache is disabled. See
+    cache for the stale argument.
 
     """
     def decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
+            value = memo.get(_memo_key(f, args))
+            if value is not memo.MISSING:
+                return value
             if os.environ.get('PYBOSSA_REDIS_CACHE_DISABLED') is None:
-                key = "%s:%s_args:" % (settings.REDIS_KEYPREFIX, f.__name__)
-                key_to_hash = ""
-                for i in args:
-                    key_to_hash += ":%s" % i
-                key_to_hash = key_to_hash.encode('utf-8')
-                key = key + ":" + hashlib.md5(key_to_hash).hexdigest()
+                key = _memoize_key(f, args)
                 #key += "_kwargs"
                 #for i in frozenset(kwargs.items()):
                 #    key += ":%s" % i
-                output = redis_slave.get(key)
-                if output:
-                    return pickle.loads(output)
-                else:
-                    output = f(*args, **kwargs)
-                    redis_master.setex(key, timeout, pickle.dumps(output))
-                    return output
+                memo.count('cache_calls')
+                value = _cached(f.__name__, key, _gen_key(f), timeout, stale,
+                                f, args, kwargs)
             else:
-                return f(*args, **kwargs)
+                value = f(*args, **kwargs)
+            memo.set(_memo_key(f, args), value)
+            return value
+        wrapper.timeout = timeout
+        wrapper.stale = stale
+        return wrapper
+    return decorator
+
+
+def memoize_many(function):
+    """
+    Decorator for computing many values of a memoized function at once.
+
+    The decorated function gets a list of arguments of function, and returns
+    a dict with the value of every one of them, e.g. from a single grouped
+    query. The wrapper reads the cached values of all the arguments with one
+    MGET, passes only the missing (or stale) ones to the decorated function
+    and stores the new values with one pipeline, sharing the keys of
+    function, so delete_memoized(function, arg) removes them too.
+
+    """
+    def decorator(f):
+        @wraps(f)
+        def wrapper(args):
+            values = {}
+            for arg in args:
+                value = memo.get(_memo_key(function, (arg,)))
+                if value is not memo.MISSING:
+                    values[arg] = value
+            args = [arg for arg in args if arg not in values]
+            if args:
+                values.update(_many(f, args))
+                for arg in args:
+                    memo.set(_memo_key(function, (arg,)), values[arg])
+            return values
+
+        def _many(f, args):
+            if os.environ.get('PYBOSSA_REDIS_CACHE_DISABLED') is not None:
+                return f(args)
+            memo.count('cache_calls')
+            keys = [_memoize_key(function, (arg,)) for arg in args]
+            start = time.time()
+            result = _safe(None, _read_many, keys, _gen_key(function))
+            if result is None:
+                start = time.time()
+                values = f(args)
+                cachestats.record(function.__name__, misses=len(args),
+                                  bypassed=len(args), compute_ms=_ms(start))
+                return values
+            gen, entries = result
+            read_ms = _ms(start)
+            values = {}
+            misses = []
+            now = time.time()
+            for arg, key, entry in zip(args, keys, entries):
+                if entry is not None:
+                    values[arg] = entry[1]
+                if entry is None or entry[0] < now:
+                    misses.append((arg, key))
+            cachestats.record(function.__name__, reads=1, read_ms=read_ms,
+                              hits=len(args) - len(misses))
+            if misses:
+                start = time.time()
+                computed = f([arg for arg, key in misses])
+                compute_ms = _ms(start)
+                pipe = redis_master.pipeline(transaction=False)
+                size = 0
+                for arg, key in misses:
+                    values[arg] = computed[arg]
+                    size += _write(key, gen, function.timeout,
+                                   function.stale, values[arg], pipe)
+                _safe(None, pipe.execute)
+                cachestats.record(function.__name__, misses=len(misses),
+                                  compute_ms=compute_ms, writes=len(misses),
+                                  bytes=size)
+            return values
         return wrapper
     return decorator
 
@@ -111,21 +583,50 @@ def delete_memoized(function, arg=None):
     Returns True if success
 
     """
+    if arg:
+        memo.delete(_memo_key(function, (arg,)))
+    else:
+        memo.delete_prefix("%s_args:" % function.__name__)
     if os.environ.get('PYBOSSA_REDIS_CACHE_DISABLED') is None:
-        keys = []
         if arg:
-            key_to_hash = ":%s" % arg
-            key_to_hash = key_to_hash.encode('utf-8')
-            key = "%s:%s_args::%s" % (settings.REDIS_KEYPREFIX,
-                                      function.__name__,
-                                      hashlib.md5(key_to_hash).hexdigest())
-            keys.append(key)
+            _delete([_memoize_key(function, (arg,))])
         else:
-            key = "%s:%s_args::*" % (settings.REDIS_KEYPREFIX,
-                                     function.__name__)
-            keys = redis_master.keys(key)
-        for k in keys:
-            redis_master.delete(k)
+            # the stored values of older generations are misses, and they
+            # just expire
+            _safe(None, redis_master.incr, _gen_key(function))
+            _delete([], prefix="%s:%s_args::" % (settings.REDIS_KEYPREFIX,
+                                                 function.__name__))
+        return True
+
+
+def update_memoized(function, arg, update):
+    """
+    Update in place the memoized value of a function for an argument.
+
+    update gets the cached value and returns the new one. Nothing is done if
+    the value is not cached, and the update is retried if another process
+    changes the value meanwhile. The value keeps its expiration time.
+
+    """
+    memo.delete(_memo_key(function, (arg,)))
+    if os.environ.get('PYBOSSA_REDIS_CACHE_DISABLED') is None:
+        key = _memoize_key(function, (arg,))
+
+        def _update(pipe):
+            raw, ttl = pipe.get(key), pipe.pttl(key)
+            if not raw or ttl is None or ttl <= 0:
+                return
+            try:
+                gen, fresh_until, value = _loads(raw)
+            except (TypeError, ValueError, zlib.error,
+                    pickle.UnpicklingError):
+                return
+            raw = _dumps((gen, fresh_until, update(value)))
+            pipe.multi()
+            pipe.psetex(key, ttl, raw)
+
+        _safe(None, redis_master.transaction, _update, key)
+        _forget([key])
         return True
 
 
@@ -136,6 +637,7 @@ def delete_cached(key):
     Returns True if success
 
     """
+    memo.delete("::%s" % key)
     if os.environ.get('PYBOSSA_REDIS_CACHE_DISABLED') is None:
         key = "%s::%s" % (settings.REDIS_KEYPREFIX, key)
-        return redis_master.delete(key)
+        return _delete([key])
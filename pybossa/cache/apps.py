@@ -16,11 +16,14 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
 
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_session
 from sqlalchemy.sql import func, text
 from pybossa.core import db
 from pybossa.model import Featured, App, TaskRun, Task
 from pybossa.util import pretty_date
-from pybossa.cache import memoize, cache, delete_memoized, delete_cached
+from pybossa.cache import memoize, memoize_many, cache, delete_memoized, \
+    delete_cached, update_memoized
 
 import json
 import string
@@ -30,26 +33,41 @@ import time
 from datetime import timedelta
 
 STATS_FRONTPAGE_TIMEOUT = 12 * 60 * 60
+# The front page values are served stale for a while after they expire, so
+# only one worker refreshes them
+STATS_FRONTPAGE_STALE = 60 * 60
 
 @memoize()
-def get_app(short_name):
+def _get_app(short_name):
+    """Return the columns of an app as a dict, or None"""
     sql = text('''SELECT * FROM
                   app WHERE app.short_name=:short_name''')
     results = db.engine.execute(sql, short_name=short_name)
-    app = App()
     for row in results:
-        app = App(id=row.id, name=row.name, short_name=row.short_name,
-                  created=row.created,
-                  description=row.description,
-                  long_description=row.long_description,
-                  owner_id=row.owner_id,
-                  hidden=row.hidden,
-                  info=json.loads(row.info),
-                  allow_anonymous_contributors=row.allow_anonymous_contributors)
-    return app
-
-
-@cache(timeout=STATS_FRONTPAGE_TIMEOUT, key_prefix="front_page_featured_apps")
+        return dict(id=row.id, name=row.name, short_name=row.short_name,
+                    created=row.created,
+                    description=row.description,
+                    long_description=row.long_description,
+                    owner_id=row.owner_id,
+                    hidden=row.hidden,
+                    info=json.loads(row.info),
+                    allow_anonymous_contributors=row.allow_anonymous_contributors)
+    return None
+
+
+def get_app(short_name):
+    """Return a transient App built from the cached columns of the app, so
+    no ORM state is stored in the cache"""
+    columns = _get_app(short_name)
+    if columns is None:
+        return App()
+    # the info is changed by some views, and the columns are kept for the
+    # request
+    return App(**dict(columns, info=dict(columns['info'] or {})))
+
+
+@cache(timeout=STATS_FRONTPAGE_TIMEOUT, stale=STATS_FRONTPAGE_STALE,
+       key_prefix="front_page_featured_apps")
 def get_featured_front_page():
     """Return featured apps"""
     sql = text('''SELECT app.id, app.name, app.short_name, app.info FROM
@@ -63,7 +81,8 @@ def get_featured_front_page():
     return featured
 
 
-@cache(timeout=STATS_FRONTPAGE_TIMEOUT, key_prefix="front_page_top_apps")
+@cache(timeout=STATS_FRONTPAGE_TIMEOUT, stale=STATS_FRONTPAGE_STALE,
+       key_prefix="front_page_top_apps")
 def get_top(n=4):
     """Return top n=4 apps"""
     sql = text('''
@@ -93,6 +112,18 @@ def n_tasks(app_id):
     return n_tasks
 
 
+@memoize_many(n_tasks)
+def n_tasks_many(app_ids):
+    """Return a dict with the number of tasks of every app"""
+    sql = text('''SELECT app_id, COUNT(id) AS n_tasks FROM task
+                  WHERE app_id IN :app_ids GROUP BY app_id''')
+    results = db.engine.execute(sql, app_ids=tuple(app_ids))
+    n_tasks = dict.fromkeys(app_ids, 0)
+    for row in results:
+        n_tasks[row.app_id] = row.n_tasks
+    return n_tasks
+
+
 @memoize()
 def n_task_runs(app_id):
     sql = text('''SELECT COUNT(task_run.id) AS n_task_runs FROM task_run
@@ -104,19 +135,6 @@ def n_task_runs(app_id):
     return n_task_runs
 
 
-@memoize()
-def last_activity(app_id):
-    sql = text('''SELECT finish_time FROM task_run WHERE app_id=:app_id
-               ORDER BY finish_time DESC LIMIT 1''')
-    results = db.engine.execute(sql, app_id=app_id)
-    for row in results:
-        if row is not None:
-            print pretty_date(row[0])
-            return pretty_date(row[0])
-        else:
-            return None
-
-
 @memoize()
 def overall_progress(app_id):
     """Returns the percentage of submitted Tasks Runs done when a task is
@@ -140,6 +158,25 @@ def overall_progress(app_id):
     return (pct * 100)
 
 
+@memoize_many(overall_progress)
+def overall_progress_many(app_ids):
+    """Return a dict with the overall progress of every app"""
+    sql = text('''SELECT app_id, SUM(n_answers) AS n_expected_task_runs,
+               SUM(LEAST(n_task_runs, n_answers)) AS n_task_runs FROM
+               (SELECT task.app_id, n_answers,
+               count(task_run.task_id) AS n_task_runs
+               FROM task LEFT OUTER JOIN task_run ON task.id=task_run.task_id
+               WHERE task.app_id IN :app_ids GROUP BY task.id) AS tasks
+               GROUP BY app_id''')
+    results = db.engine.execute(sql, app_ids=tuple(app_ids))
+    progress = dict.fromkeys(app_ids, float(0))
+    for row in results:
+        if row.n_expected_task_runs:
+            pct = float(row.n_task_runs) / float(row.n_expected_task_runs)
+            progress[row.app_id] = pct * 100
+    return progress
+
+
 @memoize()
 def last_activity(app_id):
     sql = text('''SELECT finish_time FROM task_run WHERE app_id=:app_id
@@ -152,8 +189,21 @@ def last_activity(app_id):
             return None
 
 
+@memoize_many(last_activity)
+def last_activity_many(app_ids):
+    """Return a dict with the last activity of every app"""
+    sql = text('''SELECT app_id, MAX(finish_time) AS finish_time FROM task_run
+               WHERE app_id IN :app_ids GROUP BY app_id''')
+    results = db.engine.execute(sql, app_ids=tuple(app_ids))
+    activity = dict.fromkeys(app_ids)
+    for row in results:
+        activity[row.app_id] = pretty_date(row.finish_time)
+    return activity
+
+
 # This function does not change too much, so cache it for a longer time
-@cache(timeout=STATS_FRONTPAGE_TIMEOUT, key_prefix="number_featured_apps")
+@cache(timeout=STATS_FRONTPAGE_TIMEOUT, stale=STATS_FRONTPAGE_STALE,
+       key_prefix="number_featured_apps")
 def n_featured():
     """Return number of featured apps"""
     sql = text('''select count(*) from featured;''')
@@ -164,7 +214,7 @@ def n_featured():
 
 
 # This function does not change too much, so cache it for a longer time
-@memoize(timeout=STATS_FRONTPAGE_TIMEOUT)
+@memoize(timeout=STATS_FRONTPAGE_TIMEOUT, stale=STATS_FRONTPAGE_STALE)
 def get_featured(category, page=1, per_page=5):
     """Return a list of featured apps with a pagination"""
 
@@ -178,13 +228,15 @@ def get_featured(category, page=1, per_page=5):
                OFFSET(:offset) LIMIT(:limit);
                ''')
     offset = (page - 1) * per_page
-    results = db.engine.execute(sql, limit=per_page, offset=offset)
+    results = db.engine.execute(sql, limit=per_page, offset=offset).fetchall()
+    progress = overall_progress_many([row.id for row in results])
+    activity = last_activity_many([row.id for row in results])
     apps = []
     for row in results:
         app = dict(id=row.id, name=row.name, short_name=row.short_name,
                    created=row.created, description=row.description,
-                   overall_progress=overall_progress(row.id),
-                   last_activity=last_activity(row.id),
+                   overall_progress=progress[row.id],
+                   last_activity=activity[row.id],
                    owner=row.owner,
                    featured=row.id,
                    info=dict(json.loads(row.info)))
@@ -227,7 +279,9 @@ def get_published(category, page=1, per_page=5):
                LIMIT :limit;''')
 
     offset = (page - 1) * per_page
-    results = db.engine.execute(sql, limit=per_page, offset=offset)
+    results = db.engine.execute(sql, limit=per_page, offset=offset).fetchall()
+    progress = overall_progress_many([row.id for row in results])
+    activity = last_activity_many([row.id for row in results])
     apps = []
     for row in results:
         app = dict(id=row.id,
@@ -236,15 +290,16 @@ def get_published(category, page=1, per_page=5):
                    description=row.description,
                    owner=row.owner,
                    featured=row.featured,
-                   last_activity=last_activity(row.id),
-                   overall_progress=overall_progress(row.id),
+                   last_activity=activity[row.id],
+                   overall_progress=progress[row.id],
                    info=dict(json.loads(row.info)))
         apps.append(app)
     return apps, count
 
 
 # Cache it for longer times, as this is only shown to admin users
-@cache(timeout=STATS_FRONTPAGE_TIMEOUT, key_prefix="number_draft_apps")
+@cache(timeout=STATS_FRONTPAGE_TIMEOUT, stale=STATS_FRONTPAGE_STALE,
+       key_prefix="number_draft_apps")
 def n_draft():
     """Return number of draft applications"""
     sql = text('''
@@ -259,7 +314,7 @@ def n_draft():
     return count
 
 
-@memoize(timeout=STATS_FRONTPAGE_TIMEOUT)
+@memoize(timeout=STATS_FRONTPAGE_TIMEOUT, stale=STATS_FRONTPAGE_STALE)
 def get_draft(category, page=1, per_page=5):
     """Return list of draft applications"""
 
@@ -276,15 +331,17 @@ def get_draft(category, page=1, per_page=5):
                LIMIT :limit;''')
 
     offset = (page - 1) * per_page
-    results = db.engine.execute(sql, limit=per_page, offset=offset)
+    results = db.engine.execute(sql, limit=per_page, offset=offset).fetchall()
+    progress = overall_progress_many([row.id for row in results])
+    activity = last_activity_many([row.id for row in results])
     apps = []
     for row in results:
         app = dict(id=row.id, name=row.name, short_name=row.short_name,
                    created=row.created,
                    description=row.description,
                    owner=row.owner,
-                   last_activity=last_activity(row.id),
-                   overall_progress=overall_progress(row.id),
+                   last_activity=activity[row.id],
+                   overall_progress=progress[row.id],
                    info=dict(json.loads(row.info)))
         apps.append(app)
     return apps, count
@@ -338,7 +395,10 @@ def get(category, page=1, per_page=5):
                LIMIT :limit;''')
 
     offset = (page - 1) * per_page
-    results = db.engine.execute(sql, category=category, limit=per_page, offset=offset)
+    results = db.engine.execute(sql, category=category, limit=per_page,
+                                offset=offset).fetchall()
+    progress = overall_progress_many([row.id for row in results])
+    activity = last_activity_many([row.id for row in results])
     apps = []
     for row in results:
         app = dict(id=row.id,
@@ -347,8 +407,8 @@ def get(category, page=1, per_page=5):
                    description=row.description,
                    owner=row.owner,
                    featured=row.featured,
-                   last_activity=last_activity(row.id),
-                   overall_progress=overall_progress(row.id),
+                   last_activity=activity[row.id],
+                   overall_progress=progress[row.id],
                    info=dict(json.loads(row.info)))
         apps.append(app)
     return apps, count
@@ -371,7 +431,7 @@ def reset():
 
 def delete_app(short_name):
     """Reset app values in cache"""
-    delete_memoized(get_app, short_name)
+    delete_memoized(_get_app, short_name)
 
 
 def delete_n_tasks(app_id):
@@ -401,3 +461,78 @@ def clean(app_id):
     delete_memoized(n_task_runs, app_id)
     delete_memoized(last_activity, app_id)
     delete_memoized(overall_progress, app_id)
+
+
+def _pending(target):
+    """Return the changes to the cached counters of the app of target, kept
+    on its session until it is committed"""
+    session = object_session(target)
+    if session is None:
+        return dict(tasks=0, task_runs=0, finish_time=None, deleted=set())
+    if '_apps_pending' not in session.__dict__:
+        session._apps_pending = {}
+    return session._apps_pending.setdefault(
+        target.app_id, dict(tasks=0, task_runs=0, finish_time=None,
+                            deleted=set()))
+
+
+@event.listens_for(TaskRun, 'after_insert')
+def _task_run_added(mapper, conn, target):
+    """Keep the cached counters of the app fresh with a new answer"""
+    changes = _pending(target)
+    changes['task_runs'] += 1
+    changes['finish_time'] = max(changes['finish_time'], target.finish_time)
+
+
+@event.listens_for(TaskRun, 'after_delete')
+def _task_run_deleted(mapper, conn, target):
+    """Keep the cached counters of the app fresh without the answer"""
+    changes = _pending(target)
+    changes['task_runs'] -= 1
+    changes['deleted'].add('task_run')
+
+
+@event.listens_for(Task, 'after_insert')
+def _task_added(mapper, conn, target):
+    """Keep the cached counters of the app fresh with a new task"""
+    _pending(target)['tasks'] += 1
+
+
+@event.listens_for(Task, 'after_delete')
+def _task_deleted(mapper, conn, target):
+    """The answers of a task are removed with it"""
+    changes = _pending(target)
+    changes['tasks'] -= 1
+    changes['deleted'].add('task')
+
+
+def _update_app(app_id, changes):
+    """Apply the changes of a transaction to the cached counters of an app,
+    with one update or delete per counter"""
+    if changes['tasks']:
+        update_memoized(n_tasks, app_id,
+                        lambda n: max(n + changes['tasks'], 0))
+    if 'task' in changes['deleted']:
+        delete_memoized(n_task_runs, app_id)
+        delete_memoized(last_activity, app_id)
+    else:
+        if changes['task_runs']:
+            update_memoized(n_task_runs, app_id,
+                            lambda n: max(n + changes['task_runs'], 0))
+        if 'task_run' in changes['deleted']:
+            delete_memoized(last_activity, app_id)
+        elif changes['finish_time']:
+            update_memoized(last_activity, app_id,
+                            lambda value: pretty_date(changes['finish_time']))
+    delete_memoized(overall_progress, app_id)
+
+
+@event.listens_for(Session, 'after_commit')
+def _committed(session):
+    for app_id, changes in session.__dict__.pop('_apps_pending', {}).items():
+        _update_app(app_id, changes)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _rolled_back(session):
+    session.__dict__.pop('_apps_pending', None)
@@ -24,8 +24,9 @@ import pybossa.model as model
 
 @cache(key_prefix="categories_all", timeout=ONE_DAY)
 def get_all():
-    """Return all categories"""
-    return db.session.query(model.Category).all()
+    """Return all categories, as dicts"""
+    categories = db.session.query(model.Category).all()
+    return [category.dictize() for category in categories]
 
 
 @cache(key_prefix="categories_used", timeout=ONE_DAY)
@@ -0,0 +1,94 @@
+# -*- coding: utf8 -*-
+# This file is part of PyBossa.
+#
+# Copyright (C) 2013 SF Isle of Man Limited
+#
+# PyBossa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyBossa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Metrics of the cached functions.
+
+The decorators of pybossa.cache record for every cached function (by its
+name, or the key_prefix of the cache decorator):
+
+    * hits: values read fresh from the cache
+    * stale: stale values served while another worker refreshes them
+    * misses: values computed by the function
+    * bypassed: values computed without the cache, as Redis was unavailable
+    * compute_ms: time spent computing the values
+    * reads, read_ms: Redis reads of the values and their round trip time
+    * writes, bytes: values stored and their encoded size
+
+The counts are kept within every process and added every FLUSH_INTERVAL
+seconds to one Redis hash per function (see pybossa.counters), so they are
+aggregated across all the web workers without an extra round trip per
+cached call:
+
+    pybossa_cache_stats:<name>
+
+This module exports:
+    * record: for counting the events of a cached function
+    * flush: for adding the counts of this process to Redis
+    * get: for getting the metrics of every cached function
+    * reset: for removing all the metrics
+
+"""
+from pybossa.core import app
+from pybossa.counters import Counters
+
+KEYPREFIX = 'pybossa_cache_stats'
+# Seconds the counts are kept within the process before adding them to Redis
+FLUSH_INTERVAL = 10
+
+counters = Counters(KEYPREFIX, FLUSH_INTERVAL)
+
+
+def record(name, **counts):
+    """Add counts (e.g. hits=1, read_ms=0.3) to the metrics of a function"""
+    if app.config.get('CACHE_STATS', True):
+        counters.record(name, **counts)
+
+
+def flush():
+    """Add the counts of this process to Redis"""
+    counters.flush()
+
+
+def get():
+    """Return the metrics of every cached function, the most expensive
+    first. None is returned while Redis is unavailable"""
+    hashes = counters.get()
+    if hashes is None:
+        return None
+    stats = []
+    for name, h in hashes:
+        s = dict(name=name)
+        for field in ('hits', 'stale', 'misses', 'bypassed', 'reads',
+                      'writes', 'bytes'):
+            s[field] = int(h.get(field, 0))
+        for field in ('compute_ms', 'read_ms'):
+            s[field] = float(h.get(field, 0))
+        s['calls'] = s['hits'] + s['stale'] + s['misses']
+        s['hit_ratio'] = (float(s['hits'] + s['stale']) / s['calls']
+                          if s['calls'] else 0)
+        s['avg_compute_ms'] = (s['compute_ms'] / s['misses']
+                               if s['misses'] else 0)
+        s['avg_read_ms'] = s['read_ms'] / s['reads'] if s['reads'] else 0
+        s['avg_bytes'] = s['bytes'] / s['writes'] if s['writes'] else 0
+        stats.append(s)
+    return sorted(stats, key=lambda s: s['compute_ms'], reverse=True)
+
+
+def reset():
+    """Remove all the metrics. Returns False if Redis is unavailable"""
+    return counters.reset()
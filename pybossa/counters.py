@@ -0,0 +1,116 @@
+# -*- coding: utf8 -*-
+# This file is part of PyBossa.
+#
+# Copyright (C) 2013 SF Isle of Man Limited
+#
+# PyBossa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyBossa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Counters buffered within the process and aggregated in Redis.
+
+The counts of every name are kept within the process, and added every
+flush interval to one Redis hash per name, so they are aggregated across
+all the web workers without a round trip per count:
+
+    <keyprefix>:<name>: {<field>: <count>}
+    <keyprefix>: set of the names
+
+The Redis calls go through the circuit breaker (see pybossa.breaker): the
+counts are dropped, and no counters are read, while Redis is unavailable.
+
+This module exports:
+    * Counters class: for buffering the counters of a key prefix
+
+"""
+import time
+import threading
+
+from pybossa.core import app, redis_master
+from pybossa.breaker import redis_breaker, Unavailable
+
+
+class Counters(object):
+
+    """Counters of a key prefix, flushed to Redis every interval seconds"""
+
+    def __init__(self, keyprefix, interval=10):
+        self.keyprefix = keyprefix
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._flushed = time.time()
+
+    def key(self, name):
+        return '%s:%s' % (self.keyprefix, name)
+
+    def record(self, name, **counts):
+        """Add counts (e.g. hits=1, ms=0.3) to the counters of name"""
+        with self._lock:
+            fields = self._pending.setdefault(name, {})
+            for field, n in counts.items():
+                fields[field] = fields.get(field, 0) + n
+            if time.time() - self._flushed < self.interval:
+                return
+        self.flush()
+
+    def flush(self):
+        """Add the counts of this process to Redis"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._flushed = time.time()
+        if not pending:
+            return
+        try:
+            p = redis_master.pipeline(transaction=False)
+            for name, fields in pending.items():
+                for field, n in fields.items():
+                    if isinstance(n, float):
+                        p.hincrbyfloat(self.key(name), field, n)
+                    else:
+                        p.hincrby(self.key(name), field, n)
+                p.sadd(self.keyprefix, name)
+            redis_breaker.call(p.execute)
+        except Exception as e:
+            # counters must never break the code they count
+            app.logger.warning('%s counters not saved: %s' %
+                               (self.keyprefix, e))
+
+    def get(self):
+        """Return the (name, counters) of every name, sorted by name. None
+        is returned while Redis is unavailable"""
+        try:
+            return redis_breaker.call(self._get)
+        except Unavailable:
+            return None
+
+    def _get(self):
+        names = sorted(redis_master.smembers(self.keyprefix))
+        p = redis_master.pipeline(transaction=False)
+        for name in names:
+            p.hgetall(self.key(name))
+        return [(name, h) for name, h in zip(names, p.execute()) if h]
+
+    def reset(self):
+        """Remove all the counters. Returns False if Redis is unavailable"""
+        with self._lock:
+            self._pending.clear()
+        try:
+            redis_breaker.call(self._reset)
+            return True
+        except Unavailable:
+            return False
+
+    def _reset(self):
+        names = redis_master.smembers(self.keyprefix)
+        redis_master.delete(self.keyprefix,
+                            *[self.key(name) for name in names])
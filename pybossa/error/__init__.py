@@ -38,7 +38,8 @@ class ErrorStatus(object):
 
     """
 
-    error_status = {"Forbidden": 403,
+    error_status = {"BadRequest": 400,
+                    "Forbidden": 403,
                     "NotFound": 404,
                     "Unauthorized": 401,
                     "TypeError": 415,
@@ -0,0 +1,162 @@
+# -*- coding: utf8 -*-
+# This file is part of PyBossa.
+#
+# Copyright (C) 2013 SF Isle of Man Limited
+#
+# PyBossa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyBossa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Locations of the IP addresses of the anonymous users.
+
+The GeoLiteCity database is memory mapped once per process, and the
+location of every IP address is kept in one Redis hash per day, so the geo
+stats only look up the addresses that they have not seen that day:
+
+    pybossa_geo_locs:<YYYY-MM-DD>: {<ip>: <JSON location>}
+
+Every hash expires two days after its last write, so the locations of the
+addresses that are not seen anymore are dropped.
+
+When Redis is unavailable the addresses are looked up in the database.
+
+This module exports:
+    * GEOLITE: the path of the GeoLiteCity database
+    * locate_many: for getting the locations of several IP addresses
+    * locate: for getting the location of an IP address
+    * bins: for counting the locations within the cells of a grid
+    * reset: for removing the locations kept in Redis
+
+"""
+import json
+import math
+import datetime
+import threading
+import pygeoip
+
+from pybossa.core import app, redis_master, redis_slave
+from pybossa.breaker import redis_breaker, Unavailable
+
+GEOLITE = app.root_path + '/../dat/GeoLiteCity.dat'
+KEYPREFIX = 'pybossa_geo_locs'
+# Seconds the hash of a day is kept
+TIMEOUT = 2 * 24 * 60 * 60
+# IP addresses read from (and written to) Redis in one call
+CHUNK = 1000
+
+_lock = threading.Lock()
+_reader = []
+
+
+def _key(day=None):
+    day = day or datetime.date.today()
+    return '%s:%s' % (KEYPREFIX, day.isoformat())
+
+
+def _get_reader():
+    """Return the GeoIP reader of this process"""
+    if not _reader:
+        with _lock:
+            if not _reader:
+                _reader.append(pygeoip.GeoIP(GEOLITE, pygeoip.MMAP_CACHE))
+    return _reader[0]
+
+
+def _lookup(ip):
+    try:
+        loc = _get_reader().record_by_addr(ip)
+    except Exception as e:
+        # e.g. an IPv6 address or a malformed one
+        app.logger.warning('GeoIP lookup of %s failed: %s' % (ip, e))
+        loc = None
+    return loc or {}
+
+
+def locate_many(ips):
+    """Return a dict with the location of every IP address. Unknown ones are
+    at latitude and longitude 0"""
+    ips = list(set(ips))
+    locs = {}
+    for i in range(0, len(ips), CHUNK):
+        locs.update(_locate_chunk(ips[i:i + CHUNK]))
+    for loc in locs.values():
+        if len(loc.keys()) == 0:
+            loc['latitude'] = 0
+            loc['longitude'] = 0
+    return locs
+
+
+def _locate_chunk(ips):
+    key = _key()
+    try:
+        cached = redis_breaker.call(redis_slave.hmget, key, ips)
+    except Unavailable:
+        cached = [None] * len(ips)
+    locs = {}
+    new = {}
+    for ip, raw in zip(ips, cached):
+        if raw is not None:
+            locs[ip] = json.loads(raw)
+        else:
+            locs[ip] = _lookup(ip)
+            new[ip] = json.dumps(locs[ip])
+    if new:
+        try:
+            redis_breaker.call(_store, key, new)
+        except Unavailable:
+            pass
+    return locs
+
+
+def _store(key, locs):
+    p = redis_master.pipeline(transaction=False)
+    p.hmset(key, locs)
+    # the hash of a day is not written after that day, so it expires then
+    p.expire(key, TIMEOUT)
+    p.execute()
+
+
+def locate(ip):
+    """Return the location of an IP address"""
+    return locate_many([ip])[ip]
+
+
+def bins(locs, size=1):
+    """Return the number of locations within every cell of size degrees of a
+    latitude and longitude grid, at the mean position of its locations, the
+    most populated cells first"""
+    cells = {}
+    for loc in locs:
+        lat = float(loc['latitude'])
+        lng = float(loc['longitude'])
+        key = (int(math.floor(lat / size)), int(math.floor(lng / size)))
+        cell = cells.get(key)
+        if cell is None:
+            cell = cells[key] = [0, 0.0, 0.0]
+        cell[0] += 1
+        cell[1] += lat
+        cell[2] += lng
+    out = [dict(lat=round(lat / n, 4), lng=round(lng / n, 4), count=n)
+           for n, lat, lng in cells.values()]
+    return sorted(out, key=lambda b: b['count'], reverse=True)
+
+
+def reset():
+    """Remove the locations kept in Redis, e.g. after updating the
+    GeoLiteCity database"""
+    today = datetime.date.today()
+    keys = [_key(today - datetime.timedelta(days=i)) for i in range(3)]
+    try:
+        redis_breaker.call(redis_master.delete, *keys)
+    except Unavailable:
+        app.logger.warning('GeoIP locations not removed: Redis is '
+                           'unavailable')
@@ -0,0 +1,140 @@
+# -*- coding: utf8 -*-
+# This file is part of PyBossa.
+#
+# Copyright (C) 2013 SF Isle of Man Limited
+#
+# PyBossa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyBossa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Task leases for the scheduler (GitHub #53).
+
+When an app has a time limit (App.time_limit, or the LEASE_TIMEOUT setting
+for all the apps) every task sent to a volunteer is reserved for him during
+that number of seconds. Outstanding leases count as answers when the
+scheduler picks candidate tasks, so concurrent volunteers don't get a task
+that already has enough answers and leases to reach its n_answers.
+
+Leases are stored in one Redis sorted set per task, with the volunteer as
+member and the time he got the lease as score. Expired leases are reclaimed
+lazily, when the leases of the task are read, and a lease is released as
+soon as the volunteer submits his answer.
+
+The Redis calls go through the circuit breaker (see pybossa.breaker), and
+they fail open: while Redis is unavailable no lease is taken or counted, so
+volunteers can still get tasks and submit their answers.
+
+This module exports:
+    * get_timeout: for getting the lease time of an app
+    * count: for counting the outstanding leases of a list of tasks
+    * acquire: for leasing a task to a volunteer
+    * release: for releasing the lease of a volunteer
+
+"""
+import time
+from sqlalchemy import event
+
+from pybossa.core import app, db, redis_master
+from pybossa.breaker import redis_breaker, Unavailable
+import pybossa.model as model
+
+KEYPREFIX = 'pybossa_sched:lease'
+
+
+def _key(task_id):
+    return '%s:task:%s' % (KEYPREFIX, task_id)
+
+
+def _holder(user_id=None, user_ip=None):
+    if user_id:
+        return 'user:%s' % user_id
+    return 'ip:%s' % user_ip
+
+
+def get_timeout(app_id):
+    """Return the lease time in seconds for an app, 0 if disabled"""
+    _app = db.session.query(model.App).get(app_id)
+    if _app is not None and _app.time_limit:
+        return _app.time_limit
+    return app.config.get('LEASE_TIMEOUT', 0)
+
+
+def count(task_ids, timeout, user_id=None, user_ip=None):
+    """Return a dict with the number of outstanding leases of every task,
+    not counting the lease of the given volunteer"""
+    try:
+        return redis_breaker.call(_count, task_ids, timeout, user_id,
+                                  user_ip)
+    except Unavailable:
+        return dict((task_id, 0) for task_id in task_ids)
+
+
+def _count(task_ids, timeout, user_id, user_ip):
+    holder = _holder(user_id, user_ip)
+    expired = time.time() - timeout
+    p = redis_master.pipeline(transaction=False)
+    for task_id in task_ids:
+        p.zremrangebyscore(_key(task_id), '-inf', expired)
+        p.zcard(_key(task_id))
+        p.zscore(_key(task_id), holder)
+    results = p.execute()
+    leases = {}
+    for i, task_id in enumerate(task_ids):
+        n, own = results[3 * i + 1], results[3 * i + 2]
+        leases[task_id] = n - (1 if own is not None else 0)
+    return leases
+
+
+def acquire(task, timeout, user_id=None, user_ip=None):
+    """Lease a task to a volunteer. Returns False if the task already has
+    enough answers and older leases"""
+    try:
+        return redis_breaker.call(_acquire, task, timeout, user_id, user_ip)
+    except Unavailable:
+        return True
+
+
+def _acquire(task, timeout, user_id, user_ip):
+    key = _key(task.id)
+    holder = _holder(user_id, user_ip)
+    now = time.time()
+    since = redis_master.zscore(key, holder)
+    if since is not None and since > now - timeout:
+        return True
+    p = redis_master.pipeline()
+    p.zremrangebyscore(key, '-inf', now - timeout)
+    p.zadd(key, **{holder: now})
+    p.expire(key, int(timeout) + 1)
+    p.zrank(key, holder)
+    rank = p.execute()[-1]
+    # Leases are ranked by age, so when two volunteers race for the last
+    # answer of a task the oldest lease wins
+    if (task.n_task_runs or 0) + rank >= (task.n_answers or 30):
+        redis_master.zrem(key, holder)
+        return False
+    return True
+
+
+def release(task_id, user_id=None, user_ip=None):
+    """Release the lease of a volunteer"""
+    try:
+        redis_breaker.call(redis_master.zrem, _key(task_id),
+                           _holder(user_id, user_ip))
+    except Unavailable:
+        # the lease just expires
+        pass
+
+
+@event.listens_for(model.TaskRun, 'after_insert')
+def _task_run_added(mapper, conn, target):
+    """The answer of a volunteer releases his lease"""
+    release(target.task_id, target.user_id, target.user_ip)
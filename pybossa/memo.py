@@ -0,0 +1,161 @@
+# -*- coding: utf8 -*-
+# This file is part of PyBossa.
+#
+# Copyright (C) 2013 SF Isle of Man Limited
+#
+# PyBossa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyBossa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Request scoped memoization.
+
+Values are kept in flask.g until the end of the request, so a view calling
+the same cached function (or helper) several times only pays for it once.
+The cache decorators of pybossa.cache look for their values here before
+going to Redis, and they remove them here when they are deleted. Outside a
+request nothing is memoized.
+
+The cached values are plain values. Immutable ones (numbers, strings, None
+and tuples of them) are kept as they are, and the others are kept pickled
+and unpickled on every get, so a view changing a value does not change it
+for the next callers. The values of the memoized functions are shared by all the callers: they should only
+return immutable values or instances of the session of the request (which
+are shared through its identity map anyway).
+
+Every request also counts its memo hits, cache calls (Redis reads) and DB
+queries. They are sent in the X-PyBossa-Calls header of the response when
+the REQUEST_STATS setting is enabled.
+
+This module exports:
+    * get, set, delete and delete_prefix: for the values of the request
+    * memoized: decorator for memoizing a function within a request
+    * count: for counting a call of the request
+    * counts: for getting the counts of the request
+
+"""
+from functools import wraps
+from flask import g, has_request_context
+from sqlalchemy import event
+
+from pybossa.core import db
+try:
+    import cPickle as pickle
+except ImportError:  # pragma: no cover
+    import pickle
+
+MISSING = object()
+_IMMUTABLE = (int, long, float, bool, str, unicode, type(None))
+
+
+class _Pickled(object):
+
+    """A mutable value of the memo, pickled"""
+
+    __slots__ = ('raw',)
+
+    def __init__(self, value):
+        self.raw = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+
+def _immutable(value):
+    if isinstance(value, _IMMUTABLE):
+        return True
+    if isinstance(value, (tuple, frozenset)):
+        return all(_immutable(v) for v in value)
+    return False
+
+
+def _memo():
+    if not has_request_context():
+        return None
+    memo = getattr(g, '_memo', None)
+    if memo is None:
+        memo = g._memo = {}
+    return memo
+
+
+def _get(key):
+    memo = _memo()
+    if memo is None or key not in memo:
+        return MISSING
+    count('memo_hits')
+    return memo[key]
+
+
+def get(key):
+    """Return (a copy of) the value of key in this request, or MISSING"""
+    value = _get(key)
+    if isinstance(value, _Pickled):
+        return pickle.loads(value.raw)
+    return value
+
+
+def _set(key, value):
+    memo = _memo()
+    if memo is not None:
+        memo[key] = value
+
+
+def set(key, value):
+    """Keep (a copy of) value as the value of key in this request"""
+    if has_request_context():
+        _set(key, value if _immutable(value) else _Pickled(value))
+
+
+def delete(key):
+    memo = _memo()
+    if memo is not None:
+        memo.pop(key, None)
+
+
+def delete_prefix(prefix):
+    memo = _memo()
+    if memo is not None:
+        for key in [k for k in memo if k.startswith(prefix)]:
+            del memo[key]
+
+
+def memoized(f):
+    """Decorator for memoizing a function within a request. The value is not
+    copied: f should return immutable values or instances of the session"""
+    @wraps(f)
+    def wrapper(*args):
+        key = '%s:%s' % (f.__module__, f.__name__)
+        for i in args:
+            key += ':%s' % i
+        value = _get(key)
+        if value is MISSING:
+            value = f(*args)
+            _set(key, value)
+        return value
+    return wrapper
+
+
+def count(kind, n=1):
+    """Count n calls of a kind (memo_hits, cache_calls or queries)"""
+    if has_request_context():
+        counts = getattr(g, '_memo_counts', None)
+        if counts is None:
+            counts = g._memo_counts = dict(memo_hits=0, cache_calls=0,
+                                           queries=0)
+        counts[kind] += n
+
+
+def counts():
+    """Return the counts of the current request"""
+    return getattr(g, '_memo_counts', None) or dict(memo_hits=0,
+                                                    cache_calls=0, queries=0)
+
+
+@event.listens_for(db.engine, 'after_cursor_execute')
+def _count_query(conn, cursor, statement, parameters, context, executemany):
+    count('queries')
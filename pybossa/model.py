@@ -28,7 +28,7 @@ from werkzeug import generate_password_hash, check_password_hash
 import flask.ext.login
 from sqlalchemy import BigInteger, Integer, Boolean, Unicode,\
         Float, UnicodeText, Text, String
-from sqlalchemy.schema import Table, MetaData, Column, ForeignKey
+from sqlalchemy.schema import Table, MetaData, Column, ForeignKey, Index, DDL
 from sqlalchemy.orm import relationship, backref, class_mapper
 from sqlalchemy.types import MutableType, TypeDecorator
 from sqlalchemy import event, text
@@ -325,6 +325,11 @@ class Task(db.Model, DomainObject):
     info = Column(JSONType, default=dict)
     #: Number of answers or TaskRuns per task
     n_answers = Column(Integer, default=30)
+    #: Number of TaskRuns submitted for this task. It is maintained by the
+    #: task_run_counter trigger, so it should never be written by hand.
+    n_task_runs = Column(Integer, default=0)
+    #: Number of times this task has been reported as spam
+    is_it_spam = Column(Integer, default=0)
 
     ## Relationships
     #: `TaskRun`s for this task`
@@ -337,7 +342,7 @@ class Task(db.Model, DomainObject):
         if (self.info.get('n_answers')):
             self.n_answers = int(self.info['n_answers'])
         if self.n_answers != 0 and self.n_answers != None:
-            return float(len(self.task_runs)) / self.n_answers
+            return float(self.n_task_runs or 0) / self.n_answers
         else:
             return float(0)
 
@@ -365,6 +370,9 @@ class TaskRun(db.Model, DomainObject):
     timeout = Column(Integer)
     #: See same attribute in Task
     calibration = Column(Integer)
+    #: Stage of a multi-stage app this task run belongs to. It is copied
+    #: from info['son_app_id'] by sync_son_app_id
+    son_app_id = Column(Integer)
     info = Column(JSONType, default=dict)
     '''General writable field that should be used by clients to record results\
     of a TaskRun. Usually a template for this will be provided by Task
@@ -375,6 +383,31 @@ class TaskRun(db.Model, DomainObject):
     '''
 
 
+class TaskRunStats(db.Model, DomainObject):
+    '''Number of task runs of an App per day and hour of their finish time.
+    The rows are folded from task_run by pybossa.stats.rollup.
+    '''
+    __tablename__ = 'task_run_stats'
+    app_id = Column(Integer, primary_key=True, autoincrement=False)
+    #: day of the finish time (YYYY-MM-DD)
+    day = Column(Text, primary_key=True)
+    #: hour of the finish time (00-23)
+    hour = Column(Text, primary_key=True)
+    #: task runs of authenticated users
+    n_auth = Column(Integer, nullable=False, default=0)
+    #: task runs of anonymous users
+    n_anon = Column(Integer, nullable=False, default=0)
+
+
+class StatsWatermark(db.Model, DomainObject):
+    '''Last row of a table folded into the stats rollups.'''
+    __tablename__ = 'stats_watermark'
+    #: name of the table
+    name = Column(Text, primary_key=True)
+    #: id of the last row folded
+    last_id = Column(Integer, nullable=False, default=0)
+
+
 class User(db.Model, DomainObject, flask.ext.login.UserMixin):
     __tablename__ = 'user'
     id = Column(Integer, primary_key=True)
@@ -435,6 +468,94 @@ class User(db.Model, DomainObject, flask.ext.login.UserMixin):
     apps = relationship('App', backref='owner')
 
 
+# Indexes used by the scheduler: candidate tasks are picked by priority
+# within an app, and answered tasks are excluded by (task_id, user).
+Index('task_run_task_id_user_id_idx', TaskRun.task_id, TaskRun.user_id)
+Index('task_run_task_id_user_ip_idx', TaskRun.task_id, TaskRun.user_ip)
+Index('task_run_son_app_id_user_id_idx', TaskRun.app_id, TaskRun.son_app_id,
+      TaskRun.user_id)
+Index('task_run_son_app_id_user_ip_idx', TaskRun.app_id, TaskRun.son_app_id,
+      TaskRun.user_ip)
+
+task_sched_idx = DDL('''
+CREATE INDEX task_app_id_priority_idx ON task
+(app_id, priority_0 DESC, id ASC) WHERE state != 'completed'
+''')
+event.listen(Task.__table__, 'after_create',
+             task_sched_idx.execute_if(dialect='postgresql'))
+
+task_random_idx = DDL('''
+CREATE INDEX task_app_id_id_idx ON task (app_id, id)
+WHERE state != 'completed'
+''')
+event.listen(Task.__table__, 'after_create',
+             task_random_idx.execute_if(dialect='postgresql'))
+
+# Keep Task.n_task_runs in sync with the task_run table within the same
+# transaction that inserts or deletes the TaskRun.
+task_run_counter = DDL('''
+CREATE OR REPLACE FUNCTION task_run_counter() RETURNS trigger AS $$
+BEGIN
+    IF (TG_OP = 'INSERT' OR TG_OP = 'UPDATE') THEN
+        UPDATE task SET n_task_runs = COALESCE(n_task_runs, 0) + 1
+        WHERE id = NEW.task_id;
+    END IF;
+    IF (TG_OP = 'DELETE' OR TG_OP = 'UPDATE') THEN
+        UPDATE task SET n_task_runs = GREATEST(COALESCE(n_task_runs, 0) - 1, 0)
+        WHERE id = OLD.task_id;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+CREATE TRIGGER task_run_counter
+AFTER INSERT OR DELETE OR UPDATE OF task_id ON task_run
+FOR EACH ROW EXECUTE PROCEDURE task_run_counter();
+''')
+event.listen(TaskRun.__table__, 'after_create',
+             task_run_counter.execute_if(dialect='postgresql'))
+
+# Mark a task as completed as soon as it gets n_answers task runs (or its
+# n_answers is lowered), and reopen it if it goes back below that value.
+task_state = DDL('''
+CREATE OR REPLACE FUNCTION task_state() RETURNS trigger AS $$
+BEGIN
+    IF (COALESCE(NEW.n_task_runs, 0) >= COALESCE(NEW.n_answers, 30)) THEN
+        NEW.state := 'completed';
+    ELSIF (NEW.state = 'completed') THEN
+        NEW.state := 'ongoing';
+    END IF;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+CREATE TRIGGER task_state
+BEFORE INSERT OR UPDATE OF n_answers, n_task_runs, state ON task
+FOR EACH ROW EXECUTE PROCEDURE task_state();
+''')
+event.listen(Task.__table__, 'after_create',
+             task_state.execute_if(dialect='postgresql'))
+
+
+@event.listens_for(Task, 'before_insert')
+@event.listens_for(Task, 'before_update')
+def sync_n_answers(mapper, conn, target):
+    # DEPRECATED: t.info.n_answers will be removed, but while it is used it
+    # overrides the n_answers column, so the task_state trigger sees it
+    if isinstance(target.info, dict) and target.info.get('n_answers'):
+        target.n_answers = int(target.info['n_answers'])
+
+
+@event.listens_for(TaskRun, 'before_insert')
+@event.listens_for(TaskRun, 'before_update')
+def sync_son_app_id(mapper, conn, target):
+    # Multi-stage apps send the stage within the answer, so it is copied to
+    # an indexed column for the filter_by_users scheduler
+    if isinstance(target.info, dict) and target.info.get('son_app_id') is not None:
+        try:
+            target.son_app_id = int(target.info['son_app_id'])
+        except (TypeError, ValueError):
+            target.son_app_id = None
+
+
 @event.listens_for(User, 'before_insert')
 def make_admin(mapper, conn, target):
     users = conn.scalar('select count(*) from "user"')
@@ -29,6 +29,7 @@ from functools import update_wrapper, wraps
 from flask import request, g
 from werkzeug.exceptions import TooManyRequests
 from pybossa.core import redis_master
+from pybossa.breaker import redis_breaker, Unavailable
 from pybossa.error import ErrorStatus
 
 error = ErrorStatus()
@@ -40,7 +41,8 @@ class RateLimit(object):
     Limit the number of requests.
 
     It uses a Redis pipe from the master node (configured via Sentinel) to
-    limit the number of requests.
+    limit the number of requests. If Redis is unavailable the requests are
+    not limited (see pybossa.breaker).
 
     """
 
@@ -57,7 +59,11 @@ class RateLimit(object):
         p.incr(self.key)
         p.expireat(self.key, self.reset + self.expiration_window)
 
-        self.current = min(p.execute()[0], limit)
+        try:
+            self.current = min(redis_breaker.call(p.execute)[0], limit)
+        except Unavailable:
+            # fail open, the API must keep working without Redis
+            self.current = 0
 
     remaining = property(lambda x: x.limit - x.current)
     over_limit = property(lambda x: x.current >= x.limit)
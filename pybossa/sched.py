@@ -19,50 +19,81 @@
 #import json
 #from flask import Blueprint, request, url_for, flash, redirect, abort
 #from flask import abort, request, make_response, current_app
+import json
 from sqlalchemy.sql import text
 import pybossa.model as model
 from pybossa.core import db
+from pybossa import taskqueue
+from pybossa import lease
+from pybossa import answered
+from pybossa import schedstats
 import random
 
 
+# Scheduler strategies by name, see register
+schedulers = {}
+
+
+def register(name, *aliases):
+    """Register a function as the scheduler strategy name (and aliases).
+
+    Strategies share the signature (app_id, user_id=None, user_ip=None,
+    n_answers=30, offset=0, limit=1, son_app_id=0) and return a list with up
+    to limit tasks.
+    """
+    def decorator(f):
+        for n in (name,) + aliases:
+            schedulers[n] = f
+        return f
+    return decorator
+
+
 def new_task(app_id, user_id=None, user_ip=None, offset=0):
     '''Get a new task by calling the appropriate scheduler function.
     '''
-    app = db.session.query(model.App).get(app_id)
-    if not app.allow_anonymous_contributors and user_id is None:
-        error = model.Task(info=dict(error="This application does not allow anonymous contributors"))
-        return error
-    else:
-        sched_map = {
-            'default': get_depth_first_task,
-            'breadth_first': get_breadth_first_task,
-            'depth_first': get_depth_first_task,
-            'random': get_random_task,
-            'incremental': get_incremental_task,
-			'filter_by_users': get_filtered_by_user_task}
-        sched = sched_map.get(app.info.get('sched'), sched_map['default'])
-        return sched(app_id, user_id, user_ip, offset=offset)
+    return _first(new_tasks(app_id, user_id, user_ip, offset))
+
 
 def new_task2(app_id, user_id=None, user_ip=None, offset=0, son_app_id=0):
-    '''Get a new task by calling the appropriate scheduler function.
+    '''Get a new task for the son_app_id stage of a multi-stage app.
+    '''
+    return _first(new_tasks(app_id, user_id, user_ip, offset,
+                            son_app_id=son_app_id))
+
+
+def new_tasks(app_id, user_id=None, user_ip=None, offset=0, limit=1, son_app_id=0):
+    '''Get up to limit different new tasks in a single scheduler pass.
     '''
     app = db.session.query(model.App).get(app_id)
     if not app.allow_anonymous_contributors and user_id is None:
         error = model.Task(info=dict(error="This application does not allow anonymous contributors"))
-        return error
+        return [error]
     else:
-        sched_map = {
-            'default': get_depth_first_task,
-            'breadth_first': get_breadth_first_task,
-            'depth_first': get_depth_first_task,
-            'random': get_random_task,
-            'incremental': get_incremental_task,
-			'filter_by_users': get_filtered_by_user_task}
-        sched = sched_map.get(app.info.get('sched'), sched_map['default'])
-        if app.info.get('sched') == 'filter_by_users':
-            return sched(app_id, user_id, user_ip, offset=offset, son_app_id=son_app_id)
-        else:
-            return sched(app_id, user_id, user_ip, offset=offset)
+        name = app.info.get('sched')
+        if name not in schedulers:
+            name = 'default'
+        with schedstats.timed(name, app_id):
+            return schedulers[name](app_id, user_id, user_ip, offset=offset,
+                                    limit=limit, son_app_id=son_app_id)
+
+
+def _first(tasks):
+    """Return the first task of a list, or None if it is empty"""
+    if tasks:
+        return tasks[0]
+    else:
+        return None
+
+
+def _load_tasks(task_ids):
+    """Load the given tasks with one query, keeping the order of task_ids"""
+    if not task_ids:
+        return []
+    tasks = db.session.query(model.Task)\
+              .filter(model.Task.id.in_(task_ids)).all()
+    tasks = dict((t.id, t) for t in tasks)
+    return [tasks[i] for i in task_ids if i in tasks]
+
 
 def get_breadth_first_task(app_id, user_id=None, user_ip=None, n_answers=30, offset=0):
     """Gets a new task which have the least number of task runs (excluding the
@@ -78,203 +109,296 @@ def get_breadth_first_task(app_id, user_id=None, user_ip=None, n_answers=30, off
     would be costly as we'd need to find all tasks the user has done and
     exclude those task ids explicitly.
     """
-    # Uncomment the next three lines to profile the sched function
-    #import timeit
-    #T = timeit.Timer(lambda: get_candidate_tasks(app_id, user_id,
-    #                  user_ip, n_answers))
-    #print "First algorithm: %s" % T.timeit(number=1)
+    return _first(get_breadth_first_tasks(app_id, user_id, user_ip, n_answers,
+                                          offset=offset))
+
 
+@register('breadth_first')
+def get_breadth_first_tasks(app_id, user_id=None, user_ip=None, n_answers=30, offset=0, limit=1, son_app_id=0):
+    """Gets up to limit tasks with the least number of task runs. See
+    get_breadth_first_task"""
     sql = text('''
 SELECT task.id, count(task_run.task_id) AS taskcount from task
 LEFT JOIN task_run ON (task.id = task_run.task_id)
 WHERE task.app_id = :app_id AND
 (task_run.user_id IS NULL OR task_run.user_id != :user_id OR task_run.id IS NULL)
 GROUP BY task.id
-ORDER BY taskcount ASC limit 10 ;
+ORDER BY taskcount ASC limit :limit ;
 ''')
     # results will be list of (taskid, count)
-    tasks = db.engine.execute(sql, app_id=app_id, user_id=user_id)
+    tasks = db.engine.execute(sql, app_id=app_id, user_id=user_id,
+                              limit=max(10, offset + limit))
     # ignore n_answers for the present - we will just keep going once we've
     # done as many as we need
     # tasks = [ x[0] for x in tasks if x[1] < n_answers ]
     tasks = [x[0] for x in tasks]
-    print len(tasks)
-    if tasks:
-        if (offset == 0):
-            return db.session.query(model.Task).get(tasks[0])
-        else:
-            if (offset < len(tasks)):
-                return db.session.query(model.Task).get(tasks[offset])
-            else:
-                return None
-    else:
-        return None
-    # candidate_tasks = get_candidate_tasks(app_id, user_id, user_ip, n_answers)
-    # total_remaining = len(candidate_tasks)
-    #print "Available tasks %s " % total_remaining
-    # if total_remaining == 0:
-    #    return None
-    # return candidate_tasks[0]
+    return _load_tasks(tasks[offset:offset + limit])
 
 
 def get_depth_first_task(app_id, user_id=None, user_ip=None, n_answers=30, offset=0):
     """Gets a new task for a given application"""
-    # Uncomment the next three lines to profile the sched function
-    #import timeit
-    #T = timeit.Timer(lambda: get_candidate_tasks(app_id, user_id,
-    #                  user_ip, n_answers))
-    #print "First algorithm: %s" % T.timeit(number=1)
-    candidate_tasks = get_candidate_tasks(app_id, user_id, user_ip, n_answers, offset=offset)
-    total_remaining = len(candidate_tasks)
-    #print "Available tasks %s " % total_remaining
-    if total_remaining == 0:
-        return None
-    if (offset == 0):
-        return candidate_tasks[0]
-    else:
-        if (offset < len(candidate_tasks)):
-            return candidate_tasks[offset]
-        else:
-            return None
+    return _first(get_depth_first_tasks(app_id, user_id, user_ip, n_answers,
+                                        offset=offset))
+
+
+@register('depth_first', 'default')
+def get_depth_first_tasks(app_id, user_id=None, user_ip=None, n_answers=30, offset=0, limit=1, son_app_id=0):
+    """Gets up to limit new tasks for a given application"""
+    candidate_tasks = get_candidate_tasks(app_id, user_id, user_ip, n_answers,
+                                          offset=offset, limit=limit)
+    return candidate_tasks[offset:offset + limit]
+
+
+def _queued_tasks(app_id, strategy, user_id, user_ip, offset, limit):
+    """Return the next tasks of a Redis queue that can be leased to the
+    user, or None if the queue cannot be read"""
+    lease_timeout = lease.get_timeout(app_id)
+
+    def select(tasks, candidate_tasks, n):
+        _filter_candidates(tasks, candidate_tasks, n, lease_timeout,
+                           user_id, user_ip)
+    return taskqueue.get_tasks(app_id, strategy, user_id, user_ip,
+                               offset=offset, limit=limit, select=select)
+
+
+def get_redis_depth_first_task(app_id, user_id=None, user_ip=None, n_answers=30, offset=0):
+    """Gets a new task for a given application from its Redis depth first
+    queue"""
+    return _first(get_redis_depth_first_tasks(app_id, user_id, user_ip,
+                                              n_answers, offset=offset))
+
+
+@register('redis_depth_first')
+def get_redis_depth_first_tasks(app_id, user_id=None, user_ip=None, n_answers=30, offset=0, limit=1, son_app_id=0):
+    """Gets up to limit new tasks from the Redis depth first queue"""
+    tasks = _queued_tasks(app_id, 'depth_first', user_id, user_ip, offset,
+                          limit)
+    if tasks is None:
+        # the queue is being rebuilt, or Redis is unavailable
+        return get_depth_first_tasks(app_id, user_id, user_ip, n_answers,
+                                     offset=offset, limit=limit)
+    return tasks
+
+
+def get_redis_breadth_first_task(app_id, user_id=None, user_ip=None, n_answers=30, offset=0):
+    """Gets a new task for a given application from its Redis breadth first
+    queue"""
+    return _first(get_redis_breadth_first_tasks(app_id, user_id, user_ip,
+                                                n_answers, offset=offset))
+
+
+@register('redis_breadth_first')
+def get_redis_breadth_first_tasks(app_id, user_id=None, user_ip=None, n_answers=30, offset=0, limit=1, son_app_id=0):
+    """Gets up to limit new tasks from the Redis breadth first queue"""
+    tasks = _queued_tasks(app_id, 'breadth_first', user_id, user_ip, offset,
+                          limit)
+    if tasks is None:
+        # the queue is being rebuilt, or Redis is unavailable
+        return get_breadth_first_tasks(app_id, user_id, user_ip, n_answers,
+                                       offset=offset, limit=limit)
+    return tasks
 
 
 def get_random_task(app_id, user_id=None, user_ip=None, n_answers=30, offset=0):
     """Returns a random task for the user"""
-    app = db.session.query(model.App).get(app_id)
-    from random import choice
-    if len(app.tasks) > 0:
-        return choice(app.tasks)
+    return _first(get_random_tasks(app_id, user_id, user_ip, n_answers,
+                                   offset=offset))
+
+
+@register('random')
+def get_random_tasks(app_id, user_id=None, user_ip=None, n_answers=30, offset=0, limit=1, son_app_id=0):
+    """Returns up to limit different random tasks for the user.
+
+    Instead of loading all the tasks of the app, it picks a random id between
+    the first and last ongoing task ids, and takes the tasks that the user
+    has not answered from that id on (wrapping around to the first task), in
+    growing windows of ids until it has limit tasks or has read them all.
+    Tasks placed after a gap of ids are a bit more likely to be sent.
+    """
+    sql = text('''SELECT MIN(id) AS min_id, MAX(id) AS max_id FROM task
+               WHERE app_id=:app_id AND state !='completed' ''')
+    bounds = db.engine.execute(sql, app_id=app_id).first()
+    if bounds is None or bounds.min_id is None:
+        return []
+    pivot = random.randint(bounds.min_id, bounds.max_id)
+    answered, params = _answered_filter(user_id, user_ip)
+    query = text('''SELECT * FROM task WHERE app_id=:app_id
+                 AND state !='completed' AND id > :after AND id < :end
+                 AND %s ORDER BY id ASC LIMIT :limit''' % answered)
+    window = max(10, limit)
+    lease_timeout = lease.get_timeout(app_id)
+    candidate_tasks = []
+    # the ids from the pivot on, and then the ones before it
+    for after, end in ((pivot - 1, bounds.max_id + 1),
+                       (bounds.min_id - 1, pivot)):
+        while len(candidate_tasks) < limit:
+            tasks = db.session.query(model.Task).from_statement(query)\
+                      .params(app_id=app_id, after=after, end=end,
+                              limit=window, **params).all()
+            _filter_candidates(tasks, candidate_tasks, limit, lease_timeout,
+                               user_id, user_ip)
+            if len(tasks) < window:
+                break
+            after = tasks[-1].id
+            window = min(window * 2, 1000)
+    return candidate_tasks
+
+
+def _answered_filter(user_id=None, user_ip=None):
+    """Return the SQL condition (and its params) that excludes the tasks
+    already answered by the user"""
+    if user_id and not user_ip:
+        return ('''NOT EXISTS (SELECT task_id FROM task_run WHERE
+                user_id=:user_id AND task_id=task.id)''',
+                dict(user_id=user_id))
     else:
-        return None
+        if not user_ip:
+            user_ip = '127.0.0.1'
+        return ('''NOT EXISTS (SELECT task_id FROM task_run WHERE
+                user_ip=:user_ip AND task_id=task.id)''',
+                dict(user_ip=user_ip))
 
 
 def get_incremental_task(app_id, user_id=None, user_ip=None, n_answers=30, offset=0):
     """Get a new task for a given application with its last given answer.
        It is an important strategy when dealing with large tasks, as
        transcriptions"""
-    candidate_tasks = get_candidate_tasks(app_id, user_id, user_ip, n_answers, offset=0)
+    return _first(get_incremental_tasks(app_id, user_id, user_ip, n_answers))
+
+
+@register('incremental')
+def get_incremental_tasks(app_id, user_id=None, user_ip=None, n_answers=30, offset=0, limit=1, son_app_id=0):
+    """Get up to limit new tasks with their last given answer. See
+    get_incremental_task"""
+    candidate_tasks = get_candidate_tasks(app_id, user_id, user_ip, n_answers,
+                                          offset=0, limit=limit)
     total_remaining = len(candidate_tasks)
     if total_remaining == 0:
-        return None
-    rand = random.randrange(0, total_remaining)
-    task = candidate_tasks[rand]
-    #Find last answer for the task
-    q = db.session.query(model.TaskRun)\
-          .filter(model.TaskRun.task_id == task.id)\
-          .order_by(model.TaskRun.finish_time.desc())
-    last_task_run = q.first()
-    if last_task_run:
-        task.info['last_answer'] = last_task_run.info
-        #TODO: As discussed in GitHub #53
-        # it is necessary to create a lock in the task!
-    return task
-
-
-def get_candidate_tasks(app_id, user_id=None, user_ip=None, n_answers=30, offset=0):
-    """Gets all available tasks for a given application and user"""
-    rows = None
-    if user_id and not user_ip:
-        query = text('''
-                     SELECT id FROM task WHERE NOT EXISTS
-                     (SELECT task_id FROM task_run WHERE
-                     app_id=:app_id AND user_id=:user_id AND task_id=task.id)
-                     AND app_id=:app_id AND state !='completed'
-                     ORDER BY priority_0 DESC, id ASC LIMIT 10''')
-        rows = db.engine.execute(query, app_id=app_id, user_id=user_id)
-    else:
-        if not user_ip:
-            user_ip = '127.0.0.1'
-        query = text('''
-                     SELECT id FROM task WHERE NOT EXISTS
-                     (SELECT task_id FROM task_run WHERE
-                     app_id=:app_id AND user_ip=:user_ip AND task_id=task.id)
-                     AND app_id=:app_id AND state !='completed'
-                     ORDER BY priority_0 DESC, id ASC LIMIT 10''')
-        rows = db.engine.execute(query, app_id=app_id, user_ip=user_ip)
-
-    tasks = []
-    for t in rows:
-        tasks.append(db.session.query(model.Task).get(t.id))
+        return []
+    tasks = random.sample(candidate_tasks, min(limit, total_remaining))
+    #Find last answer for the tasks
+    sql = text('''SELECT DISTINCT ON (task_id) task_id, info FROM task_run
+               WHERE task_id IN :task_ids
+               ORDER BY task_id, finish_time DESC''')
+    rows = db.engine.execute(sql, task_ids=tuple(t.id for t in tasks))
+    last_answers = dict((row.task_id,
+                         json.loads(row.info) if row.info else {})
+                        for row in rows)
+    for task in tasks:
+        if task.id in last_answers:
+            task.info['last_answer'] = last_answers[task.id]
+            # NOTE: As discussed in GitHub #53 concurrent users could get
+            # the same task; set App.time_limit to lease it (pybossa.lease)
+    return tasks
+
 
+def get_candidate_tasks(app_id, user_id=None, user_ip=None, n_answers=30, offset=0, limit=1, son_app_id=None, spam_threshold=None):
+    """Gets all available tasks for a given application and user. If
+    son_app_id is given, only the answers of that stage are skipped"""
+    # The number of answers of each task is read from the task.n_task_runs
+    # counter, and the tasks answered by the user are skipped with the
+    # pybossa.answered bitmaps, so the candidates are a plain scan of the
+    # task_app_id_priority_idx index instead of an anti-join with task_run.
+    # The scan goes on from the last task seen (keyset paging), so heavy
+    # contributors do not read the first tasks again on every window.
+    params = dict(app_id=app_id)
+    spam = ''
+    if spam_threshold is not None:
+        spam = 'AND COALESCE(is_it_spam, 0) < :spam_threshold'
+        params['spam_threshold'] = spam_threshold
+    sql = '''
+          SELECT id, priority_0 FROM task
+          WHERE app_id=:app_id AND state !='completed' %s %s
+          ORDER BY priority_0 DESC, id ASC
+          LIMIT :limit'''
+    window = max(10, offset + limit)
+    n = offset + limit
+    lease_timeout = lease.get_timeout(app_id)
+    after = ''
     candidate_tasks = []
+    while True:
+        rows = db.engine.execute(text(sql % (spam, after)), limit=window,
+                                 **params).fetchall()
+        task_ids = [row.id for row in rows]
+        done = answered.get(app_id, task_ids, user_id, user_ip, son_app_id)
+        checked = done is None
+        if checked:
+            # Redis is unavailable: skip the answered tasks with the DB
+            done = answered.check(app_id, task_ids, user_id, user_ip,
+                                  son_app_id)
+        todo = [i for i in task_ids if i not in done]
+        while todo and len(candidate_tasks) < n:
+            ids, todo = todo[:n], todo[n:]
+            if not checked:
+                # the bitmaps can miss answers committed while they were
+                # built, so the candidates are checked against the DB
+                done = answered.check(app_id, ids, user_id, user_ip,
+                                      son_app_id)
+                ids = [i for i in ids if i not in done]
+            _filter_candidates(_load_tasks(ids), candidate_tasks, n,
+                               lease_timeout, user_id, user_ip)
+        if len(task_ids) < window or len(candidate_tasks) >= n:
+            break
+        last = rows[-1]
+        params.update(last_id=last.id, last_priority=last.priority_0)
+        if last.priority_0 is None:
+            # NULL priorities come first in descending order
+            after = '''AND ((priority_0 IS NULL AND id > :last_id)
+                     OR priority_0 IS NOT NULL)'''
+        else:
+            after = '''AND (priority_0 < :last_priority
+                     OR (priority_0 = :last_priority AND id > :last_id))'''
+        # heavy contributors have answered many of the first tasks
+        window = min(window * 2, 1000)
+    return candidate_tasks
+
 
+def _filter_candidates(tasks, candidate_tasks, n, lease_timeout=0,
+                       user_id=None, user_ip=None):
+    """Append to candidate_tasks up to n tasks that still need answers, and
+    lease them to the user if the app has a time limit"""
+    if lease_timeout:
+        leases = lease.count([t.id for t in tasks], lease_timeout,
+                             user_id, user_ip)
     for t in tasks:
-        # DEPRECATED: t.info.n_answers will be removed
-        # DEPRECATED: so if your task has a different value for n_answers
-        # DEPRECATED: use t.n_answers instead
-        #print t.id
-        if (t.info.get('n_answers')):
-            t.n_answers = int(t.info['n_answers'])
-        # NEW WAY!
-        if t.n_answers is None:
-            t.n_answers = 30
-
-        if (len(t.task_runs) >= t.n_answers):
-                t.state = "completed"
-                db.session.merge(t)
-                db.session.commit()
+        # The task state is kept by the task_state trigger, so this is just
+        # a guard against drift (see cli.py reconcile_tasks), never a write
+        n_answers = t.n_answers or 30
+        if ((t.n_task_runs or 0) >= n_answers):
+            continue
+        elif lease_timeout and \
+                (t.n_task_runs or 0) + leases[t.id] >= n_answers:
+            # the remaining answers are reserved for other users
+            continue
+        elif lease_timeout and \
+                not lease.acquire(t, lease_timeout, user_id, user_ip):
+            continue
         else:
             candidate_tasks.append(t)
-            if (offset == 0):
+            if (len(candidate_tasks) >= n):
                 break
     return candidate_tasks
-	
+
 def get_filtered_by_user_task(app_id, user_id=None, user_ip=None, n_answers=30, offset=0, son_app_id=0):
     """Gets all available tasks for a given application and user"""
-    rows = None
-    if user_id and not user_ip:
-        query = text('''
-                     SELECT id,is_it_spam FROM task WHERE NOT EXISTS
-                     (SELECT task_id FROM task_run WHERE
-                     app_id=:app_id AND user_id=:user_id AND task_id=task.id AND info LIKE '%"son_app_id": '''+son_app_id+'''%')
-                     AND app_id=:app_id AND state !='completed'
-                     ORDER BY priority_0 DESC, id ASC LIMIT 10''')
-        rows = db.engine.execute(query, app_id=app_id, user_id=user_id)
-    else:
-        if not user_ip:
-            user_ip = '127.0.0.1'
-        query = text('''
-                     SELECT id,is_it_spam FROM task WHERE NOT EXISTS
-                     (SELECT task_id FROM task_run WHERE
-                     app_id=:app_id AND user_ip=:user_ip AND task_id=task.id AND info LIKE '%"son_app_id": '''+son_app_id+'''%')
-                     AND app_id=:app_id AND state !='completed'
-                     ORDER BY priority_0 DESC, id ASC LIMIT 10''')
-        rows = db.engine.execute(query, app_id=app_id, user_ip=user_ip)
-
-    tasks = []
-    for t in rows:
-        if t.is_it_spam<30:
-            tasks.append(db.session.query(model.Task).get(t.id))
+    return _first(get_filtered_by_user_tasks(app_id, user_id, user_ip,
+                                             n_answers, offset=offset,
+                                             son_app_id=son_app_id))
 
-    candidate_tasks = []
 
-    for t in tasks:
-        # DEPRECATED: t.info.n_answers will be removed
-        # DEPRECATED: so if your task has a different value for n_answers
-        # DEPRECATED: use t.n_answers instead
-        #print t.id
-        if (t.info.get('n_answers')):
-            t.n_answers = int(t.info['n_answers'])
-        # NEW WAY!
-        if t.n_answers is None:
-            t.n_answers = 30
-
-        if (len(t.task_runs) >= t.n_answers):
-                t.state = "completed"
-                db.session.merge(t)
-                db.session.commit()
-        else:
-            candidate_tasks.append(t)
-            if (offset == 0):
-                break
-    total_remaining = len(candidate_tasks)
-    #print "Available tasks %s " % total_remaining
-    if total_remaining == 0:
-        return None
-    if (offset == 0):
-        return candidate_tasks[0]
-    else:
-        if (offset < len(candidate_tasks)):
-            return candidate_tasks[offset]
-        else:
-            return None
\ No newline at end of file
+@register('filter_by_users')
+def get_filtered_by_user_tasks(app_id, user_id=None, user_ip=None, n_answers=30, offset=0, limit=1, son_app_id=0):
+    """Gets up to limit available tasks for a given application and user,
+    skipping the tasks answered by the user in the son_app_id stage and the
+    tasks reported as spam more than the app spam_threshold"""
+    app = db.session.query(model.App).get(app_id)
+    spam_threshold = app.info.get('spam_threshold', 30)
+    try:
+        son_app_id = int(son_app_id)
+    except (TypeError, ValueError):
+        son_app_id = 0
+    candidate_tasks = get_candidate_tasks(app_id, user_id, user_ip, n_answers,
+                                          offset=offset, limit=limit,
+                                          son_app_id=son_app_id,
+                                          spam_threshold=spam_threshold)
+    return candidate_tasks[offset:offset + limit]
@@ -0,0 +1,129 @@
+# -*- coding: utf8 -*-
+# This file is part of PyBossa.
+#
+# Copyright (C) 2013 SF Isle of Man Limited
+#
+# PyBossa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyBossa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Timing of the scheduler strategies.
+
+Every call to a strategy (see pybossa.sched.register) is timed, and the SQL
+queries it issues and the rows they return are counted. The numbers are
+kept within every process and added every FLUSH_INTERVAL seconds to one
+Redis hash per strategy and app (see pybossa.counters), so they are aggregated across all the web
+workers without an extra round trip per scheduler call:
+
+    pybossa_sched:stats:<strategy>:<app_id>
+
+with the fields calls, ms (total latency), queries, rows and ms:<bucket>
+for the latency histogram (calls that took up to <bucket> ms).
+
+This module exports:
+    * timed: context manager for timing a strategy call
+    * counted: context manager for counting the queries of a block
+    * flush: for adding the stats of this process to Redis
+    * get: for getting the stats of every strategy and app
+    * reset: for removing all the stats
+
+"""
+import time
+import threading
+from contextlib import contextmanager
+from sqlalchemy import event
+
+from pybossa.core import app, db
+from pybossa.counters import Counters
+
+KEYPREFIX = 'pybossa_sched:stats'
+# Latency histogram buckets in ms
+BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+# Seconds the stats are kept within the process before adding them to Redis
+FLUSH_INTERVAL = 10
+
+_local = threading.local()
+counters = Counters(KEYPREFIX, FLUSH_INTERVAL)
+
+
+def _bucket(ms):
+    for b in BUCKETS:
+        if ms <= b:
+            return 'ms:%s' % b
+    return 'ms:inf'
+
+
+@event.listens_for(db.engine, 'after_cursor_execute')
+def _count_query(conn, cursor, statement, parameters, context, executemany):
+    counter = getattr(_local, 'counter', None)
+    if counter is not None:
+        counter['queries'] += 1
+        if cursor.rowcount > 0:
+            counter['rows'] += cursor.rowcount
+
+
+@contextmanager
+def counted():
+    """Count the queries issued by the current thread within the block.
+    Yields a dict with the queries and rows counts"""
+    _local.counter = counter = dict(queries=0, rows=0)
+    try:
+        yield counter
+    finally:
+        _local.counter = None
+
+
+@contextmanager
+def timed(strategy, app_id):
+    """Time the block and count the queries it issues"""
+    if not app.config.get('SCHED_STATS', True):
+        yield
+        return
+    start = time.time()
+    try:
+        with counted() as counter:
+            yield
+    finally:
+        ms = (time.time() - start) * 1000
+        counters.record('%s:%s' % (strategy, app_id), calls=1, ms=ms,
+                        queries=counter['queries'], rows=counter['rows'],
+                        **{_bucket(ms): 1})
+
+
+def flush():
+    """Add the stats of this process to Redis"""
+    counters.flush()
+
+
+def get():
+    """Return the stats of every strategy and app, the slowest first. None
+    is returned while Redis is unavailable"""
+    hashes = counters.get()
+    if hashes is None:
+        return None
+    stats = []
+    for name, h in hashes:
+        strategy, app_id = name.rsplit(':', 1)
+        calls = int(h.get('calls', 0))
+        ms = float(h.get('ms', 0))
+        stats.append(dict(
+            strategy=strategy, app_id=int(app_id), calls=calls, ms=ms,
+            avg_ms=ms / calls if calls else 0,
+            queries=int(h.get('queries', 0)), rows=int(h.get('rows', 0)),
+            histogram=[(b, int(h.get('ms:%s' % b, 0)))
+                       for b in BUCKETS + ('inf',)]))
+    return sorted(stats, key=lambda s: s['ms'], reverse=True)
+
+
+def reset():
+    """Remove all the stats. Returns False if Redis is unavailable"""
+    return counters.reset()
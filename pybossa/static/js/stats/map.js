@@ -0,0 +1,12 @@
+// Draw the anonymous volunteers binned by the server in a grid: one circle
+// per cell, sized by the number of volunteers within it.
+function pybossaMapBins(map, bins) {
+    var i = 0;
+    var l = bins.length;
+    for (i;i<l;i++) {
+        var radius = 4 + 3 * Math.log(bins[i].count);
+        L.circleMarker([bins[i].lat, bins[i].lng], {radius: radius})
+            .bindPopup(String(bins[i].count))
+            .addTo(map);
+    }
+}
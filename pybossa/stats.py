@@ -19,30 +19,26 @@
 from flask import current_app
 from sqlalchemy.sql import text
 from pybossa.core import db
-from pybossa.cache import cache, memoize, ONE_DAY
-from pybossa.model import TaskRun, Task
+from pybossa.cache import cache, memoize, ONE_DAY, ONE_HOUR
+from pybossa.model import Task
 from pybossa.cache import FIVE_MINUTES, memoize
+from pybossa.geo import locate_many, bins
 
-import string
-import pygeoip
 import operator
 import datetime
 import time
 from datetime import timedelta
-
-
-@memoize(timeout=ONE_DAY)
-def get_task_runs(app_id):
-    """Return all the Task Runs for a given app_id"""
-    task_runs = db.session.query(TaskRun).filter_by(app_id=app_id).all()
-    return task_runs
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
 
 
 @memoize(timeout=ONE_DAY)
 def get_tasks(app_id):
-    """Return all the tasks for a given app_id"""
+    """Return all the tasks for a given app_id, as dicts"""
     tasks = db.session.query(Task).filter_by(app_id=app_id).all()
-    return tasks
+    return [task.dictize() for task in tasks]
 
 
 @memoize(timeout=ONE_DAY)
@@ -112,57 +108,135 @@ def stats_users(app_id):
     return users, anon_users, auth_users
 
 
+# The answers per app, day and hour, with the number of authenticated and
+# anonymous ones, are kept in the task_run_stats rollups. The task runs
+# created after the last rollup are still counted from task_run, so the stats
+# are up to date even if the rollups are not.
+_NEW_ANSWERS = '''SELECT app_id, split_part(finish_time, 'T', 1) AS day,
+    split_part(split_part(finish_time, 'T', 2), ':', 1) AS hour,
+    COUNT(user_id) AS n_auth, COUNT(id) - COUNT(user_id) AS n_anon
+    FROM task_run WHERE %s AND finish_time IS NOT NULL
+    GROUP BY app_id, day, hour'''
+
+ANSWERS = '''(SELECT app_id, day, hour, n_auth, n_anon FROM task_run_stats
+    UNION ALL %s) AS answers''' % (_NEW_ANSWERS % '''id > (SELECT
+    COALESCE(MAX(last_id), 0) FROM stats_watermark WHERE name='task_run')''')
+
+
+# Task runs are only folded once they are older than this, so that the ones
+# with lower ids whose transactions commit late are not skipped
+ROLLUP_MARGIN = timedelta(minutes=10)
+
+
+def rollup(rebuild=False, margin=ROLLUP_MARGIN):
+    """Fold the task runs created since the last rollup into task_run_stats,
+    and return how many were folded.
+
+    Old days never change, so the stats only have to read the rollups and the
+    few task runs that have not been folded yet. The rollups are not updated
+    when task runs are deleted: call it with rebuild=True to compute them
+    again from all the task runs.
+
+    Ids are taken when the task runs are inserted, but they are seen in the
+    order their transactions commit. Only the task runs up to the last one
+    finished more than margin ago are folded, and the watermark is left
+    there."""
+    conn = db.engine.connect()
+    trans = conn.begin()
+    try:
+        # one rollup at a time, while the stats can still be read
+        conn.execute(text('LOCK TABLE stats_watermark IN EXCLUSIVE MODE'))
+        if rebuild:
+            conn.execute(text('DELETE FROM task_run_stats'))
+            conn.execute(text('''DELETE FROM stats_watermark
+                              WHERE name='task_run' '''))
+        low = conn.execute(text('''SELECT last_id FROM stats_watermark
+                                WHERE name='task_run' ''')).scalar()
+        if low is None:
+            low = 0
+            conn.execute(text('''INSERT INTO stats_watermark (name, last_id)
+                              VALUES ('task_run', 0)'''))
+        horizon = (datetime.datetime.utcnow() - margin).isoformat()
+        high = conn.execute(text('''SELECT MAX(id) FROM task_run
+                                 WHERE id > :low
+                                 AND finish_time < :horizon'''),
+                            low=low, horizon=horizon).scalar()
+        if high is None or high <= low:
+            trans.commit()
+            return 0
+        new = _NEW_ANSWERS % 'id > :low AND id <= :high'
+        conn.execute(text('''UPDATE task_run_stats SET
+                          n_auth=task_run_stats.n_auth + new.n_auth,
+                          n_anon=task_run_stats.n_anon + new.n_anon
+                          FROM (%s) AS new
+                          WHERE task_run_stats.app_id=new.app_id
+                          AND task_run_stats.day=new.day
+                          AND task_run_stats.hour=new.hour''' % new),
+                     low=low, high=high)
+        conn.execute(text('''INSERT INTO task_run_stats
+                          (app_id, day, hour, n_auth, n_anon)
+                          SELECT * FROM (%s) AS new WHERE NOT EXISTS
+                          (SELECT 1 FROM task_run_stats
+                          WHERE task_run_stats.app_id=new.app_id
+                          AND task_run_stats.day=new.day
+                          AND task_run_stats.hour=new.hour)''' % new),
+                     low=low, high=high)
+        n = conn.execute(text('''SELECT COUNT(id) FROM task_run
+                              WHERE id > :low AND id <= :high
+                              AND finish_time IS NOT NULL'''),
+                         low=low, high=high).scalar()
+        conn.execute(text('''UPDATE stats_watermark SET last_id=:high
+                          WHERE name='task_run' '''), high=high)
+        trans.commit()
+        return n
+    except:
+        trans.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+def _answers_per_hour(app_id):
+    """Return the (day, hour, n_auth, n_anon) answers of a given app_id"""
+    sql = text('''SELECT day, hour, SUM(n_auth) AS n_auth,
+               SUM(n_anon) AS n_anon FROM %s
+               WHERE app_id=:app_id GROUP BY day, hour;''' % ANSWERS)
+    results = db.engine.execute(sql, app_id=app_id)
+    return [(row.day, row.hour, int(row.n_auth), int(row.n_anon))
+            for row in results]
+
+
 @memoize(timeout=ONE_DAY)
 def stats_dates(app_id):
+    """Return the answers per day of a given app_id, in total and for
+    anonymous and authenticated users"""
     dates = {}
     dates_anon = {}
     dates_auth = {}
     dates_n_tasks = {}
 
-    task_runs = get_task_runs(app_id)
-
     avg, total_n_tasks = get_avg_n_tasks(app_id)
 
-    for tr in task_runs:
-        # Data for dates
-        date, hour = string.split(tr.finish_time, "T")
-        tr.finish_time = string.split(tr.finish_time, '.')[0]
-        hour = string.split(hour, ":")[0]
-
-        # Dates
-        if date in dates.keys():
-            dates[date] += 1
-        else:
-            dates[date] = 1
-
-        if date in dates_n_tasks.keys():
-            dates_n_tasks[date] = total_n_tasks * avg
-        else:
-            dates_n_tasks[date] = total_n_tasks * avg
+    if _use_numpy():
+        return _dates_numpy(_answers_per_hour(app_id), total_n_tasks * avg)
 
-        if tr.user_id is None:
-            if date in dates_anon.keys():
-                dates_anon[date] += 1
-            else:
-                dates_anon[date] = 1
-        else:
-            if date in dates_auth.keys():
-                dates_auth[date] += 1
-            else:
-                dates_auth[date] = 1
+    for day, hour, n_auth, n_anon in _answers_per_hour(app_id):
+        dates[day] = dates.get(day, 0) + n_auth + n_anon
+        dates_n_tasks[day] = total_n_tasks * avg
+        if n_anon > 0:
+            dates_anon[day] = dates_anon.get(day, 0) + n_anon
+        if n_auth > 0:
+            dates_auth[day] = dates_auth.get(day, 0) + n_auth
     return dates, dates_n_tasks, dates_anon, dates_auth
 
 
 @memoize(timeout=ONE_DAY)
 def stats_hours(app_id):
+    """Return the answers per hour of the day of a given app_id, in total
+    and for anonymous and authenticated users, and their maximums"""
     hours = {}
     hours_anon = {}
     hours_auth = {}
-    max_hours = 0
-    max_hours_anon = 0
-    max_hours_auth = 0
-
-    task_runs = get_task_runs(app_id)
 
     # initialize hours keys
     for i in range(0, 24):
@@ -170,29 +244,81 @@ def stats_hours(app_id):
         hours_anon[str(i).zfill(2)] = 0
         hours_auth[str(i).zfill(2)] = 0
 
-    for tr in task_runs:
-        # Hours
-        date, hour = string.split(tr.finish_time, "T")
-        tr.finish_time = string.split(tr.finish_time, '.')[0]
-        hour = string.split(hour, ":")[0]
-
-        if hour in hours.keys():
-            hours[hour] += 1
-            if (hours[hour] > max_hours):
-                max_hours = hours[hour]
+    for day, hour, n_auth, n_anon in _answers_per_hour(app_id):
+        if hour in hours:
+            hours[hour] += n_auth + n_anon
+            hours_anon[hour] += n_anon
+            hours_auth[hour] += n_auth
+    return hours, hours_anon, hours_auth, max(hours.values()), \
+        max(hours_anon.values()), max(hours_auth.values())
+
+
+def _use_numpy():
+    """Return True if the stats are computed with NumPy arrays"""
+    return numpy is not None and current_app.config.get('STATS_NUMPY', False)
+
+
+def _js_time(day):
+    """Return the local midnight of a YYYY-MM-DD day in miliseconds since
+    EPOCH, as JavaScript expects"""
+    return int(time.mktime(time.strptime(day, "%Y-%m-%d")) * 1000)
+
+
+def _dates_numpy(answers, n_tasks):
+    """stats_dates with NumPy arrays: the answers per hour are summed per day
+    ordinal with bincount"""
+    if not answers:
+        return {}, {}, {}, {}
+    days, hours, auth, anon = zip(*answers)
+    ordinals = numpy.array(days, dtype='datetime64[D]').astype(numpy.int64)
+    ordinals, index = numpy.unique(ordinals, return_inverse=True)
+    auth = numpy.bincount(index, weights=auth).astype(numpy.int64)
+    anon = numpy.bincount(index, weights=anon).astype(numpy.int64)
+    days = numpy.datetime_as_string(
+        ordinals.astype('datetime64[D]')).tolist()
+    dates = dict(zip(days, (auth + anon).tolist()))
+    dates_n_tasks = dict((d, n_tasks) for d in days)
+    dates_anon = dict((d, n) for d, n in zip(days, anon.tolist()) if n > 0)
+    dates_auth = dict((d, n) for d, n in zip(days, auth.tolist()) if n > 0)
+    return dates, dates_n_tasks, dates_anon, dates_auth
 
-        if tr.user_id is None:
-            if hour in hours_anon.keys():
-                hours_anon[hour] += 1
-                if (hours_anon[hour] > max_hours_anon):
-                    max_hours_anon = hours_anon[hour]
 
-        else:
-            if hour in hours_auth.keys():
-                hours_auth[hour] += 1
-                if (hours_auth[hour] > max_hours_auth):
-                    max_hours_auth = hours_auth[hour]
-    return hours, hours_anon, hours_auth, max_hours, max_hours_anon, max_hours_auth
+def _format_dates_numpy(dates, dates_n_tasks, dates_estimate, dates_anon,
+                        dates_auth):
+    """stats_format_dates with NumPy arrays of the days and their answers.
+    Returns the values of every series by name"""
+    days = sorted(dates.keys())
+    ms = [_js_time(d) for d in days]
+    answers = numpy.array([dates[d] for d in days], dtype=numpy.int64)
+    anon = numpy.array([dates_anon.get(d, 0) for d in days],
+                       dtype=numpy.int64)
+    auth = numpy.array([dates_auth.get(d, 0) for d in days],
+                       dtype=numpy.int64)
+    total = numpy.cumsum(answers)
+
+    values = dict(new=map(list, zip(ms, answers.tolist())),
+                  total=map(list, zip(ms, total.tolist())),
+                  anon=map(list, zip(ms, anon.tolist())),
+                  auth=map(list, zip(ms, auth.tolist())),
+                  avg=[[t, dates_n_tasks[d]] for t, d in zip(ms, days)])
+
+    days = sorted(dates_estimate.keys())
+    ms = [_js_time(d) for d in days]
+    values['estimate'] = [[t, dates_estimate[d]] for t, d in zip(ms, days)]
+    if days:
+        n_tasks = dates_n_tasks.values()[0]
+        values['avg'] += [[t, n_tasks] for t in ms]
+    return values
+
+
+def _estimate_numpy(last_day, total_answers, avg_answers_per_day,
+                    required_days_to_finish):
+    """Return the estimated answers per day until the app is completed,
+    with NumPy arrays"""
+    i = numpy.arange(int(required_days_to_finish) + 2)
+    days = numpy.datetime64(last_day.date()) + i
+    pace = total_answers + i * avg_answers_per_day
+    return dict(zip(numpy.datetime_as_string(days).tolist(), pace.tolist()))
 
 
 @memoize(timeout=ONE_DAY)
@@ -206,48 +332,42 @@ def stats_format_dates(app_id, dates, dates_n_tasks, dates_estimate,
     dayNewAnonStats = dict(label="Anonymous", values=[])
     dayNewAuthStats = dict(label="Authenticated", values=[])
 
+    if _use_numpy():
+        values = _format_dates_numpy(dates, dates_n_tasks, dates_estimate,
+                                     dates_anon, dates_auth)
+        dayNewStats['values'] = values['new']
+        dayNewAnonStats['values'] = values['anon']
+        dayNewAuthStats['values'] = values['auth']
+        dayTotalStats['values'] = values['total']
+        dayAvgAnswers['values'] = values['avg']
+        dayEstimates['values'] = values['estimate']
+        return dayNewStats, dayNewAnonStats, dayNewAuthStats, \
+            dayTotalStats, dayAvgAnswers, dayEstimates
+
     total = 0
     for d in sorted(dates.keys()):
         # JavaScript expects miliseconds since EPOCH
+        ms = _js_time(d)
         # New answers per day
-        dayNewStats['values'].append(
-            [int(time.mktime(time.strptime(d, "%Y-%m-%d")) * 1000), dates[d]])
+        dayNewStats['values'].append([ms, dates[d]])
 
-        dayAvgAnswers['values'].append(
-            [int(time.mktime(time.strptime(d, "%Y-%m-%d")) * 1000),
-             dates_n_tasks[d]])
+        dayAvgAnswers['values'].append([ms, dates_n_tasks[d]])
 
         # Total answers per day
         total = total + dates[d]
-        dayTotalStats['values'].append(
-            [int(time.mktime(time.strptime(d, "%Y-%m-%d")) * 1000), total])
+        dayTotalStats['values'].append([ms, total])
 
         # Anonymous answers per day
-        if d in (dates_anon.keys()):
-            dayNewAnonStats['values'].append(
-                [int(time.mktime(time.strptime(d, "%Y-%m-%d")) * 1000),
-                 dates_anon[d]])
-        else:
-            dayNewAnonStats['values'].append(
-                [int(time.mktime(time.strptime(d, "%Y-%m-%d")) * 1000), 0])
+        dayNewAnonStats['values'].append([ms, dates_anon.get(d, 0)])
 
         # Authenticated answers per day
-        if d in (dates_auth.keys()):
-            dayNewAuthStats['values'].append(
-                [int(time.mktime(time.strptime(d, "%Y-%m-%d")) * 1000),
-                 dates_auth[d]])
-        else:
-            dayNewAuthStats['values'].append(
-                [int(time.mktime(time.strptime(d, "%Y-%m-%d")) * 1000), 0])
+        dayNewAuthStats['values'].append([ms, dates_auth.get(d, 0)])
 
     for d in sorted(dates_estimate.keys()):
-        dayEstimates['values'].append(
-            [int(time.mktime(time.strptime(d, "%Y-%m-%d")) * 1000),
-             dates_estimate[d]])
+        ms = _js_time(d)
+        dayEstimates['values'].append([ms, dates_estimate[d]])
 
-        dayAvgAnswers['values'].append(
-            [int(time.mktime(time.strptime(d, "%Y-%m-%d")) * 1000),
-             dates_n_tasks.values()[0]])
+        dayAvgAnswers['values'].append([ms, dates_n_tasks.values()[0]])
 
     return dayNewStats, dayNewAnonStats, dayNewAuthStats, \
         dayTotalStats, dayAvgAnswers, dayEstimates
@@ -298,7 +418,7 @@ def stats_format_hours(app_id, hours, hours_anon, hours_auth,
 def stats_format_users(app_id, users, anon_users, auth_users, geo=False):
     """Format User Stats into JSON"""
     userStats = dict(label="User Statistics", values=[])
-    userAnonStats = dict(label="Anonymous Users", values=[], top5=[], locs=[])
+    userAnonStats = dict(label="Anonymous Users", values=[], top5=[])
     userAuthStats = dict(label="Authenticated Users", values=[], top5=[])
 
     userStats['values'].append(dict(label="Anonymous", value=[0, users['n_anon']]))
@@ -311,37 +431,18 @@ def stats_format_users(app_id, users, anon_users, auth_users, geo=False):
         userAuthStats['values'].append(dict(label=u[0], value=[u[1]]))
 
     # Get location for Anonymous users
+    # (the map gets them from stats_locs)
     top5_anon = []
     top5_auth = []
-    loc_anon = []
-    # Check if the GeoLiteCity.dat exists
-    geolite = current_app.root_path + '/../dat/GeoLiteCity.dat'
     if geo:
-        gic = pygeoip.GeoIP(geolite)
-    for u in anon_users:
+        locs = locate_many([u[0] for u in anon_users[0:5]])
+    for u in anon_users[0:5]:
         if geo:
-            loc = gic.record_by_addr(u[0])
+            loc = locs[u[0]]
         else:
-            loc = {}
-        if loc is None:
-            loc = {}
-        if (len(loc.keys()) == 0):
-            loc['latitude'] = 0
-            loc['longitude'] = 0
+            loc = dict(latitude=0, longitude=0)
         top5_anon.append(dict(ip=u[0], loc=loc, tasks=u[1]))
 
-    for u in anon_users:
-        if geo:
-            loc = gic.record_by_addr(u[0])
-        else:
-            loc = {}
-        if loc is None:
-            loc = {}
-        if (len(loc.keys()) == 0):
-            loc['latitude'] = 0
-            loc['longitude'] = 0
-        loc_anon.append(dict(ip=u[0], loc=loc, tasks=u[1]))
-
     for u in auth_users:
         sql = text('''SELECT name, fullname from "user" where id=:id;''')
         results = db.engine.execute(sql, id=u[0])
@@ -350,8 +451,7 @@ def stats_format_users(app_id, users, anon_users, auth_users, geo=False):
             name = row.name
         top5_auth.append(dict(name=name, fullname=fullname, tasks=u[1]))
 
-    userAnonStats['top5'] = top5_anon[0:5]
-    userAnonStats['locs'] = loc_anon
+    userAnonStats['top5'] = top5_anon
     userAuthStats['top5'] = top5_auth
 
     return dict(users=userStats, anon=userAnonStats, auth=userAuthStats,
@@ -359,6 +459,15 @@ def stats_format_users(app_id, users, anon_users, auth_users, geo=False):
 
 
 @memoize(timeout=ONE_DAY)
+def stats_locs(app_id):
+    """Return the locations of the anonymous users of a given app_id, binned
+    in a grid of GEO_BIN_SIZE degrees"""
+    users, anon_users, auth_users = stats_users(app_id)
+    locs = locate_many([u[0] for u in anon_users])
+    return bins(locs.values(), current_app.config.get('GEO_BIN_SIZE', 1))
+
+
+@memoize(timeout=ONE_DAY, stale=ONE_HOUR)
 def get_stats(app_id, geo=False):
     """Return the stats a given app"""
     hours, hours_anon, hours_auth, max_hours, \
@@ -376,14 +485,18 @@ def get_stats(app_id, geo=False):
         avg_answers_per_day = total_answers / len(dates)
     required_days_to_finish = ((avg * total_n_tasks) - total_answers) / avg_answers_per_day
 
-    pace = total_answers
-
-    dates_estimate = {}
-    for i in range(0, int(required_days_to_finish) + 2):
-        tmp = last_day + timedelta(days=(i))
-        tmp_str = tmp.date().strftime('%Y-%m-%d')
-        dates_estimate[tmp_str] = pace
-        pace = pace + avg_answers_per_day
+    if _use_numpy():
+        dates_estimate = _estimate_numpy(last_day, total_answers,
+                                         avg_answers_per_day,
+                                         required_days_to_finish)
+    else:
+        pace = total_answers
+        dates_estimate = {}
+        for i in range(0, int(required_days_to_finish) + 2):
+            tmp = last_day + timedelta(days=(i))
+            tmp_str = tmp.date().strftime('%Y-%m-%d')
+            dates_estimate[tmp_str] = pace
+            pace = pace + avg_answers_per_day
 
     dates_stats = stats_format_dates(app_id, dates, dates_n_tasks, dates_estimate,
                                      dates_anon, dates_auth)
@@ -0,0 +1,228 @@
+# -*- coding: utf8 -*-
+# This file is part of PyBossa.
+#
+# Copyright (C) 2013 SF Isle of Man Limited
+#
+# PyBossa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyBossa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Redis backed task queues for the scheduler.
+
+Every app gets one sorted set per strategy with the ids of its ongoing tasks:
+
+    * depth_first: scored by -priority_0, so the most important task is first
+    * breadth_first: scored by the number of answers, so the least answered
+      task is first
+
+Ties are broken by task id, as members are zero padded ids. Picking a task
+is a ZRANGE on the queue plus a check against the bitmap of the tasks
+answered by the user (see pybossa.answered), and no SQL query is issued
+until the picked tasks are loaded.
+
+Queues are rebuilt from the DB when they are missing, by one worker at a
+time, and they expire after SCHED_QUEUE_TIMEOUT seconds to recover from any
+drift. While a queue is being rebuilt, or Redis is unavailable, get_tasks
+returns None and the scheduler uses its SQL strategy.
+
+This module exports:
+    * get_tasks: for getting the next tasks of a queue
+    * rebuild: for rebuilding the queues of an app from the DB
+    * delete: for removing the queues of an app
+
+"""
+import uuid
+from sqlalchemy import event
+from sqlalchemy.sql import text
+
+from pybossa.core import app, db, redis_master
+from pybossa.breaker import redis_breaker, Unavailable
+from pybossa import answered
+import pybossa.model as model
+
+STRATEGIES = ('depth_first', 'breadth_first')
+KEYPREFIX = 'pybossa_sched'
+# Number of queued tasks checked per ZRANGE
+WINDOW = 50
+# Sentinel member, so an empty queue can be stored in Redis
+EMPTY = 0
+# Seconds a worker can take to rebuild the queues of an app
+LOCK_TIMEOUT = 60
+
+
+def _timeout():
+    return app.config.get('SCHED_QUEUE_TIMEOUT', 24 * 60 * 60)
+
+
+def _member(task_id):
+    return '%012d' % task_id
+
+
+def _queue_key(app_id, strategy):
+    return '%s:app:%s:%s' % (KEYPREFIX, app_id, strategy)
+
+
+def rebuild(app_id):
+    """Rebuild the queues of an app from the DB"""
+    sql = text('''SELECT id, priority_0, n_task_runs FROM task
+               WHERE app_id=:app_id AND state !='completed'
+               AND COALESCE(n_task_runs, 0) < COALESCE(n_answers, 30)''')
+    rows = db.engine.execute(sql, app_id=app_id).fetchall()
+    scores = dict(depth_first=lambda row: -(row.priority_0 or 0),
+                  breadth_first=lambda row: row.n_task_runs or 0)
+    for strategy in STRATEGIES:
+        # Build the queue in a temporary key and swap it atomically, so
+        # concurrent requests never see a half built queue
+        key = _queue_key(app_id, strategy)
+        tmp = '%s:tmp:%s' % (key, uuid.uuid4().hex)
+        p = redis_master.pipeline(transaction=False)
+        for i in range(0, len(rows), 1000):
+            chunk = dict((_member(row.id), scores[strategy](row))
+                         for row in rows[i:i + 1000])
+            p.zadd(tmp, **chunk)
+        if rows:
+            p.expire(tmp, _timeout())
+            p.rename(tmp, key)
+        else:
+            # an empty queue is stored as the sentinel member
+            p.delete(key)
+            p.zadd(key, **{_member(EMPTY): float('inf')})
+            p.expire(key, _timeout())
+        p.execute()
+
+
+def delete(app_id):
+    """Remove the queues of an app, so they are rebuilt on next request"""
+    try:
+        redis_breaker.call(redis_master.delete,
+                           *[_queue_key(app_id, s) for s in STRATEGIES])
+    except Unavailable:
+        # the queues expire after SCHED_QUEUE_TIMEOUT seconds
+        app.logger.warning('Task queues of app %s not removed' % app_id)
+
+
+def _ready(app_id, queue):
+    """Return True if the queue exists, rebuilding the queues of the app if
+    they are missing and no other worker is rebuilding them"""
+    if redis_master.exists(queue):
+        return True
+    lock = '%s:app:%s:rebuild' % (KEYPREFIX, app_id)
+    if not redis_master.set(lock, 1, nx=True, ex=LOCK_TIMEOUT):
+        return False
+    try:
+        rebuild(app_id)
+    finally:
+        redis_master.delete(lock)
+    return True
+
+
+def _select(tasks, candidates, n):
+    candidates.extend(tasks[:n - len(candidates)])
+
+
+def get_tasks(app_id, strategy, user_id=None, user_ip=None, offset=0, limit=1,
+              select=_select):
+    """Return the next tasks of the app queue not answered by the user, or
+    None if the queue cannot be read. select(tasks, candidates, n) appends
+    up to n of the loaded tasks to candidates, e.g. the ones that can be
+    leased to the user"""
+    queue = _queue_key(app_id, strategy)
+    try:
+        if not redis_breaker.call(_ready, app_id, queue):
+            return None
+    except Unavailable:
+        return None
+
+    n = offset + limit
+    candidates = []
+    start = 0
+    while len(candidates) < n:
+        try:
+            window = redis_breaker.call(redis_master.zrange, queue, start,
+                                        start + WINDOW - 1)
+        except Unavailable:
+            return None
+        window = [int(m) for m in window]
+        if not window:
+            break
+        window = [i for i in window if i != EMPTY]
+        done = answered.get(app_id, window, user_id, user_ip)
+        if done is None:
+            # Redis is unavailable: skip the answered tasks with the DB
+            done = answered.check(app_id, window, user_id, user_ip)
+        task_ids = [i for i in window if i not in done]
+        for i in range(0, len(task_ids), n):
+            # the bitmaps can miss answers committed while they were built;
+            # the ones found here are set, so the next request gets other
+            # tasks
+            ids = task_ids[i:i + n]
+            done = answered.check(app_id, ids, user_id, user_ip)
+            select(_load([t for t in ids if t not in done]), candidates, n)
+            if len(candidates) >= n:
+                break
+        start += WINDOW
+    return candidates[offset:offset + limit]
+
+
+def _load(task_ids):
+    if not task_ids:
+        return []
+    tasks = db.session.query(model.Task)\
+              .filter(model.Task.id.in_(task_ids)).all()
+    tasks = dict((t.id, t) for t in tasks)
+    return [tasks[i] for i in task_ids if i in tasks]
+
+
+def _update(conn, app_id, task_id):
+    depth_first = _queue_key(app_id, 'depth_first')
+    breadth_first = _queue_key(app_id, 'breadth_first')
+    p = redis_master.pipeline(transaction=False)
+    p.exists(depth_first)
+    p.exists(breadth_first)
+    if not any(p.execute()):
+        # the app does not use the queues, or they are rebuilt from the DB
+        return
+    sql = text('''SELECT n_task_runs, n_answers FROM task WHERE id=:task_id''')
+    task = conn.execute(sql, task_id=task_id).first()
+    if task is None:
+        return
+    member = _member(task_id)
+    if (task.n_task_runs or 0) >= (task.n_answers or 30):
+        redis_master.zrem(depth_first, member)
+        redis_master.zrem(breadth_first, member)
+    elif redis_master.zscore(breadth_first, member) is not None:
+        redis_master.zincrby(breadth_first, member, 1)
+
+
+@event.listens_for(model.TaskRun, 'after_insert')
+def _task_run_added(mapper, conn, target):
+    """Update the queues of the app with a new answer"""
+    try:
+        redis_breaker.call(_update, conn, target.app_id, target.task_id)
+    except Unavailable:
+        # the answered bitmaps still skip the task for this user, and the
+        # queues are rebuilt when they expire
+        pass
+
+
+@event.listens_for(model.TaskRun, 'after_delete')
+def _task_run_deleted(mapper, conn, target):
+    """Answers are rarely deleted, so just drop the queues"""
+    delete(target.app_id)
+
+
+@event.listens_for(model.Task, 'after_insert')
+@event.listens_for(model.Task, 'after_update')
+@event.listens_for(model.Task, 'after_delete')
+def _task_changed(mapper, conn, target):
+    """New, updated or removed tasks invalidate the queues of the app"""
+    delete(target.app_id)
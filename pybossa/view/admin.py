@@ -35,6 +35,9 @@ from pybossa.core import db
 from pybossa.util import admin_required
 from pybossa.cache import apps as cached_apps
 from pybossa.cache import categories as cached_cat
+from pybossa import schedstats
+from pybossa import cachestats
+from pybossa import breaker
 from pybossa.auth import require
 import pybossa.validator as pb_validator
 from sqlalchemy import or_, func
@@ -71,8 +74,8 @@ def featured(app_id=None):
         if request.method == 'GET':
             apps = {}
             for c in categories:
-                n_apps = cached_apps.n_count(category=c.short_name)
-                apps[c.short_name], n_apps = cached_apps.get(category=c.short_name,
+                n_apps = cached_apps.n_count(category=c['short_name'])
+                apps[c['short_name']], n_apps = cached_apps.get(category=c['short_name'],
                                                              page=1,
                                                              per_page=n_apps)
             return render_template('/admin/applications.html', apps=apps,
@@ -246,7 +249,7 @@ def categories():
         categories = cached_cat.get_all()
         n_apps_per_category = dict()
         for c in categories:
-            n_apps_per_category[c.short_name] = cached_apps.n_count(c.short_name)
+            n_apps_per_category[c['short_name']] = cached_apps.n_count(c['short_name'])
 
         return render_template('admin/categories.html',
                                title=gettext('Categories'),
@@ -338,3 +341,64 @@ def update_category(id):
     except Exception as e:
         current_app.logger.error(e)
         return abort(500)
+
+
+@blueprint.route('/scheduler', methods=['GET', 'POST'])
+@login_required
+@admin_required
+def scheduler():
+    """Show the timing of the scheduler strategies per app"""
+    try:
+        if request.method == 'POST':
+            if schedstats.reset():
+                flash(gettext('Scheduler stats reset'), 'success')
+            else:
+                flash(gettext('Redis is unavailable'), 'error')
+            return redirect(url_for('.scheduler'))
+        schedstats.flush()
+        stats = schedstats.get()
+        if stats is None:
+            flash(gettext('Redis is unavailable'), 'error')
+            stats = []
+        app_ids = set(s['app_id'] for s in stats)
+        apps = {}
+        if app_ids:
+            apps = dict((a.id, a) for a in db.session.query(model.App)
+                        .filter(model.App.id.in_(app_ids)).all())
+        return render_template('admin/scheduler.html',
+                               title=gettext('Scheduler'),
+                               stats=stats, apps=apps,
+                               buckets=schedstats.BUCKETS + ('inf',))
+    except HTTPException:
+        return abort(403)
+    except Exception as e:
+        current_app.logger.error(e)
+        return abort(500)
+
+
+@blueprint.route('/cache', methods=['GET', 'POST'])
+@login_required
+@admin_required
+def cache():
+    """Show the hits, misses and timing of the cached functions"""
+    try:
+        if request.method == 'POST':
+            if cachestats.reset():
+                flash(gettext('Cache stats reset'), 'success')
+            else:
+                flash(gettext('Redis is unavailable'), 'error')
+            return redirect(url_for('.cache'))
+        cachestats.flush()
+        stats = cachestats.get()
+        if stats is None:
+            flash(gettext('Redis is unavailable'), 'error')
+            stats = []
+        return render_template('admin/cache.html',
+                               title=gettext('Cache'),
+                               stats=stats,
+                               breakers=breaker.get())
+    except HTTPException:
+        return abort(403)
+    except Exception as e:
+        current_app.logger.error(e)
+        return abort(500)
@@ -37,6 +37,7 @@ from pybossa.util import Pagination, UnicodeWriter, admin_required
 from pybossa.auth import require
 from pybossa.cache import apps as cached_apps
 from pybossa.cache import categories as cached_cat
+from pybossa import memo
 from pybossa.ckan import Ckan
 
 import json
@@ -108,6 +109,8 @@ class TaskSchedulerForm(Form):
                                  ('breadth_first', lazy_gettext('Breadth First')),
                                  ('depth_first', lazy_gettext('Depth First')),
                                  ('random', lazy_gettext('Random')),
+                                 ('redis_depth_first', lazy_gettext('Depth First (Redis queue)')),
+                                 ('redis_breadth_first', lazy_gettext('Breadth First (Redis queue)')),
 								 ('filter_by_users', lazy_gettext('Filtered by Users'))],)
 
 
@@ -120,6 +123,8 @@ def app_title(app, page_name):
 
 
 def app_by_shortname(short_name):
+    # not memoized: views change the App, and its values are already kept for
+    # the request by the cache decorators
     app = cached_apps.get_app(short_name)
     if app.id:
         # Populate CACHE with the data of the app
@@ -167,7 +172,7 @@ def index(page):
     else:
         categories = cached_cat.get_all()
         if len(categories) > 0:
-            cat_short_name = categories[0].short_name
+            cat_short_name = categories[0]['short_name']
         else:
             cat = db.session.query(model.Category).first()
             if cat:
@@ -209,11 +214,15 @@ def app_index(page, lookup, category, fallback, use_count):
     #        data.append(dict(app=app, n_tasks=cached_apps.n_tasks(app['id']),
     #                         overall_progress=cached_apps.overall_progress(app['id']),
     #                         last_activity=cached_apps.last_activity(app['id'])))
+    app_ids = [app['id'] for app in apps if 'tutorial' not in app['short_name']]
+    n_tasks = cached_apps.n_tasks_many(app_ids)
+    overall_progress = cached_apps.overall_progress_many(app_ids)
+    last_activity = cached_apps.last_activity_many(app_ids)
     for app in apps:
         if 'tutorial' not in app['short_name']:
-            data.append(dict(app=app, n_tasks=cached_apps.n_tasks(app['id']),
-                             overall_progress=cached_apps.overall_progress(app['id']),
-                             last_activity=cached_apps.last_activity(app['id'])))
+            data.append(dict(app=app, n_tasks=n_tasks[app['id']],
+                             overall_progress=overall_progress[app['id']],
+                             last_activity=last_activity[app['id']]))
 
     if fallback and not apps:
         return redirect(url_for('.published'))
@@ -221,22 +230,23 @@ def app_index(page, lookup, category, fallback, use_count):
     pagination = Pagination(page, per_page, count)
     categories = cached_cat.get_all()
     # Check for pre-defined categories featured and draft
-    featured_cat = model.Category(name='Featured',
-                                  short_name='featured',
-                                  description='Featured applications')
+    featured_cat = dict(name='Featured',
+                        short_name='featured',
+                        description='Featured applications')
     if category == 'featured':
         active_cat = featured_cat
     elif category == 'draft':
-        active_cat = model.Category(name='Draft',
-                                    short_name='draft',
-                                    description='Draft applications')
+        active_cat = dict(name='Draft',
+                          short_name='draft',
+                          description='Draft applications')
     else:
         active_cat = db.session.query(model.Category)\
                        .filter_by(short_name=category).first()
 
     # Check if we have to add the section Featured to local nav
     if cached_apps.n_featured() > 0:
-        categories.insert(0, featured_cat)
+        # do not change the list of categories kept for the request
+        categories = [featured_cat] + categories
     template_args = {
         "apps": data,
         "title": gettext("Applications"),
@@ -247,7 +257,7 @@ def app_index(page, lookup, category, fallback, use_count):
 
     n_apps_per_category = dict()
     for c in categories:
-        n_apps_per_category[c.short_name] = cached_apps.n_count(c.short_name)
+        n_apps_per_category[c['short_name']] = cached_apps.n_count(c['short_name'])
     template_args['n_apps_per_category'] = n_apps_per_category
     if use_count:
         template_args.update({"count": count})
@@ -493,7 +503,7 @@ def update(short_name):
         if request.method == 'POST':
             form = AppForm(request.form)
             categories = cached_cat.get_all()
-            form.category_id.choices = [(c.id, c.name) for c in categories]
+            form.category_id.choices = [(c['id'], c['name']) for c in categories]
             if form.validate():
                 return handle_valid_form(form)
             flash(gettext('Please correct the errors'), 'error')
@@ -677,10 +687,30 @@ def _import_task(app, handler, form, render_forms):
     return render_forms()
 
 
+@memo.memoized
+def task_by_id(task_id):
+    return db.session.query(Task).get(task_id)
+
+
+@memo.memoized
+def has_answered(app_id, task_id, user_id, user_ip):
+    """Return whether the user (or the IP address) has answered the task"""
+    tr = db.session.query(model.TaskRun.id)\
+        .filter(model.TaskRun.task_id == task_id)\
+        .filter(model.TaskRun.app_id == app_id)
+    if user_id is None:
+        tr = tr.filter(model.TaskRun.user_ip == user_ip)
+    else:
+        tr = tr.filter(model.TaskRun.user_id == user_id)
+    return tr.first() is not None
+
+
 @blueprint.route('/<short_name>/task/<int:task_id>')
 def task_presenter(short_name, task_id):
     app, n_tasks, n_task_runs, overall_progress, last_activity = app_by_shortname(short_name)
-    task = Task.query.filter_by(id=task_id).first_or_404()
+    task = task_by_id(task_id)
+    if task is None:
+        raise abort(404)
     try:
         require.app.read(app)
     except HTTPException:
@@ -724,18 +754,13 @@ def task_presenter(short_name, task_id):
     #return render_template('/applications/presenter.html', app = app)
     # Check if the user has submitted a task before
 
-    tr_search = db.session.query(model.TaskRun)\
-                  .filter(model.TaskRun.task_id == task_id)\
-                  .filter(model.TaskRun.app_id == app.id)
-
     if current_user.is_anonymous():
         remote_addr = request.remote_addr or "127.0.0.1"
-        tr = tr_search.filter(model.TaskRun.user_ip == remote_addr)
+        answered = has_answered(app.id, task.id, None, remote_addr)
     else:
-        tr = tr_search.filter(model.TaskRun.user_id == current_user.id)
+        answered = has_answered(app.id, task.id, current_user.id, None)
 
-    tr_first = tr.first()
-    if tr_first is None:
+    if not answered:
         return respond('/applications/presenter.html')
     else:
         return respond('/applications/task/done.html')
@@ -1169,6 +1194,25 @@ def show_stats(short_name):
                            app=app)
 
 
+@blueprint.route('/<short_name>/stats/locs.json')
+@login_required
+@admin_required
+def show_locs(short_name):
+    """Returns the number of anonymous users per cell of the App map"""
+    app, n_tasks, n_task_runs, overall_progress, last_activity = app_by_shortname(short_name)
+    try:
+        require.app.read(app)
+    except HTTPException:
+        if app.hidden:
+            raise abort(403)
+        else:
+            raise
+    locs = []
+    if current_app.config['GEO']:
+        locs = stats.stats_locs(app.id)
+    return Response(json.dumps(locs), mimetype='application/json')
+
+
 @blueprint.route('/<short_name>/tasks/settings')
 @login_required
 @admin_required
@@ -16,14 +16,15 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
 import json
-import pygeoip
-from flask import Blueprint, current_app
+from flask import Blueprint, current_app, Response
 from flask import render_template
 from sqlalchemy.sql import text
 
 from pybossa.core import db
 from pybossa.cache import cache, ONE_DAY
 from pybossa.cache import apps as cached_apps
+from pybossa.stats import ANSWERS
+from pybossa.geo import locate_many, bins
 
 blueprint = Blueprint('stats', __name__)
 
@@ -58,10 +59,11 @@ def n_tasks_site():
 
 @cache(timeout=ONE_DAY, key_prefix="site_n_task_runs")
 def n_task_runs_site():
-    sql = text('''SELECT COUNT(task_run.id) AS n_task_runs FROM task_run''')
+    sql = text('''SELECT SUM(n_auth + n_anon) AS n_task_runs FROM %s'''
+               % ANSWERS)
     results = db.engine.execute(sql)
     for row in results:
-        n_task_runs = row.n_task_runs
+        n_task_runs = int(row.n_task_runs or 0)
     return n_task_runs
 
 
@@ -69,19 +71,20 @@ def n_task_runs_site():
 def get_top5_apps_24_hours():
     # Top 5 Most active apps in last 24 hours
     sql = text('''SELECT app.id, app.name, app.short_name, app.info,
-               COUNT(task_run.app_id) AS n_answers FROM app, task_run
-               WHERE app.id=task_run.app_id
+               SUM(n_auth + n_anon) AS n_answers FROM app, %s
+               WHERE app.id=answers.app_id
                AND app.hidden=0
-               AND DATE(task_run.finish_time) > NOW() - INTERVAL '24 hour'
-               AND DATE(task_run.finish_time) <= NOW()
+               AND CAST(answers.day AS DATE) > NOW() - INTERVAL '24 hour'
+               AND CAST(answers.day AS DATE) <= NOW()
                GROUP BY app.id
-               ORDER BY n_answers DESC LIMIT 5;''')
+               ORDER BY n_answers DESC LIMIT 5;''' % ANSWERS)
 
     results = db.engine.execute(sql, limit=5)
     top5_apps_24_hours = []
     for row in results:
         tmp = dict(id=row.id, name=row.name, short_name=row.short_name,
-                   info=dict(json.loads(row.info)), n_answers=row.n_answers)
+                   info=dict(json.loads(row.info)),
+                   n_answers=int(row.n_answers))
         top5_apps_24_hours.append(tmp)
     return top5_apps_24_hours
 
@@ -107,27 +110,24 @@ def get_top5_users_24_hours():
     return top5_users_24_hours
 
 
-@cache(timeout=ONE_DAY, key_prefix="site_locs")
+@cache(timeout=ONE_DAY, key_prefix="site_locs_bins")
 def get_locs():
-    # All IP addresses from anonymous users to create a map
+    # All IP addresses from anonymous users, binned in a grid to create a map
     locs = []
     if current_app.config['GEO']:
         sql = '''SELECT DISTINCT(user_ip) from task_run WHERE user_ip IS NOT NULL;'''
-        results = db.engine.execute(sql)
-
-        geolite = current_app.root_path + '/../dat/GeoLiteCity.dat'
-        gic = pygeoip.GeoIP(geolite)
-        for row in results:
-            loc = gic.record_by_addr(row.user_ip)
-            if loc is None:
-                loc = {}
-            if (len(loc.keys()) == 0):
-                loc['latitude'] = 0
-                loc['longitude'] = 0
-            locs.append(dict(loc=loc))
+        ips = [row.user_ip for row in db.engine.execute(sql)]
+        locs = bins(locate_many(ips).values(),
+                    current_app.config.get('GEO_BIN_SIZE', 1))
     return locs
 
 
+@blueprint.route('/locs.json')
+def locs():
+    """Return the number of anonymous users per cell of the map"""
+    return Response(json.dumps(get_locs()), mimetype='application/json')
+
+
 @blueprint.route('/')
 def index():
     """Return Global Statistics for the site"""
@@ -152,11 +152,8 @@ def index():
 
     top5_users_24_hours = get_top5_users_24_hours()
 
-    locs = get_locs()
-
-    show_locs = False
-    if len(locs) > 0:
-        show_locs = True
+    # the map loads the locations from locs.json
+    show_locs = current_app.config['GEO']
 
     stats = dict(n_total_users=n_total_users, n_auth=n_auth, n_anon=n_anon,
                  n_published_apps=n_published_apps,
@@ -184,7 +181,6 @@ def index():
                            users=json.dumps(users),
                            apps=json.dumps(apps),
                            tasks=json.dumps(tasks),
-                           locs=json.dumps(locs),
                            show_locs=show_locs,
                            top5_users_24_hours=top5_users_24_hours,
                            top5_apps_24_hours=top5_apps_24_hours,
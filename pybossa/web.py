@@ -46,6 +46,8 @@ from pybossa.cache import apps as cached_apps
 from pybossa.cache import users as cached_users
 from pybossa.cache import categories as cached_cat
 from pybossa.ratelimit import get_view_rate_limit
+from pybossa import memo
+from pybossa import geo
 
 ##unosat addon
 from pybossa.model import User
@@ -97,8 +99,7 @@ except Exception as inst:
     print "Google singin disabled"
 
 # Check if app stats page can generate the map
-geolite = app.root_path + '/../dat/GeoLiteCity.dat'
-if not os.path.exists(geolite):
+if not os.path.exists(geo.GEOLITE):
     app.config['GEO'] = False
     print("GeoLiteCity.dat file not found")
     print("App page stats web map disabled")
@@ -143,6 +144,16 @@ def inject_x_rate_headers(response):
         h.add('X-RateLimit-Reset', str(limit.reset))
     return response
 
+
+@app.after_request
+def inject_x_calls_header(response):
+    if app.config.get('REQUEST_STATS'):
+        counts = memo.counts()
+        response.headers.add('X-PyBossa-Calls',
+                             'memo=%(memo_hits)s; cache=%(cache_calls)s; '
+                             'db=%(queries)s' % counts)
+    return response
+
 @app.context_processor
 def global_template_context():
     if current_user.is_authenticated():
@@ -197,10 +208,16 @@ def global_template_context():
 
 
 @login_manager.user_loader
+@memo.memoized
 def load_user(username):
     return db.session.query(model.User).filter_by(name=username).first()
 
 
+@memo.memoized
+def user_by_api_key(apikey):
+    return db.session.query(model.User).filter_by(api_key=apikey).first()
+
+
 @app.before_request
 def api_authentication():
     """ Attempt API authentication on a per-request basis."""
@@ -209,7 +226,7 @@ def api_authentication():
     if 'Authorization' in request.headers:
         apikey = request.headers.get('Authorization')
     if apikey:
-        user = db.session.query(model.User).filter_by(api_key=apikey).first()
+        user = user_by_api_key(apikey)
         ## HACK:
         # login_user sets a session cookie which we really don't want.
         # login_user(user)
@@ -281,8 +298,8 @@ def home():
     n_apps_per_category = dict()
     apps = dict()
     for c in categories:
-        n_apps_per_category[c.short_name] = cached_apps.n_count(c.short_name)
-        apps[c.short_name],count = cached_apps.get(c.short_name,1,1)
+        n_apps_per_category[c['short_name']] = cached_apps.n_count(c['short_name'])
+        apps[c['short_name']],count = cached_apps.get(c['short_name'],1,1)
     d['categories'] = categories
     d['n_apps_per_category'] = n_apps_per_category
     d['apps'] = apps
@@ -364,7 +381,7 @@ def get_flickr_gallery():
 @app.route("/add_one_spam")
 def add_one_spam():
     task_id=request.args.get('task_id', None)
-    query = text(''' UPDATE task SET is_it_spam=is_it_spam+1 WHERE id=:task_id ''')
+    query = text(''' UPDATE task SET is_it_spam=COALESCE(is_it_spam, 0)+1 WHERE id=:task_id ''')
     rows = db.engine.execute(query, task_id=task_id)
     return render_template("/home/about.html")
 
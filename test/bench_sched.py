@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+# This file is part of PyBossa.
+#
+# Copyright (C) 2013 SF Isle of Man Limited
+#
+# PyBossa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyBossa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Benchmark of the scheduler strategies.
+
+It creates one app per size with synthetic tasks and answers in the test DB
+(SQLALCHEMY_DATABASE_TEST_URI), and measures the latency and the number of
+queries of every strategy registered in pybossa.sched for:
+
+    * heavy: the registered user with most answers
+    * user: a registered user without answers
+    * anonymous: an IP without answers
+
+with one and several concurrent callers. Results are printed as JSON:
+
+    python test/bench_sched.py --sizes 10000,100000 --output bench.json
+
+WARNING: it rebuilds the test DB unless --reuse is given.
+
+"""
+import json
+import math
+import optparse
+import sys
+import threading
+import time
+
+from sqlalchemy.sql import text
+
+from base import web, model, db
+import pybossa.sched as sched
+from pybossa import schedstats
+from pybossa import taskqueue
+
+N_USERS = 1000
+# Share of the answers sent by anonymous volunteers
+ANONYMOUS = 0.3
+# Share of the answers sent from a son app (multi-stage apps)
+SON_APPS = 0.3
+
+
+def create_app(size, answers):
+    """Create an app with size tasks and about answers task runs per task"""
+    name = u'bench_%s' % size
+    app = db.session.query(model.App).filter_by(short_name=name).first()
+    if app is not None:
+        return app
+    app = model.App(name=name, short_name=name, description=name,
+                    owner_id=1, info={})
+    db.session.add(app)
+    db.session.commit()
+    print >> sys.stderr, 'Creating %s tasks' % size
+    db.engine.execute(text('''
+        INSERT INTO task (created, app_id, state, quorum, calibration,
+                          priority_0, info, n_answers, n_task_runs, is_it_spam)
+        SELECT now()::text, :app_id, 'ongoing', 0, 0, random(),
+               '{"url": "http://example.com/' || i || '.jpg"}', 30, 0,
+               CASE WHEN random() < 0.01 THEN 50 ELSE 0 END
+        FROM generate_series(1, :size) AS i'''), app_id=app.id, size=size)
+    # The answers are skewed: a few heavy volunteers send most of them, and
+    # tasks with a low id get more answers than the most recent ones
+    print >> sys.stderr, 'Creating task runs'
+    db.engine.execute('ALTER TABLE task_run DISABLE TRIGGER task_run_counter')
+    db.engine.execute(text('''
+        INSERT INTO task_run (created, app_id, task_id, user_id, user_ip,
+                              finish_time, son_app_id, info)
+        SELECT now()::text, :app_id, id,
+               CASE WHEN anonymous THEN NULL ELSE user_id END,
+               CASE WHEN anonymous THEN '10.' || (user_id % 256) || '.' ||
+                    floor(random() * 256) || '.' || floor(random() * 256)
+               END,
+               now()::text, son_app_id,
+               CASE WHEN son_app_id IS NULL THEN '{"answer": "Yes"}'
+                    ELSE '{"answer": "Yes", "son_app_id": ' || son_app_id || '}'
+               END
+        FROM (SELECT task.id,
+                     1 + CAST(floor(power(random(), 3) * :n_users) AS integer)
+                         AS user_id,
+                     random() < :anonymous AS anonymous,
+                     CASE WHEN random() < :son_apps
+                          THEN 1 + CAST(floor(random() * 3) AS integer)
+                     END AS son_app_id
+              FROM task, generate_series(1, :answers)
+              WHERE task.app_id = :app_id
+              AND random() < 1 - (task.id - :first) / CAST(:size AS float)) AS runs'''),
+        app_id=app.id, n_users=N_USERS, anonymous=ANONYMOUS,
+        son_apps=SON_APPS, answers=answers * 2, size=size,
+        first=db.session.query(db.func.min(model.Task.id))
+                .filter_by(app_id=app.id).scalar())
+    db.engine.execute('ALTER TABLE task_run ENABLE TRIGGER task_run_counter')
+    # Recount the answers, the task_state trigger sets the completed tasks
+    db.engine.execute(text('''
+        UPDATE task SET n_task_runs=counts.n FROM
+        (SELECT task_id, COUNT(id) AS n FROM task_run WHERE app_id=:app_id
+        GROUP BY task_id) AS counts WHERE task.id=counts.task_id'''),
+        app_id=app.id)
+    db.engine.execute('ANALYZE task; ANALYZE task_run')
+    return app
+
+
+def create_users():
+    """Create the volunteers that answer the tasks"""
+    if db.session.query(model.User).count() >= N_USERS:
+        return
+    print >> sys.stderr, 'Creating %s users' % N_USERS
+    db.engine.execute(text('''
+        INSERT INTO "user" (created, email_addr, name, fullname, api_key,
+                            admin, info)
+        SELECT now()::text, 'bench' || i || '@example.com', 'bench' || i,
+               'bench' || i, md5(i::text), false, '{}'
+        FROM generate_series(1, :n) AS i'''), n=N_USERS)
+
+
+def callers(app_id):
+    """Return the (user_id, user_ip) of every kind of caller"""
+    heavy = db.engine.execute(text('''
+        SELECT user_id FROM task_run WHERE app_id=:app_id
+        AND user_id IS NOT NULL GROUP BY user_id
+        ORDER BY COUNT(id) DESC LIMIT 1'''), app_id=app_id).scalar()
+    return dict(heavy=(heavy, None),
+                user=(N_USERS, None),
+                anonymous=(None, '192.168.0.1'))
+
+
+def percentile(values, p):
+    """Nearest rank percentile of a sorted list"""
+    if not values:
+        return None
+    return values[max(0, int(math.ceil(p / 100.0 * len(values))) - 1)]
+
+
+def run(strategy, app_id, user_id, user_ip, calls, concurrency, limit):
+    """Call the strategy calls times from concurrency threads"""
+    f = sched.schedulers[strategy]
+    latencies = []
+    counts = []
+    lock = threading.Lock()
+
+    def worker(n):
+        for i in range(n):
+            with schedstats.counted() as counter:
+                start = time.time()
+                f(app_id, user_id, user_ip, limit=limit, son_app_id=1)
+                ms = (time.time() - start) * 1000
+            # drop the changes of the strategy (e.g. incremental answers)
+            db.session.remove()
+            with lock:
+                latencies.append(ms)
+                counts.append(counter)
+
+    threads = [threading.Thread(target=worker, args=(calls // concurrency,))
+               for i in range(concurrency)]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - start
+    latencies.sort()
+    n = len(latencies)
+    return dict(calls=n,
+                throughput=n / elapsed if elapsed else None,
+                mean_ms=sum(latencies) / n,
+                p50_ms=percentile(latencies, 50),
+                p95_ms=percentile(latencies, 95),
+                p99_ms=percentile(latencies, 99),
+                max_ms=latencies[-1],
+                queries_per_call=sum(c['queries'] for c in counts) / float(n),
+                rows_per_call=sum(c['rows'] for c in counts) / float(n))
+
+
+def main():
+    parser = optparse.OptionParser(__doc__.strip().split('\n')[0])
+    parser.add_option('--sizes', default='10000,100000,1000000',
+                      help='comma separated number of tasks of the apps')
+    parser.add_option('--answers', type='int', default=2,
+                      help='average number of answers of the first tasks')
+    parser.add_option('--strategies', default=None,
+                      help='comma separated strategies, all by default')
+    parser.add_option('--calls', type='int', default=200,
+                      help='calls per strategy and caller')
+    parser.add_option('--concurrency', default='1,8',
+                      help='comma separated number of concurrent callers')
+    parser.add_option('--limit', type='int', default=1,
+                      help='tasks requested per call')
+    parser.add_option('--reuse', action='store_true',
+                      help='reuse the apps of a previous run')
+    parser.add_option('--output', default=None,
+                      help='file for the JSON results, stdout by default')
+    options, args = parser.parse_args()
+
+    strategies = options.strategies and options.strategies.split(',') or \
+        sorted(set(s for s in sched.schedulers if s != 'default'))
+    web.app.config['SCHED_STATS'] = False
+    if not options.reuse:
+        db.drop_all()
+        db.create_all()
+    create_users()
+
+    results = []
+    for size in [int(s) for s in options.sizes.split(',')]:
+        app = create_app(size, options.answers)
+        taskqueue.delete(app.id)
+        for strategy in strategies:
+            for caller, (user_id, user_ip) in sorted(callers(app.id).items()):
+                for concurrency in options.concurrency.split(','):
+                    print >> sys.stderr, '%s tasks, %s, %s, %s threads' % \
+                        (size, strategy, caller, concurrency)
+                    r = run(strategy, app.id, user_id, user_ip,
+                            options.calls, int(concurrency), options.limit)
+                    r.update(size=size, strategy=strategy, caller=caller,
+                             concurrency=int(concurrency),
+                             limit=options.limit)
+                    results.append(r)
+        taskqueue.delete(app.id)
+
+    out = dict(created=time.strftime('%Y-%m-%dT%H:%M:%S'),
+               database=db.engine.url.database,
+               answers=options.answers, results=results)
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(out, f, indent=2)
+    else:
+        print json.dumps(out, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -16,7 +16,7 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
 
-from base import model, db, web, Fixtures
+from base import model, db, web, Fixtures, redis_flushall
 from helper.user import User
 
 
@@ -32,6 +32,7 @@ class Helper(object):
 
     def tearDown(self):
         db.session.remove()
+        redis_flushall()
 
     @classmethod
     def teardown_class(cls):
@@ -17,8 +17,11 @@
 # along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
 
 import json
+import time
 from helper import web
-from base import model, Fixtures, db
+from base import model, Fixtures, db, redis_flushall
+from pybossa import cachestats
+from pybossa.breaker import redis_breaker
 from mock import patch
 from collections import namedtuple
 from bs4 import BeautifulSoup
@@ -519,3 +522,60 @@ class TestAdmin(web.Helper):
         assert category['name'] in res.data, err_msg
         output = db.session.query(model.Category).get(obj.id)
         assert output.id == category['id'], err_msg
+
+    def test_scheduler_stats(self):
+        """Test ADMIN scheduler shows the timing of the schedulers"""
+        redis_flushall()
+        self.register()
+        self.new_application()
+        self.new_task(1)
+        self.app.get('/api/app/1/newtask')
+        res = self.app.get('/admin/scheduler', follow_redirects=True)
+        assert "Sample App" in res.data, res.data
+        assert "default" in res.data, res.data
+        # Reset the stats
+        res = self.app.post('/admin/scheduler', follow_redirects=True)
+        assert "Scheduler stats reset" in res.data, res.data
+        assert "Sample App" not in res.data, res.data
+        self.signout()
+
+        # Non admin users cannot see them
+        self.register(fullname="Juan Jose", username="juan",
+                      email="juan@juan.com", password="juan")
+        res = self.app.get('/admin/scheduler', follow_redirects=True)
+        assert res.status_code == 403, res.status
+
+    def test_cache_stats(self):
+        """Test ADMIN cache shows the metrics of the cached functions"""
+        redis_flushall()
+        self.register()
+        cachestats.record('front_page_top_apps', hits=3, misses=1,
+                          compute_ms=20.0, writes=1, bytes=100)
+        res = self.app.get('/admin/cache', follow_redirects=True)
+        assert "front_page_top_apps" in res.data, res.data
+        assert "75%" in res.data, res.data
+        # Reset the stats
+        res = self.app.post('/admin/cache', follow_redirects=True)
+        assert "Cache stats reset" in res.data, res.data
+        assert "front_page_top_apps" not in res.data, res.data
+        self.signout()
+
+        # Non admin users cannot see them
+        self.register(fullname="Juan Jose", username="juan",
+                      email="juan@juan.com", password="juan")
+        res = self.app.get('/admin/cache', follow_redirects=True)
+        assert res.status_code == 403, res.status
+
+    def test_stats_without_redis(self):
+        """Test ADMIN cache and scheduler stats work without Redis"""
+        self.register()
+        redis_breaker.opened_at = time.time()
+        try:
+            for url in ('/admin/cache', '/admin/scheduler'):
+                res = self.app.get(url, follow_redirects=True)
+                assert res.status_code == 200, (url, res.status)
+                assert "Redis is unavailable" in res.data, res.data
+                res = self.app.post(url, follow_redirects=True)
+                assert "Redis is unavailable" in res.data, res.data
+        finally:
+            redis_breaker.opened_at = None
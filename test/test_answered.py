@@ -0,0 +1,130 @@
+# -*- coding: utf8 -*-
+# This file is part of PyBossa.
+#
+# Copyright (C) 2013 SF Isle of Man Limited
+#
+# PyBossa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyBossa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+from mock import patch
+from helper import sched
+from base import model, Fixtures, db, redis_flushall, redis_master
+import pybossa.sched
+from pybossa import answered
+from pybossa.breaker import redis_breaker
+
+
+class TestAnswered(sched.Helper):
+    def setUp(self):
+        super(TestAnswered, self).setUp()
+        redis_flushall()
+        Fixtures.create()
+        self.del_task_runs()
+
+    def add_task_run(self, task_id, **kwargs):
+        tr = model.TaskRun(app_id=1, task_id=task_id, **kwargs)
+        db.session.add(tr)
+        db.session.commit()
+
+    def test_built_from_db(self):
+        """Test ANSWERED bitmaps are built with the answers in the DB"""
+        self.add_task_run(1, user_ip='127.0.0.1')
+        self.add_task_run(3, user_id=1)
+        assert answered.get(1, range(1, 11), user_ip='127.0.0.1') == set([1])
+        assert answered.get(1, range(1, 11), user_id=1) == set([3])
+        assert answered.get(1, range(1, 11), user_id=2) == set()
+
+    def test_updated_on_answer(self):
+        """Test ANSWERED bitmaps are updated with new answers"""
+        assert answered.get(1, [1, 2], user_id=1) == set()
+        self.add_task_run(2, user_id=1)
+        # The bitmap is updated in place, not rebuilt from the DB
+        db.engine.execute('DELETE FROM task_run')
+        assert answered.get(1, [1, 2], user_id=1) == set([2])
+
+    def test_son_app_id(self):
+        """Test ANSWERED bitmaps of a stage only have its answers"""
+        self.add_task_run(1, user_ip='127.0.0.1', info={'son_app_id': 2})
+        self.add_task_run(2, user_ip='127.0.0.1')
+        tasks = range(1, 11)
+        assert answered.get(1, tasks, user_ip='127.0.0.1') == set([1, 2])
+        assert answered.get(1, tasks, user_ip='127.0.0.1',
+                            son_app_id=2) == set([1])
+        self.add_task_run(3, user_ip='127.0.0.1', info={'son_app_id': 2})
+        assert answered.get(1, tasks, user_ip='127.0.0.1',
+                            son_app_id=2) == set([1, 3])
+        assert answered.get(1, tasks, user_ip='127.0.0.1',
+                            son_app_id=20) == set()
+
+    def test_delete(self):
+        """Test ANSWERED deleted answers drop the bitmaps of the app"""
+        self.add_task_run(1, user_id=1)
+        assert answered.get(1, [1], user_id=1) == set([1])
+        tr = db.session.query(model.TaskRun).first()
+        db.session.delete(tr)
+        db.session.commit()
+        assert answered.get(1, [1], user_id=1) == set()
+        # a bitmap is a bit per task, not per answer
+        key = [k for k in redis_master.keys('pybossa_sched:app:1:answered:*')
+               if k.endswith(':user:1')][0]
+        assert redis_master.strlen(key) <= 2, redis_master.strlen(key)
+
+    def test_rolled_back(self):
+        """Test ANSWERED bits are only set for committed answers"""
+        assert answered.get(1, [1, 2], user_id=1) == set()
+        db.session.add(model.TaskRun(app_id=1, task_id=2, user_id=1))
+        db.session.flush()
+        db.session.rollback()
+        assert answered.get(1, [1, 2], user_id=1) == set()
+
+    def test_check(self):
+        """Test ANSWERED check finds the answers missing in the bitmaps"""
+        self.add_task_run(1, user_id=1)
+        assert answered.get(1, [1, 2], user_id=1) == set([1])
+        # an answer committed while the bitmap was built
+        db.engine.execute("INSERT INTO task_run (app_id, task_id, user_id) "
+                          "VALUES (1, 2, 1)")
+        assert answered.get(1, [1, 2], user_id=1) == set([1])
+        task = pybossa.sched.get_depth_first_task(1, user_id=1)
+        assert task.id == 3, task.id
+        # and the bitmap has been fixed
+        assert answered.get(1, [1, 2], user_id=1) == set([1, 2])
+
+    def test_redis_unavailable(self):
+        """Test ANSWERED get returns None without Redis"""
+        self.add_task_run(1, user_id=1)
+        redis_breaker.opened_at = time.time()
+        try:
+            assert answered.get(1, [1, 2], user_id=1) is None
+            self.add_task_run(2, user_id=1)
+            tasks = pybossa.sched.get_depth_first_tasks(1, user_id=1, limit=2)
+        finally:
+            redis_breaker.opened_at = None
+        assert [t.id for t in tasks] == [3, 4], [t.id for t in tasks]
+
+    def test_span(self):
+        """Test ANSWERED tasks beyond the span of the bitmaps use the DB"""
+        self.add_task_run(1, user_id=1)
+        self.add_task_run(3, user_id=1)
+        with patch.object(answered, 'MAX_SPAN', 2):
+            assert answered.get(1, [1, 2, 3, 4], user_id=1) == set([1, 3])
+            self.add_task_run(4, user_id=1)
+            assert answered.get(1, [2, 4], user_id=1) == set([4])
+            ns = redis_master.get(answered._ns_key(1))
+            key = answered._key(1, ns, user_id=1)
+            assert redis_master.strlen(key) == 1, redis_master.strlen(key)
+
+    def test_no_tasks(self):
+        """Test ANSWERED get returns None for apps without tasks"""
+        assert answered.get(1000, [1, 2], user_id=1) is None
@@ -0,0 +1,129 @@
+# -*- coding: utf8 -*-
+# This file is part of PyBossa.
+#
+# Copyright (C) 2013 SF Isle of Man Limited
+#
+# PyBossa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyBossa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import time
+from mock import patch
+from nose.tools import assert_raises
+from redis.exceptions import ConnectionError, ResponseError
+from base import redis_flushall, redis_master
+from pybossa.breaker import CircuitBreaker, Unavailable, redis_breaker
+from pybossa.cache import memoize
+from pybossa.ratelimit import RateLimit
+
+
+calls = []
+
+
+def fail():
+    calls.append('fail')
+    raise ConnectionError('down')
+
+
+def work():
+    calls.append('work')
+    return 'done'
+
+
+@memoize(timeout=300)
+def square(n):
+    calls.append(n)
+    return n * n
+
+
+class FakeSettings:
+    REDIS_KEYPREFIX = 'pybossa_cache_test'
+
+
+class TestCircuitBreaker:
+    def setUp(self):
+        del calls[:]
+
+    def test_opens(self):
+        """Test BREAKER opens after threshold consecutive failures"""
+        b = CircuitBreaker('test', threshold=2, cooldown=300)
+        assert_raises(Unavailable, b.call, fail)
+        assert b.state == 'closed'
+        assert_raises(Unavailable, b.call, fail)
+        assert b.state == 'open'
+        # the service is not called while it is open
+        assert_raises(Unavailable, b.call, work)
+        assert calls == ['fail', 'fail'], calls
+        assert b.stats == dict(calls=2, failures=2, short_circuits=1,
+                               opens=1), b.stats
+
+    def test_success_resets_failures(self):
+        """Test BREAKER only counts consecutive failures"""
+        b = CircuitBreaker('test', threshold=2, cooldown=300)
+        assert_raises(Unavailable, b.call, fail)
+        assert b.call(work) == 'done'
+        assert_raises(Unavailable, b.call, fail)
+        assert b.state == 'closed'
+
+    def test_half_open(self):
+        """Test BREAKER tries the service again after the cool-down"""
+        b = CircuitBreaker('test', threshold=1, cooldown=0.05)
+        assert_raises(Unavailable, b.call, fail)
+        time.sleep(0.06)
+        assert b.state == 'half-open'
+        # a failed try opens it for another cool-down
+        assert_raises(Unavailable, b.call, fail)
+        assert_raises(Unavailable, b.call, work)
+        time.sleep(0.06)
+        assert b.call(work) == 'done'
+        assert b.state == 'closed'
+
+    def test_other_errors(self):
+        """Test BREAKER does not count errors of the calls"""
+        def wrong():
+            raise ResponseError('wrong type')
+        b = CircuitBreaker('test', threshold=1, cooldown=300)
+        assert_raises(ResponseError, b.call, wrong)
+        assert b.state == 'closed'
+
+
+class TestRedisUnavailable:
+    def setUp(self):
+        redis_flushall()
+        del calls[:]
+        self.env = patch.dict(os.environ)
+        self.env.start()
+        os.environ.pop('PYBOSSA_REDIS_CACHE_DISABLED', None)
+        self.settings = patch('pybossa.cache.settings', FakeSettings)
+        self.settings.start()
+        redis_breaker.opened_at = time.time()
+
+    def tearDown(self):
+        redis_breaker.opened_at = None
+        self.settings.stop()
+        self.env.stop()
+        redis_flushall()
+
+    def test_cache(self):
+        """Test BREAKER open skips the cache"""
+        assert square(2) == 4
+        assert square(2) == 4
+        assert calls == [2, 2], calls
+        assert not redis_master.keys('pybossa_cache_test*')
+
+    def test_ratelimit(self):
+        """Test BREAKER open does not limit the requests"""
+        for i in range(3):
+            rlimit = RateLimit('rate-limit/test/', 2, 300, True)
+            assert not rlimit.over_limit
+            assert rlimit.remaining == 2
@@ -0,0 +1,348 @@
+# -*- coding: utf8 -*-
+# This file is part of PyBossa.
+#
+# Copyright (C) 2013 SF Isle of Man Limited
+#
+# PyBossa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyBossa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import time
+import datetime
+import cPickle as pickle
+from mock import patch
+from nose.plugins.skip import SkipTest
+from nose.tools import assert_raises
+from helper import sched
+from base import model, Fixtures, db, redis_flushall, redis_master
+import pybossa.cache
+from pybossa import cachestats
+from pybossa.cache import LocalCache, memoize, memoize_many, delete_memoized, \
+    update_memoized, _dumps, _loads
+from pybossa.cache import apps as cached_apps
+from pybossa.util import pretty_date
+
+
+class FakeSettings:
+    REDIS_KEYPREFIX = 'pybossa_cache_test'
+
+
+calls = []
+
+
+@memoize(timeout=300)
+def double(n):
+    calls.append(n)
+    return n * 2
+
+
+@memoize_many(double)
+def double_many(ns):
+    calls.append(ns)
+    return dict((n, n * 2) for n in ns)
+
+
+@memoize(timeout=1, stale=300)
+def triple(n):
+    calls.append(n)
+    return n * 3
+
+
+@memoize(timeout=300)
+def category(name):
+    calls.append(name)
+    return model.Category(name=name, short_name=name)
+
+
+class TestLocalCache:
+    def test_get_set(self):
+        """Test CACHE local cache stores values"""
+        c = LocalCache(size=10, timeout=5)
+        assert c.get('a') is None
+        c.set('a', 'pickled', 300)
+        assert c.get('a') == 'pickled', c.get('a')
+        c.delete('a')
+        assert c.get('a') is None
+
+    def test_disabled(self):
+        """Test CACHE local cache of size 0 stores nothing"""
+        c = LocalCache(size=0)
+        c.set('a', 'pickled', 300)
+        assert c.get('a') is None
+
+    def test_lru(self):
+        """Test CACHE local cache evicts the least recently used key"""
+        c = LocalCache(size=2, timeout=5)
+        c.set('a', 1, 300)
+        c.set('b', 2, 300)
+        c.get('a')
+        c.set('c', 3, 300)
+        assert c.get('b') is None
+        assert c.get('a') == 1
+        assert c.get('c') == 3
+
+    def test_timeout(self):
+        """Test CACHE local cache keeps keys for the shortest timeout"""
+        c = LocalCache(size=2, timeout=5)
+        c.set('a', 1, 0)
+        c.set('b', 2, 300)
+        time.sleep(0.01)
+        assert c.get('a') is None
+        assert c.get('b') == 2
+
+    def test_delete_prefix(self):
+        """Test CACHE local cache deletes all the keys of a function"""
+        c = LocalCache(size=10, timeout=5)
+        c.set('p:f_args::1', 1, 300)
+        c.set('p:f_args::2', 2, 300)
+        c.set('p:g_args::1', 3, 300)
+        c.delete_prefix('p:f_args::')
+        assert c.get('p:f_args::1') is None
+        assert c.get('p:f_args::2') is None
+        assert c.get('p:g_args::1') == 3
+
+
+class TestMemoize:
+    def setUp(self):
+        redis_flushall()
+        del calls[:]
+        self.env = patch.dict(os.environ)
+        self.env.start()
+        os.environ.pop('PYBOSSA_REDIS_CACHE_DISABLED', None)
+        self.settings = patch('pybossa.cache.settings', FakeSettings)
+        self.settings.start()
+
+    def tearDown(self):
+        self.settings.stop()
+        self.env.stop()
+        redis_flushall()
+
+    def test_memoize(self):
+        """Test CACHE memoize caches the value per argument"""
+        assert double(1) == 2
+        assert double(1) == 2
+        assert double(2) == 4
+        assert calls == [1, 2], calls
+
+    def test_delete_memoized_arg(self):
+        """Test CACHE delete_memoized removes the value of one argument"""
+        double(1)
+        double(2)
+        delete_memoized(double, 1)
+        double(1)
+        double(2)
+        assert calls == [1, 2, 1], calls
+
+    def test_delete_memoized_all(self):
+        """Test CACHE delete_memoized of a function is a counter increment"""
+        double(1)
+        double(2)
+        n_keys = len(redis_master.keys('pybossa_cache_test*'))
+        delete_memoized(double)
+        # values of the old generation are not deleted, but ignored
+        assert len(redis_master.keys('pybossa_cache_test*')) == n_keys
+        double(1)
+        double(2)
+        assert calls == [1, 2, 1, 2], calls
+
+    def lock(self, function):
+        """Take the lock of the only memoized key of a function"""
+        keys = redis_master.keys('pybossa_cache_test:%s_args::*' %
+                                 function.__name__)
+        keys = [k for k in keys if not k.endswith(':lock')]
+        redis_master.set('%s:lock' % keys[0], 1)
+        return keys[0]
+
+    def test_stale_while_revalidate(self):
+        """Test CACHE stale values are served while a worker refreshes them"""
+        assert triple(1) == 3
+        time.sleep(1.1)
+        # another worker is refreshing the value
+        key = self.lock(triple)
+        assert triple(1) == 3
+        assert calls == [1], calls
+        # the value is refreshed by the next worker that gets the lock
+        redis_master.delete('%s:lock' % key)
+        assert triple(1) == 3
+        assert calls == [1, 1], calls
+        assert not redis_master.exists('%s:lock' % key)
+
+    def test_single_flight(self):
+        """Test CACHE waits for the worker computing a missing value"""
+        double(1)
+        key = self.lock(double)
+        redis_master.delete(key)
+        with patch.object(pybossa.cache, 'LOCK_WAIT', 0.2):
+            start = time.time()
+            assert double(1) == 2
+            # the worker holding the lock did not store it, so it gives up
+            assert time.time() - start >= 0.2
+        assert calls == [1, 1], calls
+
+
+    def test_memoize_many(self):
+        """Test CACHE memoize_many computes only the missing values"""
+        double(1)
+        assert double_many([1, 2, 3]) == {1: 2, 2: 4, 3: 6}
+        assert double_many([3, 2]) == {2: 4, 3: 6}
+        # the values are shared with the memoized function
+        assert double(2) == 4
+        delete_memoized(double, 3)
+        assert double_many([1, 2, 3]) == {1: 2, 2: 4, 3: 6}
+        assert calls == [1, [2, 3], [3]], calls
+
+    def test_stats(self):
+        """Test CACHE hits and misses are recorded per function"""
+        cachestats.reset()
+        double(1)
+        double(1)
+        double_many([1, 2])
+        cachestats.flush()
+        stats = dict((s['name'], s) for s in cachestats.get())
+        assert stats['double']['hits'] == 2, stats
+        assert stats['double']['misses'] == 2, stats
+        assert stats['double']['reads'] == 3, stats
+        assert stats['double']['writes'] == 2, stats
+        assert stats['double']['bytes'] > 0, stats
+        cachestats.reset()
+        assert cachestats.get() == []
+
+    def test_update_memoized(self):
+        """Test CACHE update_memoized changes only cached values"""
+        double(1)
+        update_memoized(double, 1, lambda n: n + 10)
+        update_memoized(double, 2, lambda n: n + 10)
+        assert double(1) == 12
+        assert double(2) == 4
+        assert calls == [1, 2], calls
+
+    def test_mapped_instances_not_cached(self):
+        """Test CACHE refuses to store mapped instances"""
+        assert category(u'a').name == u'a'
+        assert category(u'a').name == u'a'
+        assert calls == [u'a', u'a'], calls
+        assert not redis_master.keys('pybossa_cache_test:category_args::*')
+
+
+class TestAppsMany(sched.Helper):
+    def setUp(self):
+        super(TestAppsMany, self).setUp()
+        Fixtures.create()
+
+    def test_many_equals_one(self):
+        """Test CACHE apps grouped queries match the per app ones"""
+        app_ids = [1, 2]
+        n_tasks = cached_apps.n_tasks_many(app_ids)
+        progress = cached_apps.overall_progress_many(app_ids)
+        activity = cached_apps.last_activity_many(app_ids)
+        for app_id in app_ids:
+            assert n_tasks[app_id] == cached_apps.n_tasks(app_id)
+            assert progress[app_id] == \
+                cached_apps.overall_progress(app_id), progress
+            assert activity[app_id] == cached_apps.last_activity(app_id)
+
+
+class TestAppsCounters(sched.Helper):
+    def setUp(self):
+        super(TestAppsCounters, self).setUp()
+        Fixtures.create()
+        redis_flushall()
+        self.env = patch.dict(os.environ)
+        self.env.start()
+        os.environ.pop('PYBOSSA_REDIS_CACHE_DISABLED', None)
+        self.settings = patch('pybossa.cache.settings', FakeSettings)
+        self.settings.start()
+
+    def tearDown(self):
+        self.settings.stop()
+        self.env.stop()
+        super(TestAppsCounters, self).tearDown()
+
+    def test_counters_follow_writes(self):
+        """Test CACHE apps counters are updated by new tasks and answers"""
+        n_tasks = cached_apps.n_tasks(1)
+        n_task_runs = cached_apps.n_task_runs(1)
+        cached_apps.last_activity(1)
+        task = model.Task(app_id=1, info={}, n_answers=10)
+        db.session.add(task)
+        db.session.commit()
+        task_run = model.TaskRun(app_id=1, task_id=task.id,
+                                 user_ip='127.0.0.1',
+                                 finish_time='2013-01-01T00:00:00')
+        db.session.add(task_run)
+        db.session.commit()
+        # the counters are updated in place, not computed again
+        db.engine.execute('DELETE FROM task_run')
+        assert cached_apps.n_tasks(1) == n_tasks + 1
+        assert cached_apps.n_task_runs(1) == n_task_runs + 1
+        assert cached_apps.last_activity(1) == \
+            pretty_date('2013-01-01T00:00:00')
+
+    def test_counters_rolled_back(self):
+        """Test CACHE apps counters are only updated on commit"""
+        n_tasks = cached_apps.n_tasks(1)
+        n_task_runs = cached_apps.n_task_runs(1)
+        task = model.Task(app_id=1, info={}, n_answers=10)
+        db.session.add(task)
+        db.session.flush()
+        db.session.add(model.TaskRun(app_id=1, task_id=task.id,
+                                     user_ip='127.0.0.1'))
+        db.session.flush()
+        db.session.rollback()
+        assert cached_apps.n_tasks(1) == n_tasks
+        assert cached_apps.n_task_runs(1) == n_task_runs
+
+        # one update per app and transaction
+        with patch('pybossa.cache.apps.update_memoized') as update:
+            db.session.add_all([model.Task(app_id=1, info={}, n_answers=10)
+                                for i in range(3)])
+            db.session.commit()
+        assert update.call_count == 1, update.call_args_list
+
+
+class TestEncoding:
+    def test_round_trip(self):
+        """Test CACHE values are decoded as they were encoded"""
+        value = (1, 2.5, [u'a', 'b', None], dict(a=(1, 2)))
+        raw = _dumps(value)
+        assert raw[0] == 'p', raw[0]
+        assert _loads(raw) == value, _loads(raw)
+
+    def test_compression(self):
+        """Test CACHE values larger than the threshold are compressed"""
+        value = [(u'2013-01-01T00:00:00', i) for i in range(1000)]
+        with patch.object(pybossa.cache, 'COMPRESS_THRESHOLD', 100):
+            raw = _dumps(value)
+        with patch.object(pybossa.cache, 'COMPRESS_THRESHOLD', 10 ** 9):
+            plain = _dumps(value)
+        assert raw[0] == 'P', raw[0]
+        assert plain[0] == 'p', plain[0]
+        assert len(raw) < len(plain), (len(raw), len(plain))
+        assert _loads(raw) == value
+
+    def test_msgpack(self):
+        """Test CACHE values can be encoded with msgpack"""
+        if pybossa.cache.msgpack is None:
+            raise SkipTest('msgpack is not installed')
+        with patch.object(pybossa.cache, 'ENCODING', 'msgpack'):
+            raw = _dumps((1, 2.5, [u'a', None]))
+            assert raw[0] == 'm', raw[0]
+            assert _loads(raw) == (1, 2.5, [u'a', None]), _loads(raw)
+            # msgpack does not know about datetimes, so they are pickled
+            raw = _dumps((1, 2.5, datetime.datetime.now()))
+            assert raw[0] == 'p', raw[0]
+
+    def test_unknown_encoding(self):
+        """Test CACHE values stored by previous versions are rejected"""
+        raw = pickle.dumps((1, 2.5, 'a'), pickle.HIGHEST_PROTOCOL)
+        assert_raises(ValueError, _loads, raw)
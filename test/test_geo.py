@@ -0,0 +1,108 @@
+# -*- coding: utf8 -*-
+# This file is part of PyBossa.
+#
+# Copyright (C) 2013 SF Isle of Man Limited
+#
+# PyBossa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyBossa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+from mock import patch
+from base import redis_flushall, redis_master
+from pybossa import geo
+from pybossa.breaker import redis_breaker
+
+
+class FakeReader(object):
+    def __init__(self):
+        self.lookups = []
+
+    def record_by_addr(self, ip):
+        self.lookups.append(ip)
+        if ip == '10.0.0.1':
+            return None
+        return dict(city='Geneva', latitude=46.2, longitude=6.15)
+
+
+class TestGeo:
+    def setUp(self):
+        redis_flushall()
+        self.reader = FakeReader()
+        self.patch = patch('pybossa.geo._get_reader', lambda: self.reader)
+        self.patch.start()
+
+    def tearDown(self):
+        self.patch.stop()
+        redis_flushall()
+
+    def test_locate_many(self):
+        """Test GEO looks up every IP address only once"""
+        locs = geo.locate_many(['1.2.3.4', '10.0.0.1', '1.2.3.4'])
+        assert locs['1.2.3.4']['city'] == 'Geneva', locs
+        err_msg = "Unknown addresses should be at 0, 0"
+        assert locs['10.0.0.1'] == dict(latitude=0, longitude=0), err_msg
+        assert sorted(self.reader.lookups) == ['1.2.3.4', '10.0.0.1']
+        assert redis_master.hlen(geo._key()) == 2
+        assert 0 < redis_master.ttl(geo._key()) <= geo.TIMEOUT
+
+        locs = geo.locate_many(['1.2.3.4', '10.0.0.1', '5.6.7.8'])
+        assert locs['10.0.0.1'] == dict(latitude=0, longitude=0), locs
+        assert locs['5.6.7.8']['latitude'] == 46.2, locs
+        assert sorted(self.reader.lookups) == ['1.2.3.4', '10.0.0.1',
+                                               '5.6.7.8']
+        assert geo.locate('1.2.3.4')['longitude'] == 6.15
+
+    def test_chunks(self):
+        """Test GEO reads the IP addresses from Redis in chunks"""
+        ips = ['1.2.3.%s' % i for i in range(5)]
+        with patch.object(geo, 'CHUNK', 2):
+            assert len(geo.locate_many(ips)) == 5
+            assert len(geo.locate_many(ips)) == 5
+        assert len(self.reader.lookups) == 5, self.reader.lookups
+
+    def test_redis_unavailable(self):
+        """Test GEO looks up the IP addresses without Redis"""
+        redis_breaker.opened_at = time.time()
+        try:
+            geo.locate_many(['1.2.3.4'])
+            geo.locate_many(['1.2.3.4'])
+        finally:
+            redis_breaker.opened_at = None
+        assert self.reader.lookups == ['1.2.3.4', '1.2.3.4']
+        assert not redis_master.exists(geo._key())
+
+    def test_reset(self):
+        """Test GEO reset removes the locations"""
+        geo.locate('1.2.3.4')
+        geo.reset()
+        geo.locate('1.2.3.4')
+        assert self.reader.lookups == ['1.2.3.4', '1.2.3.4']
+        redis_breaker.opened_at = time.time()
+        try:
+            geo.reset()
+        finally:
+            redis_breaker.opened_at = None
+
+    def test_bins(self):
+        """Test GEO counts the locations within the cells of a grid"""
+        locs = [dict(latitude=46.2, longitude=6.1),
+                dict(latitude=46.4, longitude=6.3),
+                dict(latitude=-33.9, longitude=18.4),
+                dict(latitude=0, longitude=0)]
+        bins = geo.bins(locs, size=1)
+        assert len(bins) == 3, bins
+        assert bins[0] == dict(lat=46.3, lng=6.2, count=2), bins[0]
+        assert dict(lat=-33.9, lng=18.4, count=1) in bins, bins
+        # the cell of (0, 0) goes up to (90, 90)
+        assert len(geo.bins(locs, size=90)) == 2
+        assert geo.bins([]) == []
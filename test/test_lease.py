@@ -0,0 +1,81 @@
+# -*- coding: utf8 -*-
+# This file is part of PyBossa.
+#
+# Copyright (C) 2013 SF Isle of Man Limited
+#
+# PyBossa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyBossa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+
+from helper import sched
+from base import model, Fixtures, db, redis_flushall
+import pybossa
+from pybossa.breaker import redis_breaker
+
+
+class TestLease(sched.Helper):
+    def setUp(self):
+        super(TestLease, self).setUp()
+        redis_flushall()
+        Fixtures.create()
+        self.del_task_runs()
+        app = db.session.query(model.App).get(1)
+        app.time_limit = 60
+        for t in app.tasks:
+            t.n_answers = 1
+            t.info = {}
+        db.session.commit()
+
+    def test_leased_task_is_not_sent_twice(self):
+        """Test LEASE a leased task is not sent to other users"""
+        t1 = pybossa.sched.new_task(1, user_ip='10.0.0.1')
+        t2 = pybossa.sched.new_task(1, user_ip='10.0.0.2')
+        assert t1.id != t2.id, (t1, t2)
+        # the lease holder gets the same task again
+        t3 = pybossa.sched.new_task(1, user_ip='10.0.0.1')
+        assert t3.id == t1.id, t3
+
+    def test_answer_releases_lease(self):
+        """Test LEASE an answer releases the lease of the user"""
+        t1 = pybossa.sched.new_task(1, user_ip='10.0.0.1')
+        tr = model.TaskRun(app_id=1, task_id=t1.id, user_ip='10.0.0.1')
+        db.session.add(tr)
+        db.session.commit()
+        leases = pybossa.lease.count([t1.id], 60)
+        assert leases[t1.id] == 0, leases
+
+    def test_expired_lease_is_reclaimed(self):
+        """Test LEASE expired leases are reclaimed"""
+        app = db.session.query(model.App).get(1)
+        app.time_limit = 1
+        db.session.commit()
+        t1 = pybossa.sched.new_task(1, user_ip='10.0.0.1')
+        time.sleep(1.1)
+        t2 = pybossa.sched.new_task(1, user_ip='10.0.0.2')
+        assert t1.id == t2.id, (t1, t2)
+
+    def test_redis_unavailable(self):
+        """Test LEASE fails open without Redis"""
+        t1 = pybossa.sched.new_task(1, user_ip='10.0.0.1')
+        redis_breaker.opened_at = time.time()
+        try:
+            # no lease is counted or taken
+            t2 = pybossa.sched.new_task(1, user_ip='10.0.0.2')
+            assert t2.id == t1.id, (t1, t2)
+            assert pybossa.lease.count([t1.id], 60) == {t1.id: 0}
+            tr = model.TaskRun(app_id=1, task_id=t1.id, user_ip='10.0.0.1')
+            db.session.add(tr)
+            db.session.commit()
+        finally:
+            redis_breaker.opened_at = None
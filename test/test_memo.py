@@ -0,0 +1,129 @@
+# -*- coding: utf8 -*-
+# This file is part of PyBossa.
+#
+# Copyright (C) 2013 SF Isle of Man Limited
+#
+# PyBossa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyBossa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
+
+from mock import patch
+from helper import web
+from base import Fixtures, redis_flushall
+from pybossa import memo
+from pybossa.cache import memoize, memoize_many, delete_memoized
+
+
+calls = []
+
+
+@memoize(timeout=300)
+def double(n):
+    calls.append(n)
+    return n * 2
+
+
+@memoize_many(double)
+def double_many(ns):
+    calls.append(tuple(ns))
+    return dict((n, n * 2) for n in ns)
+
+
+@memo.memoized
+def triple(n):
+    calls.append(n)
+    return n * 3
+
+
+class TestMemo(web.Helper):
+    def setUp(self):
+        super(TestMemo, self).setUp()
+        redis_flushall()
+        del calls[:]
+
+    def test_memoize(self):
+        """Test MEMO keeps the memoized values within the request"""
+        with web.web.app.test_request_context('/'):
+            assert double(2) == 4
+            assert double(2) == 4
+            assert calls == [2], calls
+            assert memo.counts()['memo_hits'] == 1, memo.counts()
+        with web.web.app.test_request_context('/'):
+            assert double(2) == 4
+            assert memo.counts()['memo_hits'] == 0, memo.counts()
+
+    def test_memoize_many(self):
+        """Test MEMO is shared by the memoize_many functions"""
+        with web.web.app.test_request_context('/'):
+            assert double(1) == 2
+            assert double_many([1, 2]) == {1: 2, 2: 4}
+            assert double(2) == 4
+            assert calls == [1, (2,)], calls
+
+    def test_delete(self):
+        """Test MEMO values are removed by delete_memoized"""
+        with web.web.app.test_request_context('/'):
+            double(2)
+            double(3)
+            delete_memoized(double, 2)
+            double(2)
+            double(3)
+            assert calls == [2, 3, 2], calls
+            delete_memoized(double)
+            double(3)
+            assert calls == [2, 3, 2, 3], calls
+
+    def test_memoized(self):
+        """Test MEMO memoized only keeps the values within a request"""
+        assert triple(2) == 6
+        assert triple(2) == 6
+        assert calls == [2, 2], calls
+        with web.web.app.test_request_context('/'):
+            triple(2)
+            triple(2)
+            triple(3)
+            assert calls == [2, 2, 2, 3], calls
+
+    def test_header(self):
+        """Test MEMO sends the calls of the request if REQUEST_STATS"""
+        Fixtures.create()
+        res = self.app.get('/app/%s/' % Fixtures.app_short_name)
+        assert 'X-PyBossa-Calls' not in res.headers
+        with patch.dict(web.web.app.config, {'REQUEST_STATS': True}):
+            res = self.app.get('/app/%s/' % Fixtures.app_short_name)
+            header = res.headers['X-PyBossa-Calls']
+            assert header.startswith('memo='), header
+            assert 'db=' in header, header
+
+    def test_copies(self):
+        """Test MEMO values changed by a caller do not change for the others"""
+        with web.web.app.test_request_context('/'):
+            value = dict(info=dict(n=1))
+            memo.set('key', value)
+            value['info']['n'] = 2
+            memo.get('key')['info']['n'] = 3
+            assert memo.get('key') == dict(info=dict(n=1)), memo.get('key')
+            # immutable values are not copied
+            value = (1, u'a', None)
+            memo.set('key', value)
+            assert memo.get('key') is value
+
+    def test_users(self):
+        """Test MEMO keeps the users of the request"""
+        Fixtures.create()
+        with web.web.app.test_request_context('/'):
+            user = web.web.load_user(Fixtures.name)
+            assert web.web.user_by_api_key(Fixtures.api_key) is user
+            queries = memo.counts()['queries']
+            assert web.web.load_user(Fixtures.name) is user
+            assert web.web.user_by_api_key(Fixtures.api_key) is user
+            assert memo.counts()['queries'] == queries, memo.counts()
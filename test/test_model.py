@@ -93,3 +93,50 @@ class TestModel:
 
         out = user.dictize()
         assert out['name'] == u'test-user', out
+
+    def test_task_n_task_runs(self):
+        """Test MODEL Task.n_task_runs follows TaskRun inserts and deletes"""
+        app = model.App(name=u'counter', short_name=u'counter')
+        task = model.Task(app=app, info={})
+        db.session.add_all([app, task])
+        db.session.commit()
+        task_id = task.id
+        assert task.n_task_runs == 0, task.n_task_runs
+
+        for i in range(3):
+            db.session.add(model.TaskRun(app=app, task=task,
+                                         user_ip='127.0.0.%s' % i))
+        db.session.commit()
+        db.session.remove()
+        task = db.session.query(model.Task).get(task_id)
+        assert task.n_task_runs == 3, task.n_task_runs
+
+        db.session.delete(task.task_runs[0])
+        db.session.commit()
+        db.session.remove()
+        task = db.session.query(model.Task).get(task_id)
+        assert task.n_task_runs == 2, task.n_task_runs
+
+    def test_task_state(self):
+        """Test MODEL Task.state is completed when n_answers are submitted"""
+        app = model.App(name=u'state', short_name=u'state')
+        task = model.Task(app=app, info={'n_answers': 2})
+        db.session.add_all([app, task])
+        db.session.commit()
+        task_id = task.id
+        assert task.n_answers == 2, task.n_answers
+
+        for i in range(2):
+            db.session.add(model.TaskRun(app=app, task=task,
+                                         user_ip='127.0.0.%s' % i))
+            db.session.commit()
+        db.session.remove()
+        task = db.session.query(model.Task).get(task_id)
+        assert task.state == 'completed', task.state
+
+        task.n_answers = 3
+        task.info = {}
+        db.session.commit()
+        db.session.remove()
+        task = db.session.query(model.Task).get(task_id)
+        assert task.state == 'ongoing', task.state
@@ -18,10 +18,15 @@
 
 import json
 import random
+import time
+from mock import patch
 
 from helper import sched
 from base import model, Fixtures, db, redis_flushall
 import pybossa
+import pybossa.lease
+import pybossa.schedstats
+from pybossa.breaker import redis_breaker
 
 
 class TestSched(sched.Helper):
@@ -345,6 +350,155 @@ class TestSched(sched.Helper):
         print json.loads(res.data)
         assert json.loads(res.data) == {}, res.data
 
+    def test_task_batch_preloading(self):
+        """Test TASK batch Pre-loading returns N different tasks"""
+        redis_flushall()
+        # Del previous TaskRuns
+        self.del_task_runs()
+
+        res = self.app.get('api/app/1/newtasks?n=3')
+        tasks = json.loads(res.data)
+        assert len(tasks) == 3, tasks
+        for t in tasks:
+            assert t.get('info'), t
+            assert self.is_unique(t['id'], tasks), "Tasks should be different"
+        # The batch starts with the task returned by newtask
+        res = self.app.get('api/app/1/newtask')
+        task = json.loads(res.data)
+        assert tasks[0]['id'] == task['id'], task
+
+        # Submit an Answer for all of them
+        for t in tasks:
+            tr = model.TaskRun(app_id=t['app_id'], task_id=t['id'],
+                               user_ip="127.0.0.1", info={'answer': 'No'})
+            db.session.add(tr)
+        db.session.commit()
+        res = self.app.get('api/app/1/newtasks?n=20')
+        new_tasks = json.loads(res.data)
+        assert len(new_tasks) == 7, new_tasks
+        for t in tasks:
+            assert self.is_unique(t['id'], tasks + new_tasks), t
+
+    def test_task_batch_preloading_n(self):
+        """Test TASK batch Pre-loading only accepts a positive n"""
+        for n in ('0', '-3', 'all'):
+            res = self.app.get('api/app/1/newtasks?n=%s' % n)
+            assert res.status_code == 400, (n, res.status_code)
+            err = json.loads(res.data)
+            assert err['exception_cls'] == 'BadRequest', err
+
+    def test_random_task(self):
+        """Test SCHED random sends all the tasks not answered by the user"""
+        redis_flushall()
+        # Del previous TaskRuns
+        self.del_task_runs()
+
+        assigned_tasks = []
+        task = pybossa.sched.get_random_task(1, user_ip='127.0.0.1')
+        while task is not None:
+            assigned_tasks.append(task)
+            tr = model.TaskRun(app_id=1, task_id=task.id,
+                               user_ip='127.0.0.1', info={'answer': 'Yes'})
+            db.session.add(tr)
+            db.session.commit()
+            task = pybossa.sched.get_random_task(1, user_ip='127.0.0.1')
+
+        assert len(assigned_tasks) == 10, assigned_tasks
+        for t in assigned_tasks:
+            assert self.is_unique(t.id, assigned_tasks), t
+        # completed tasks are not sent
+        task = pybossa.sched.get_random_task(1, user_ip='127.0.0.2')
+        assert task is not None, task
+        db.session.query(model.Task).update({'n_answers': 1})
+        db.session.commit()
+        task = pybossa.sched.get_random_task(1, user_ip='127.0.0.2')
+        assert task is None, task
+
+    def test_random_tasks_windows(self):
+        """Test SCHED random reads past the windows of leased tasks"""
+        redis_flushall()
+        # Del previous TaskRuns
+        self.del_task_runs()
+        app = db.session.query(model.App).get(1)
+        app.time_limit = 60
+        for t in app.tasks:
+            t.n_answers = 1
+            t.info = {}
+        for i in range(20):
+            db.session.add(model.Task(app_id=1, info={}, n_answers=1))
+        db.session.commit()
+        tasks = db.session.query(model.Task).order_by(model.Task.id).all()
+        # the first two windows are leased to another user
+        for t in tasks[:-5]:
+            assert pybossa.lease.acquire(t, 60, user_ip='10.0.0.9')
+
+        with patch('random.randint', lambda a, b: a):
+            got = pybossa.sched.get_random_tasks(1, user_ip='127.0.0.1',
+                                                 limit=3)
+        assert [t.id for t in got] == [t.id for t in tasks[-5:-2]], got
+
+    def test_filtered_by_user_task(self):
+        """Test SCHED filter_by_users skips the tasks answered in a stage"""
+        redis_flushall()
+        # Del previous TaskRuns
+        self.del_task_runs()
+
+        task = pybossa.sched.get_filtered_by_user_task(
+            1, user_ip='127.0.0.1', son_app_id='2')
+        tr = model.TaskRun(app_id=1, task_id=task.id, user_ip='127.0.0.1',
+                           info={'answer': 'Yes', 'son_app_id': 2})
+        db.session.add(tr)
+        db.session.commit()
+        assert tr.son_app_id == 2, tr.son_app_id
+
+        # The task is answered for stage 2 but not for stage 20
+        t = pybossa.sched.get_filtered_by_user_task(
+            1, user_ip='127.0.0.1', son_app_id='2')
+        assert t.id != task.id, t
+        t = pybossa.sched.get_filtered_by_user_task(
+            1, user_ip='127.0.0.1', son_app_id='20')
+        assert t.id == task.id, t
+
+        # Spam reports are checked against the app spam_threshold
+        app = db.session.query(model.App).get(1)
+        app.info = dict(app.info, spam_threshold=1)
+        task.is_it_spam = 1
+        db.session.add_all([app, task])
+        db.session.commit()
+        t = pybossa.sched.get_filtered_by_user_task(
+            1, user_ip='127.0.0.1', son_app_id='20')
+        assert t.id != task.id, t
+
+    def test_sched_stats(self):
+        """Test SCHED calls are timed per strategy and app"""
+        redis_flushall()
+        # Del previous TaskRuns
+        self.del_task_runs()
+        pybossa.schedstats.reset()
+
+        with patch.object(pybossa.schedstats.counters, 'interval', 3600):
+            pybossa.sched.new_task(1, user_ip='127.0.0.1')
+            pybossa.sched.new_tasks(1, user_ip='127.0.0.1', limit=3)
+            err_msg = "The stats should be kept within the process"
+            assert pybossa.schedstats.get() == [], err_msg
+            pybossa.schedstats.flush()
+            stats = pybossa.schedstats.get()
+            assert len(stats) == 1, stats
+            assert stats[0]['strategy'] == 'default', stats
+            assert stats[0]['app_id'] == 1, stats
+            assert stats[0]['calls'] == 2, stats
+            assert stats[0]['queries'] >= 2, stats
+            assert sum(n for b, n in stats[0]['histogram']) == 2, stats
+
+            # the stats are dropped while Redis is unavailable
+            pybossa.sched.new_task(1, user_ip='127.0.0.1')
+            redis_breaker.opened_at = time.time()
+            try:
+                pybossa.schedstats.flush()
+            finally:
+                redis_breaker.opened_at = None
+            assert pybossa.schedstats.get()[0]['calls'] == 2
+
     def test_task_priority(self):
         """Test SCHED respects priority_0 field"""
         redis_flushall()
@@ -17,7 +17,7 @@
 # along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
 
 from helper import sched
-from base import Fixtures, redis_flushall
+from base import model, Fixtures, db, redis_flushall
 import json
 
 
@@ -82,3 +82,17 @@ class TestSched(sched.Helper):
         # Check that we received a Task with answer
         assert data.get('info'), data
         assert data.get('info').get('last_answer').get('answer') == 'No No'
+
+    def test_incremental_tasks_without_info(self):
+        """ Test incremental SCHED strategy with answers without info"""
+        redis_flushall()
+        Fixtures.create_2(sched='incremental')
+        self.del_task_runs()
+        task = db.session.query(model.Task).first()
+        db.session.add(model.TaskRun(app_id=task.app_id, task_id=task.id,
+                                     user_ip='10.0.0.1', info=None))
+        db.session.commit()
+
+        res = self.app.get('api/app/1/newtask')
+        data = json.loads(res.data)
+        assert data.get('info').get('last_answer') == {}, data
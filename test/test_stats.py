@@ -16,8 +16,11 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
 
+import os
 import datetime
 import time
+from mock import patch
+from nose.plugins.skip import SkipTest
 from base import web, model, db, Fixtures
 import pybossa.stats as stats
 
@@ -165,3 +168,82 @@ class TestStats:
 
             err_msg = "date stats sum of auth and anon should be 10"
             assert user_stats['n_anon'] + user_stats['n_auth'], err_msg
+
+    def test_04_stats_grouped_by_day_and_hour(self):
+        """Test STATS dates and hours are grouped by day and hour"""
+        runs = db.session.query(model.TaskRun).order_by(model.TaskRun.id)\
+                 .limit(3).all()
+        for tr in runs:
+            tr.finish_time = u'2013-01-15T07:30:00.000000'
+            tr.user_id = None
+            tr.user_ip = u'127.0.0.1'
+        db.session.commit()
+        with self.app.test_request_context('/'):
+            dates, dates_n_tasks, dates_anon, dates_auth = \
+                stats.stats_dates(1)
+            assert dates[u'2013-01-15'] == 3, dates
+            assert dates_anon[u'2013-01-15'] == 3, dates_anon
+            assert u'2013-01-15' not in dates_auth, dates_auth
+            assert sum(dates.values()) == 10, dates
+            hours, hours_anon, hours_auth, max_hours, \
+                max_hours_anon, max_hours_auth = stats.stats_hours(1)
+            assert hours['07'] >= 3, hours
+            assert hours_anon['07'] >= 3, hours_anon
+            assert sum(hours.values()) == 10, hours
+            assert max_hours == max(hours.values()), max_hours
+
+    def test_05_rollup(self):
+        """Test STATS rollup folds the new task runs only once"""
+        before = sorted(stats._answers_per_hour(1))
+        err_msg = "The task runs of the last minutes should not be folded"
+        assert stats.rollup() == 0, err_msg
+        assert stats.rollup(margin=datetime.timedelta(0)) == 10
+        assert stats.rollup(margin=datetime.timedelta(0)) == 0
+        assert db.session.query(model.TaskRunStats).count() > 0
+        err_msg = "The answers should be the same with the rollups"
+        assert sorted(stats._answers_per_hour(1)) == before, err_msg
+
+        # task runs created after the rollup are still counted
+        task = db.session.query(model.Task).first()
+        tr = model.TaskRun(app_id=1, task_id=task.id,
+                           user_ip=u'127.0.0.2',
+                           finish_time=u'2013-01-15T07:30:00.000000')
+        db.session.add(tr)
+        db.session.commit()
+        answers = stats._answers_per_hour(1)
+        assert (u'2013-01-15', u'07', 0, 1) in answers, answers
+        assert stats.rollup() == 1
+        assert sorted(stats._answers_per_hour(1)) == sorted(answers)
+
+        db.session.delete(tr)
+        db.session.commit()
+        assert stats.rollup(rebuild=True, margin=datetime.timedelta(0)) == 10
+        assert sorted(stats._answers_per_hour(1)) == before
+
+    def test_06_stats_numpy(self):
+        """Test STATS computed with NumPy are the same"""
+        if stats.numpy is None:
+            raise SkipTest('numpy is not installed')
+        dates = {'2013-03-30': 3, '2013-03-31': 1, '2013-04-02': 5}
+        dates_n_tasks = dict((d, 100.0) for d in dates)
+        dates_anon = {'2013-03-30': 3, '2013-04-02': 1}
+        dates_auth = {'2013-03-31': 1, '2013-04-02': 4}
+        last_day = datetime.datetime(2013, 4, 2)
+        with patch.dict(os.environ, {'PYBOSSA_REDIS_CACHE_DISABLED': '1'}):
+            with patch.dict(self.app.config, {'STATS_NUMPY': False}):
+                with self.app.test_request_context('/'):
+                    expected = stats.get_stats(1)
+                    expected_days = stats.stats_dates(1)
+                    expected_dates = stats.stats_format_dates(
+                        1, dates, dates_n_tasks, {}, dates_anon, dates_auth)
+            with patch.dict(self.app.config, {'STATS_NUMPY': True}):
+                with self.app.test_request_context('/'):
+                    assert stats.get_stats(1) == expected
+                    assert stats.stats_dates(1) == expected_days
+                    assert stats.stats_format_dates(
+                        1, dates, dates_n_tasks, {}, dates_anon,
+                        dates_auth) == expected_dates
+                    estimate = stats._estimate_numpy(last_day, 9, 3, 4.5)
+        assert estimate == {'2013-04-02': 9, '2013-04-03': 12,
+                            '2013-04-04': 15, '2013-04-05': 18,
+                            '2013-04-06': 21, '2013-04-07': 24}, estimate
@@ -0,0 +1,137 @@
+# -*- coding: utf8 -*-
+# This file is part of PyBossa.
+#
+# Copyright (C) 2013 SF Isle of Man Limited
+#
+# PyBossa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyBossa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import time
+from mock import patch
+
+from helper import sched
+from base import model, Fixtures, db, redis_flushall, redis_master
+from pybossa import taskqueue
+import pybossa.sched
+from pybossa.breaker import redis_breaker
+
+
+class TestTaskQueue(sched.Helper):
+    def setUp(self):
+        super(TestTaskQueue, self).setUp()
+        redis_flushall()
+        Fixtures.create(sched='redis_depth_first')
+        self.del_task_runs()
+
+    def test_depth_first_queue(self):
+        """Test TASKQUEUE depth first sends tasks by priority and id"""
+        task = db.session.query(model.Task).get(5)
+        task.priority_0 = 1
+        db.session.commit()
+
+        tasks = taskqueue.get_tasks(1, 'depth_first', user_ip='127.0.0.1',
+                                    limit=3)
+        assert [t.id for t in tasks] == [5, 1, 2], tasks
+        tasks = taskqueue.get_tasks(1, 'depth_first', user_ip='127.0.0.1',
+                                    offset=1)
+        assert [t.id for t in tasks] == [1], tasks
+
+    def test_breadth_first_queue(self):
+        """Test TASKQUEUE breadth first sends the least answered task"""
+        taskqueue.rebuild(1)
+        tr = model.TaskRun(app_id=1, task_id=1, user_ip='127.0.0.2')
+        db.session.add(tr)
+        db.session.commit()
+
+        tasks = taskqueue.get_tasks(1, 'breadth_first', user_ip='127.0.0.1',
+                                    limit=10)
+        assert len(tasks) == 10, tasks
+        assert tasks[-1].id == 1, tasks
+
+    def test_queue_excludes_answered_tasks(self):
+        """Test TASKQUEUE does not send a task twice to the same user"""
+        tasks = taskqueue.get_tasks(1, 'depth_first', user_ip='127.0.0.1')
+        tr = model.TaskRun(app_id=1, task_id=tasks[0].id,
+                           user_ip='127.0.0.1')
+        db.session.add(tr)
+        db.session.commit()
+
+        out = taskqueue.get_tasks(1, 'depth_first', user_ip='127.0.0.1')
+        assert out[0].id != tasks[0].id, out
+        out = taskqueue.get_tasks(1, 'depth_first', user_ip='127.0.0.2')
+        assert out[0].id == tasks[0].id, out
+
+    def test_newtask_endpoint(self):
+        """Test TASKQUEUE is used by the newtask endpoint"""
+        res = self.app.get('api/app/1/newtask')
+        data = json.loads(res.data)
+        assert data['id'] == 1, data
+
+    def test_answer_without_queues(self):
+        """Test TASKQUEUE answers of apps without queues do not create them"""
+        tr = model.TaskRun(app_id=1, task_id=1, user_ip='127.0.0.2')
+        db.session.add(tr)
+        db.session.commit()
+        assert not redis_master.keys('pybossa_sched:app:1:*_first')
+
+    def test_answer_without_redis(self):
+        """Test TASKQUEUE answers are saved while Redis is unavailable"""
+        taskqueue.rebuild(1)
+        redis_breaker.opened_at = time.time()
+        try:
+            tr = model.TaskRun(app_id=1, task_id=1, user_ip='127.0.0.2')
+            db.session.add(tr)
+            db.session.commit()
+        finally:
+            redis_breaker.opened_at = None
+        assert db.session.query(model.TaskRun).count() == 1
+
+    def test_queue_without_redis(self):
+        """Test TASKQUEUE strategies use the DB while Redis is unavailable"""
+        redis_breaker.opened_at = time.time()
+        try:
+            assert taskqueue.get_tasks(1, 'depth_first') is None
+            res = self.app.get('api/app/1/newtask')
+        finally:
+            redis_breaker.opened_at = None
+        data = json.loads(res.data)
+        assert data['id'] == 1, data
+
+    def test_rebuild_lock(self):
+        """Test TASKQUEUE queues are rebuilt by one worker at a time"""
+        redis_master.set('pybossa_sched:app:1:rebuild', 1)
+        with patch.object(taskqueue, 'rebuild') as rebuild:
+            assert taskqueue.get_tasks(1, 'depth_first') is None
+            assert not rebuild.called
+            res = self.app.get('api/app/1/newtask')
+            assert json.loads(res.data)['id'] == 1, res.data
+        redis_master.delete('pybossa_sched:app:1:rebuild')
+        tasks = taskqueue.get_tasks(1, 'depth_first')
+        assert [t.id for t in tasks] == [1], tasks
+        assert redis_master.exists('pybossa_sched:app:1:depth_first')
+
+    def test_queue_leases(self):
+        """Test TASKQUEUE strategies do not send a leased task to others"""
+        app = db.session.query(model.App).get(1)
+        app.time_limit = 60
+        for t in app.tasks:
+            t.n_answers = 1
+            t.info = {}
+        db.session.commit()
+        t1 = pybossa.sched.new_task(1, user_ip='10.0.0.1')
+        t2 = pybossa.sched.new_task(1, user_ip='10.0.0.2')
+        assert t1.id != t2.id, (t1, t2)
+        # the lease holder gets the same task again
+        t3 = pybossa.sched.new_task(1, user_ip='10.0.0.1')
+        assert t3.id == t1.id, t3
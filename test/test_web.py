@@ -1723,6 +1723,24 @@ class TestWeb(web.Helper):
         err_msg = "There should be a Global Statistics page of the project"
         assert "General Statistics" in res.data, err_msg
 
+    def test_58_global_stats_locs(self):
+        """Test WEB global stats map is served as JSON"""
+        res = self.app.get("/stats/locs.json")
+        assert res.status_code == 200, res.status_code
+        assert res.mimetype == 'application/json', res.mimetype
+        assert isinstance(json.loads(res.data), list), res.data
+
+    def test_58_global_stats_map(self):
+        """Test WEB global stats shows the map without locating the users"""
+        with patch('pybossa.view.stats.get_locs') as get_locs:
+            with patch.dict(web.web.app.config, {'GEO': True}):
+                res = self.app.get('/stats', follow_redirects=True)
+                assert 'id="map"' in res.data, res.data
+            with patch.dict(web.web.app.config, {'GEO': False}):
+                res = self.app.get('/stats', follow_redirects=True)
+                assert 'id="map"' not in res.data, res.data
+            assert not get_locs.called, get_locs.call_count
+
     def test_59_help_api(self):
         """Test WEB help api page exists"""
         Fixtures.create()